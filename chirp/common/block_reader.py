@@ -0,0 +1,210 @@
+"""
+Backends for reading a file as a sequence of data blocks.
+
+mp3_frame.split() consumes a file as an iterator over blocks of data.
+How those blocks are produced matters a great deal depending on where
+the file lives:
+
+  "buffered": Small (4k) reads.  This is the historical behavior, and
+    works with any file-like object.
+  "large": Big (1-8MB) reads, with posix_fadvise() hints telling the
+    kernel that the file will be read sequentially and only once.  On
+    network filesystems (like our Samba mounts), where each read is
+    bounded by latency rather than bandwidth, this is much faster.
+  "mmap": The file is memory-mapped and the blocks are sliced directly
+    from the mapping, so no read() calls are made at all.  This is the
+    fastest option for files on local disks.
+
+Backends that need a real file descriptor quietly fall back to
+buffered reads when given something like a StringIO.
+
+The default backend is taken from the MP3_READER setting, if there is
+one.
+"""
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+import sys
+
+
+BUFFERED = "buffered"
+LARGE = "large"
+MMAP = "mmap"
+
+ALL_READERS = (BUFFERED, LARGE, MMAP)
+
+# The size of the chunks of data read by the buffered backend.  The
+# largest possible MP3 frame is 1045 bytes; this value should be larger
+# than that.
+BUFFERED_READ_SIZE = 4 << 10  # 4k
+
+# Limits and default for the size of the reads done by the large
+# backend.
+MIN_LARGE_READ_SIZE = 1 << 20  # 1MB
+MAX_LARGE_READ_SIZE = 8 << 20  # 8MB
+DEFAULT_LARGE_READ_SIZE = 4 << 20  # 4MB
+
+# The size of the blocks sliced out of a memory mapping.
+MMAP_BLOCK_SIZE = 1 << 20  # 1MB
+
+# Linux's values for the posix_fadvise() advice constants.
+_POSIX_FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", 2)
+_POSIX_FADV_NOREUSE = getattr(os, "POSIX_FADV_NOREUSE", 5)
+
+
+def _find_posix_fadvise():
+    """Returns a posix_fadvise(fd, offset, len, advice) function, or None."""
+    if hasattr(os, "posix_fadvise"):
+        return os.posix_fadvise
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        c_fadvise = libc.posix_fadvise64
+    except (OSError, AttributeError):
+        return None
+    c_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                          ctypes.c_int]
+    c_fadvise.restype = ctypes.c_int
+
+    def posix_fadvise(fd, offset, length, advice):
+        err = c_fadvise(fd, offset, length, advice)
+        if err:
+            raise OSError(err, os.strerror(err))
+    return posix_fadvise
+
+_posix_fadvise = _find_posix_fadvise()
+
+
+def fadvise(fd, *advice_list):
+    """Give the kernel hints about how an entire file will be accessed.
+
+    This is purely advisory, so failures are silently ignored.
+
+    Args:
+      fd: An integer file descriptor.
+      advice_list: One or more POSIX_FADV_* values.
+
+    Returns:
+      True if all of the hints were accepted, False otherwise.
+    """
+    if _posix_fadvise is None:
+        return False
+    try:
+        for advice in advice_list:
+            _posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        return False
+    return True
+
+
+def _get_fileno(file_obj):
+    """Returns file_obj's file descriptor, or None if it doesn't have one."""
+    try:
+        return file_obj.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+
+def read_buffered(file_obj, read_size=BUFFERED_READ_SIZE):
+    """Yields successive small blocks of data from a file-like object."""
+    while True:
+        block = file_obj.read(read_size)
+        if not block:
+            break
+        yield block
+
+
+def read_large(file_obj, read_size=DEFAULT_LARGE_READ_SIZE):
+    """Yields successive large blocks of data from a file-like object.
+
+    Args:
+      file_obj: A file-like object.
+      read_size: The size of each read; this is clamped to lie between
+        MIN_LARGE_READ_SIZE and MAX_LARGE_READ_SIZE.
+    """
+    read_size = max(MIN_LARGE_READ_SIZE, min(read_size, MAX_LARGE_READ_SIZE))
+    fd = _get_fileno(file_obj)
+    if fd is not None:
+        fadvise(fd, _POSIX_FADV_SEQUENTIAL, _POSIX_FADV_NOREUSE)
+    return read_buffered(file_obj, read_size)
+
+
+def read_mmap(file_obj, block_size=MMAP_BLOCK_SIZE):
+    """Yields blocks of data sliced from a memory mapping of a file.
+
+    The data starts at file_obj's current position, and file_obj's
+    position is moved to the end of the file.  If file_obj cannot be
+    memory-mapped, this falls back to buffered reads.
+    """
+    fd = _get_fileno(file_obj)
+    mapping = None
+    if fd is not None:
+        try:
+            size = os.fstat(fd).st_size
+            start = file_obj.tell()
+            if start < size:
+                mapping = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            mapping = None
+    if mapping is None:
+        for block in read_buffered(file_obj):
+            yield block
+        return
+    try:
+        file_obj.seek(size)
+        for i in xrange(start, size, block_size):
+            yield mapping[i:i + block_size]
+    finally:
+        mapping.close()
+
+
+_NO_SETTINGS = object()
+_settings = None
+
+def _get_setting(name, default):
+    """Look up a value in the settings, or return default if it is unset."""
+    global _settings
+    if _settings is None:
+        try:
+            from chirp.common import conf as _settings
+        except ImportError:
+            _settings = _NO_SETTINGS
+    return getattr(_settings, name, default)
+
+
+def get_default_reader():
+    """Returns the name of the reader backend set in MP3_READER.
+
+    If there is no settings file, or it does not mention MP3_READER,
+    this returns BUFFERED.
+    """
+    return _get_setting("MP3_READER", BUFFERED)
+
+
+def read_blocks(file_obj, reader=None):
+    """Read a file-like object as a sequence of blocks.
+
+    Args:
+      file_obj: A file-like object.
+      reader: The name of the reader backend to use, one of ALL_READERS.
+        If None, the default from get_default_reader() is used.
+
+    Returns:
+      An iterator over blocks of data.
+
+    Raises:
+      ValueError: if reader is not a known backend.
+    """
+    if reader is None:
+        reader = get_default_reader()
+    if reader == BUFFERED:
+        return read_buffered(file_obj)
+    elif reader == LARGE:
+        return read_large(file_obj, _get_setting("MP3_READER_READ_SIZE",
+                                                 DEFAULT_LARGE_READ_SIZE))
+    elif reader == MMAP:
+        return read_mmap(file_obj)
+    raise ValueError("Unknown reader backend: %r" % (reader,))
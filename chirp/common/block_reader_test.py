@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import cStringIO
+import os
+import tempfile
+import unittest
+
+from chirp.common import block_reader
+from chirp.common import mp3_frame
+
+
+class BlockReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = "".join(chr(i % 251) for i in xrange(3 << 20))
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_readers(self):
+        for reader in block_reader.ALL_READERS:
+            # A real file.
+            f_in = open(self.path, "rb")
+            blocks = list(block_reader.read_blocks(f_in, reader))
+            self.assertEqual(self.data, "".join(blocks))
+            self.assertEqual("", f_in.read())
+            f_in.close()
+            # Starting from the middle of a real file.
+            f_in = open(self.path, "rb")
+            f_in.seek(12345)
+            blocks = list(block_reader.read_blocks(f_in, reader))
+            self.assertEqual(self.data[12345:], "".join(blocks))
+            f_in.close()
+            # Something without a file descriptor.
+            blocks = list(block_reader.read_blocks(
+                    cStringIO.StringIO(self.data), reader))
+            self.assertEqual(self.data, "".join(blocks))
+            # An empty file.
+            f_in = open(os.devnull, "rb")
+            self.assertEqual([], list(block_reader.read_blocks(f_in, reader)))
+            f_in.close()
+
+        self.assertRaises(ValueError, block_reader.read_blocks,
+                          cStringIO.StringIO(self.data), "bogus")
+
+    def test_block_sizes(self):
+        f_in = open(self.path, "rb")
+        blocks = list(block_reader.read_buffered(f_in))
+        self.assertEqual(block_reader.BUFFERED_READ_SIZE, len(blocks[0]))
+        f_in.seek(0)
+        # Read sizes are clamped.
+        blocks = list(block_reader.read_large(f_in, read_size=1))
+        self.assertEqual(block_reader.MIN_LARGE_READ_SIZE, len(blocks[0]))
+        f_in.seek(0)
+        blocks = list(block_reader.read_mmap(f_in, block_size=1 << 20))
+        self.assertEqual(3, len(blocks))
+        f_in.close()
+
+    def test_split(self):
+        data = mp3_frame.dead_air(5000) + "junk" + mp3_frame.dead_air(5000)
+        f_out = open(self.path, "wb")
+        f_out.write(data)
+        f_out.close()
+        expected = list(mp3_frame.split(cStringIO.StringIO(data)))
+        for reader in block_reader.ALL_READERS:
+            f_in = open(self.path, "rb")
+            self.assertEqual(expected, list(mp3_frame.split(f_in,
+                                                            reader=reader)))
+            f_in.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
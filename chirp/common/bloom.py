@@ -0,0 +1,71 @@
+"""
+A simple Bloom filter.
+
+A Bloom filter is a compact, probabilistic representation of a set of
+strings.  Asking whether a string is in the filter never gives a false
+negative, but gives a false positive with a small, tunable probability.
+We use it to skip database lookups for strings (like fingerprints) that
+are almost certainly not in a large table.
+"""
+
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    """A Bloom filter over strings.
+
+    Attributes:
+      capacity: The number of strings the filter was sized for.
+      error_rate: The expected false positive rate once the filter
+        holds 'capacity' strings.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """Constructor.
+
+        Args:
+          capacity: The number of strings we expect to add.  Adding more
+            than this is allowed, but raises the false positive rate.
+          error_rate: The desired false positive rate, between 0 and 1.
+        """
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        # The standard optimal sizes for the bit array and for the
+        # number of hash functions.
+        num_bits = -self.capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self._num_bits = max(8, int(math.ceil(num_bits)))
+        self._num_hashes = max(1, int(round(
+                    math.log(2) * self._num_bits / self.capacity)))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+        self._count = 0
+
+    def __len__(self):
+        """Returns the number of strings that have been added."""
+        return self._count
+
+    def _bit_indexes(self, key):
+        # Derive all of the hash functions from two halves of a single
+        # MD5 digest (the Kirsch-Mitzenmacher construction).
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self._num_bits
+                for i in xrange(self._num_hashes)]
+
+    def add(self, key):
+        """Add a string to the filter."""
+        for i in self._bit_indexes(key):
+            self._bits[i >> 3] |= 1 << (i & 7)
+        self._count += 1
+
+    def __contains__(self, key):
+        """Returns False if key was definitely never added."""
+        bits = self._bits
+        for i in self._bit_indexes(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+import hashlib
+import unittest
+
+from chirp.common import bloom
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_basic(self):
+        keys = [hashlib.sha1(str(i)).hexdigest() for i in xrange(5000)]
+        fp_filter = bloom.BloomFilter(len(keys), error_rate=0.01)
+        for key in keys:
+            fp_filter.add(key)
+        self.assertEqual(len(keys), len(fp_filter))
+        # No false negatives.
+        for key in keys:
+            self.assertTrue(key in fp_filter)
+        self.assertTrue(unicode(keys[0]) in fp_filter)
+        # Few false positives.
+        false_positives = sum(
+            1 for i in xrange(5000, 15000)
+            if hashlib.sha1(str(i)).hexdigest() in fp_filter)
+        self.assertTrue(false_positives < 300, false_positives)
+
+    def test_empty(self):
+        fp_filter = bloom.BloomFilter(0)
+        self.assertFalse("anything" in fp_filter)
+        self.assertRaises(ValueError, bloom.BloomFilter, 10, error_rate=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+"""
+Cheap directory traversal, for use on slow network filesystems.
+
+os.listdir() followed by a stat (os.path.isfile, os.path.isdir, and
+os.walk itself all stat) of every entry costs one round trip per entry
+on our Samba mounts.  This module uses scandir, which gets each entry's
+type from the directory listing itself, so no stat is needed just to
+tell files from directories.  When real stat information is needed, it
+can be fetched for many entries concurrently with stat_entries(), or
+with a StatPool when statting the contents of many directories.
+
+If neither os.scandir nor the scandir module is available, this falls
+back to os.listdir() and stats, which is no slower than before.
+"""
+
+import os
+import stat
+from multiprocessing import pool as mp_pool
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+
+# The number of threads used by stat_entries() by default.
+DEFAULT_STAT_THREADS = 8
+
+
+class _ListdirEntry(object):
+    """A stand-in for scandir's DirEntry, built on os.listdir()."""
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def _get_lstat(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def _test_mode(self, test, follow_symlinks):
+        try:
+            if follow_symlinks:
+                return test(self.stat().st_mode)
+            return test(self._get_lstat().st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        return self._test_mode(stat.S_ISDIR, follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self._test_mode(stat.S_ISREG, follow_symlinks)
+
+    def is_symlink(self):
+        return self._test_mode(stat.S_ISLNK, False)
+
+
+def scan_dir(path):
+    """List the entries in a directory.
+
+    Args:
+      path: The path to a directory.
+
+    Returns:
+      A list of DirEntry-like objects, with name and path attributes
+      and is_dir(), is_file(), is_symlink() and stat() methods, in
+      the same order as os.listdir() would return them.
+
+    Raises:
+      OSError: if the directory cannot be listed.
+    """
+    if _scandir is not None:
+        return list(_scandir(path))
+    return [_ListdirEntry(path, name) for name in os.listdir(path)]
+
+
+def walk(top):
+    """Walk a directory tree from the top down, like os.walk().
+
+    Symbolic links to directories are listed but not followed, and
+    directories that cannot be listed are silently skipped.
+
+    Args:
+      top: The path to the root of the tree.
+
+    Yields:
+      (dirpath, dir_entries, file_entries) tuples.  dir_entries holds
+      the subdirectories of dirpath and file_entries everything else.
+      Like with os.walk(), the caller can modify dir_entries in place to
+      control which subdirectories are visited.
+    """
+    try:
+        entries = scan_dir(top)
+    except OSError:
+        return
+    dir_entries = []
+    file_entries = []
+    for entry in entries:
+        if entry.is_dir():
+            dir_entries.append(entry)
+        else:
+            file_entries.append(entry)
+    yield top, dir_entries, file_entries
+    for entry in dir_entries:
+        if not entry.is_symlink():
+            for x in walk(entry.path):
+                yield x
+
+
+def _stat_one(path):
+    try:
+        return os.stat(path), None
+    except (IOError, OSError), ex:
+        return None, ex
+
+
+class StatPool(object):
+    """A pool of threads for statting many directory entries at once.
+
+    On a network filesystem most of the time spent in a stat is waiting
+    for the server, so issuing the stats from several threads at once
+    is much faster than doing them one at a time.  The threads are
+    started when they are first needed and are reused until close() is
+    called.  StatPool objects can also be used as context managers,
+    which close the pool on exit.  A StatPool should only be used by
+    one thread at a time.
+    """
+
+    def __init__(self, threads=DEFAULT_STAT_THREADS):
+        """Constructor.
+
+        Args:
+          threads: The number of concurrent stats to issue.
+        """
+        self._threads = threads
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stat_entries(self, entries):
+        """Stat many directory entries at once.
+
+        Args:
+          entries: A list of entries, as returned by scan_dir() or walk().
+
+        Returns:
+          A list of (stat_obj, error) pairs, one for each entry.  If the
+          stat succeeded error is None, otherwise stat_obj is None and
+          error is the IOError or OSError that was raised.
+        """
+        paths = [entry.path for entry in entries]
+        if self._threads <= 1 or len(paths) <= 1:
+            return [_stat_one(path) for path in paths]
+        if self._pool is None:
+            self._pool = mp_pool.ThreadPool(self._threads)
+        return self._pool.map(_stat_one, paths)
+
+    def close(self):
+        """Stop the pool's threads.  It is safe to call this more than once."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def stat_entries(entries, threads=DEFAULT_STAT_THREADS):
+    """Stat many directory entries at once, using a temporary StatPool.
+
+    Args:
+      entries: A list of entries, as returned by scan_dir() or walk().
+      threads: The number of concurrent stats to issue.
+
+    Returns:
+      The same as StatPool.stat_entries().
+    """
+    with StatPool(threads) as pool:
+        return pool.stat_entries(entries)
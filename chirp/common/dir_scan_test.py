@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from chirp.common import dir_scan
+
+
+class DirScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        for name in ("a/b/c", "a/d", ".hidden", "e"):
+            os.makedirs(os.path.join(self.test_dir, name))
+        for name in ("f1", "a/f2", "a/b/f3", "a/b/c/f4", "e/.f5"):
+            open(os.path.join(self.test_dir, name), "w").close()
+        os.symlink(os.path.join(self.test_dir, "a"),
+                   os.path.join(self.test_dir, "link"))
+        os.symlink(os.path.join(self.test_dir, "f1"),
+                   os.path.join(self.test_dir, "e/link_f1"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def assert_walk_matches(self, top):
+        expected = [(dirpath, sorted(dirnames), sorted(filenames))
+                    for dirpath, dirnames, filenames in os.walk(top)]
+        actual = [(dirpath,
+                   sorted(e.name for e in dir_entries),
+                   sorted(e.name for e in file_entries))
+                  for dirpath, dir_entries, file_entries in dir_scan.walk(top)]
+        self.assertEqual(expected, actual)
+
+    def test_walk(self):
+        self.assert_walk_matches(self.test_dir)
+        self.assert_walk_matches(os.path.join(self.test_dir, "missing"))
+        # Pruning works like it does with os.walk.
+        dirpaths = []
+        for dirpath, dir_entries, _ in dir_scan.walk(self.test_dir):
+            dirpaths.append(dirpath)
+            dir_entries[:] = [e for e in dir_entries if e.name != "a"]
+        self.assertEqual(
+            sorted([self.test_dir] + [os.path.join(self.test_dir, x)
+                                      for x in (".hidden", "e")]),
+            sorted(dirpaths))
+
+    def test_fallback(self):
+        saved = dir_scan._scandir
+        try:
+            dir_scan._scandir = None
+            self.assert_walk_matches(self.test_dir)
+            entries = dict((e.name, e)
+                           for e in dir_scan.scan_dir(self.test_dir))
+            self.assertTrue(entries["f1"].is_file())
+            self.assertTrue(entries["link"].is_dir())
+            self.assertTrue(entries["link"].is_symlink())
+            self.assertFalse(entries["link"].is_dir(follow_symlinks=False))
+        finally:
+            dir_scan._scandir = saved
+
+    def test_stat_entries(self):
+        entries = dir_scan.scan_dir(self.test_dir)
+        os.unlink(os.path.join(self.test_dir, "f1"))
+        for threads in (1, 4):
+            results = dict(zip((e.name for e in entries),
+                               dir_scan.stat_entries(entries, threads)))
+            stat_obj, ex = results["a"]
+            self.assertEqual(None, ex)
+            self.assertEqual(os.stat(os.path.join(self.test_dir, "a")),
+                             stat_obj)
+            stat_obj, ex = results["f1"]
+            self.assertEqual(None, stat_obj)
+            self.assertTrue(isinstance(ex, OSError))
+
+    def test_stat_pool(self):
+        entries = dir_scan.scan_dir(self.test_dir)
+        expected = [os.stat(e.path) for e in entries]
+        num_threads = threading.active_count()
+        # No threads are left behind by a one-off stat_entries().
+        dir_scan.stat_entries(entries, 4)
+        self.assertEqual(num_threads, threading.active_count())
+        with dir_scan.StatPool(4) as pool:
+            # Nothing is started until it is needed.
+            self.assertEqual(num_threads, threading.active_count())
+            for _ in range(2):
+                self.assertEqual(
+                    expected,
+                    [stat_obj for stat_obj, _ in pool.stat_entries(entries)])
+            self.assertTrue(threading.active_count() > num_threads)
+        self.assertEqual(num_threads, threading.active_count())
+        pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,362 @@
+"""
+A compact, columnar index of the MPEG frames inside an MP3 file.
+
+A FrameTable is built in a single pass over a file.  It holds
+array-backed columns describing every frame (its offset, size, bit
+rate index, padding flag and header key) plus the ranges of non-MPEG junk that
+were found between frames.  Aggregate statistics such as the frame
+count, duration and average bit rate are derived from the columns, and
+the fingerprint of the MPEG payload is computed during the same pass,
+so none of them require re-reading the file.
+
+A FrameTable can be serialized as a small string, which is much
+cheaper to pass between processes, or to keep in the scan cache (see
+chirp.library.scan_cache), than the frames themselves.
+"""
+
+import array
+import hashlib
+import struct
+import sys
+import zlib
+
+from chirp.common import mp3_frame
+from chirp.common import mp3_header
+
+
+# Serialized tables start with this header:
+#   magic, format version, key of the first frame's header, key of the
+#   first mismatched header, fingerprint flag, frame count, junk range
+#   count, index of the first mismatched frame (or -1) and the binary
+#   SHA1 fingerprint.
+_SERIALIZED_MAGIC = "CHFT"
+_SERIALIZED_VERSION = 3
+_SERIALIZED_HEADER = struct.Struct("<4sHHHHIIi20s")
+
+
+def _new_offset_array():
+    return array.array("I")
+
+
+# Maps each shared MP3Header to its key.
+_keys_by_hdr = {}
+
+
+def _get_key(hdr):
+    key = _keys_by_hdr.get(hdr)
+    if key is None:
+        key = mp3_header.to_key(hdr)
+        # Only shared headers can't change underneath us.
+        if hdr._frozen:
+            _keys_by_hdr[hdr] = key
+    return key
+
+
+class FrameTable(object):
+    """An index of the frames inside an MP3 file.
+
+    Attributes:
+      offsets: An array of the byte offset of each frame.
+      sizes: An array of the size of each frame, in bytes.
+      bit_rate_indexes: An array of the raw 4-bit bit rate index of
+        each frame.
+      paddings: An array of flags, 1 if the frame is padded.
+      keys: An array of the key (see mp3_header.to_key) of each
+        frame's header.
+      junk_offsets: An array of the byte offset of each range of
+        non-MPEG junk.
+      junk_sizes: An array of the size of each range of junk, in bytes.
+      first_hdr: The MP3Header of the first frame, or None if no frames
+        were found.
+      mismatch_index: The index of the first frame whose sampling rate
+        or channel mode differs from those of the first frame, or None.
+      mismatch_hdr: The MP3Header of that frame, or None.
+      fingerprint: The fingerprint (as 40 hex digits) of the
+        concatenated frames, or None if it was not computed.
+      total_size: The total number of bytes that were scanned.
+    """
+
+    def __init__(self):
+        self.offsets = _new_offset_array()
+        self.sizes = array.array("H")
+        self.bit_rate_indexes = array.array("B")
+        self.paddings = array.array("B")
+        self.keys = array.array("H")
+        self.junk_offsets = _new_offset_array()
+        self.junk_sizes = _new_offset_array()
+        self.first_hdr = None
+        self.mismatch_index = None
+        self.mismatch_hdr = None
+        self.fingerprint = None
+        self.total_size = 0
+
+    def __eq__(self, other):
+        return (self.offsets == other.offsets
+                and self.sizes == other.sizes
+                and self.bit_rate_indexes == other.bit_rate_indexes
+                and self.paddings == other.paddings
+                and self.keys == other.keys
+                and self.junk_offsets == other.junk_offsets
+                and self.junk_sizes == other.junk_sizes
+                and self.first_hdr is other.first_hdr
+                and self.mismatch_index == other.mismatch_index
+                and self.mismatch_hdr is other.mismatch_hdr
+                and self.fingerprint == other.fingerprint
+                and self.total_size == other.total_size)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def frame_count(self):
+        """The number of MPEG frames."""
+        return len(self.offsets)
+
+    @property
+    def frame_size(self):
+        """The total size of all MPEG frames, in bytes."""
+        return sum(self.sizes)
+
+    @property
+    def duration_ms(self):
+        """The total duration of all MPEG frames, in milliseconds.
+
+        This is a float, and is accumulated frame-by-frame in exactly
+        the same way as in a sequential scan of the file.
+        """
+        duration_ms = 0
+        if self.first_hdr is not None:
+            frame_duration_ms = self.first_hdr.duration_ms
+            for _ in xrange(self.frame_count):
+                duration_ms += frame_duration_ms
+        return duration_ms
+
+    def is_vbr(self):
+        """Returns True if the frames do not all have the same bit rate."""
+        if not self.bit_rate_indexes:
+            return False
+        first = self.bit_rate_indexes[0]
+        return any(x != first for x in self.bit_rate_indexes)
+
+    def average_bit_rate_kbps(self):
+        """Returns the average bit rate, or None if there are no frames."""
+        if not self.frame_count:
+            return None
+        table = mp3_header._BIT_RATE_KBPS_TABLE
+        total = sum(table[x] for x in self.bit_rate_indexes)
+        return float(total) / self.frame_count
+
+    def payload_ranges(self):
+        """Returns the byte ranges that hold MPEG frames.
+
+        Adjacent frames are coalesced into a single range.
+
+        Returns:
+          A list of (offset, size) pairs, in increasing offset order.
+        """
+        ranges = []
+        range_start = range_end = None
+        for offset, size in zip(self.offsets, self.sizes):
+            if offset != range_end:
+                if range_start is not None:
+                    ranges.append((range_start, range_end - range_start))
+                range_start = offset
+            range_end = offset + size
+        if range_start is not None:
+            ranges.append((range_start, range_end - range_start))
+        return ranges
+
+    def _add_frame(self, offset, hdr, size):
+        if self.first_hdr is None:
+            self.first_hdr = hdr
+        elif (self.mismatch_index is None
+              and (hdr.sampling_rate_hz != self.first_hdr.sampling_rate_hz
+                   or hdr.channels != self.first_hdr.channels)):
+            self.mismatch_index = len(self.offsets)
+            self.mismatch_hdr = hdr
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.bit_rate_indexes.append(
+            mp3_header._BIT_RATE_KBPS_TO_RAW[hdr.bit_rate_kbps])
+        self.paddings.append(int(hdr.padding))
+        self.keys.append(_get_key(hdr))
+
+    def extend(self, other, start_index=0):
+        """Append frames from another table to the end of this one.
+
+        Only the frame columns are copied; junk ranges, the mismatch
+        information and the fingerprint of other are ignored.
+
+        Args:
+          other: A FrameTable whose frames all follow this table's.
+          start_index: Skip the frames in other before this index.
+        """
+        if other.frame_count <= start_index:
+            return
+        if self.first_hdr is None:
+            self.first_hdr = mp3_header.from_key(other.keys[start_index])
+        self.offsets.extend(other.offsets[start_index:])
+        self.sizes.extend(other.sizes[start_index:])
+        self.bit_rate_indexes.extend(other.bit_rate_indexes[start_index:])
+        self.paddings.extend(other.paddings[start_index:])
+        self.keys.extend(other.keys[start_index:])
+
+    def _add_junk(self, offset, size):
+        # Coalesce adjacent junk.
+        if (self.junk_offsets
+            and self.junk_offsets[-1] + self.junk_sizes[-1] == offset):
+            self.junk_sizes[-1] += size
+        else:
+            self.junk_offsets.append(offset)
+            self.junk_sizes.append(size)
+
+    def serialize(self):
+        """Encode this table as a compact string.
+
+        Returns:
+          A string that can be passed to deserialize().
+        """
+        columns = [self.offsets, self.sizes, self.bit_rate_indexes,
+                   self.paddings, self.keys, self.junk_offsets,
+                   self.junk_sizes]
+        if sys.byteorder != "little":
+            columns = [array.array(c.typecode, c) for c in columns]
+            for col in columns:
+                col.byteswap()
+        body = zlib.compress("".join(c.tostring() for c in columns))
+        header = _SERIALIZED_HEADER.pack(
+            _SERIALIZED_MAGIC, _SERIALIZED_VERSION,
+            self.first_hdr and mp3_header.to_key(self.first_hdr) or 0,
+            self.mismatch_hdr and mp3_header.to_key(self.mismatch_hdr) or 0,
+            int(self.fingerprint is not None),
+            self.frame_count, len(self.junk_offsets),
+            -1 if self.mismatch_index is None else self.mismatch_index,
+            (self.fingerprint or "0" * 40).decode("hex"))
+        return header + body
+
+
+def deserialize(data):
+    """Decode a string produced by FrameTable.serialize.
+
+    Returns:
+      A FrameTable, or None if the data is not a valid serialized
+      FrameTable.
+    """
+    if len(data) < _SERIALIZED_HEADER.size:
+        return None
+    (magic, version, first_key, mismatch_key, has_fingerprint,
+     frame_count, junk_count, mismatch_index,
+     raw_fingerprint) = _SERIALIZED_HEADER.unpack_from(data)
+    if magic != _SERIALIZED_MAGIC or version != _SERIALIZED_VERSION:
+        return None
+    try:
+        body = zlib.decompress(data[_SERIALIZED_HEADER.size:])
+    except zlib.error:
+        return None
+
+    table = FrameTable()
+    pos = 0
+    for col, count in ((table.offsets, frame_count),
+                       (table.sizes, frame_count),
+                       (table.bit_rate_indexes, frame_count),
+                       (table.paddings, frame_count),
+                       (table.keys, frame_count),
+                       (table.junk_offsets, junk_count),
+                       (table.junk_sizes, junk_count)):
+        size = count * col.itemsize
+        if pos + size > len(body):
+            return None
+        col.fromstring(body[pos:pos + size])
+        if sys.byteorder != "little":
+            col.byteswap()
+        pos += size
+    if pos != len(body):
+        return None
+
+    if frame_count:
+        table.first_hdr = mp3_header.from_key(first_key)
+    if mismatch_index >= 0:
+        table.mismatch_index = mismatch_index
+        table.mismatch_hdr = mp3_header.from_key(mismatch_key)
+    if has_fingerprint:
+        table.fingerprint = raw_fingerprint.encode("hex")
+    if table.offsets:
+        table.total_size = table.offsets[-1] + table.sizes[-1]
+    if table.junk_offsets:
+        table.total_size = max(table.total_size,
+                               table.junk_offsets[-1] + table.junk_sizes[-1])
+    return table
+
+
+def build(file_obj, compute_fingerprint=True, payload_out=None, reader=None):
+    """Build a FrameTable in a single pass over a file.
+
+    Args:
+      file_obj: A file-like object.
+      compute_fingerprint: If False, do not compute a fingerprint.
+      payload_out: An optional file-like object; if given, the
+        concatenated MPEG frames are written to it.
+      reader: The name of the block_reader backend used to read
+        file_obj.  If None, the default backend is used.
+
+    Returns:
+      A FrameTable object.
+    """
+    table = FrameTable()
+    sha1_calc = hashlib.sha1()  # unused if compute_fingerprint is False.
+    offset = 0
+    for hdr, view in mp3_frame.split_views(file_obj, reader=reader):
+        size = len(view)
+        if hdr is None:
+            table._add_junk(offset, size)
+        else:
+            table._add_frame(offset, hdr, size)
+            if compute_fingerprint:
+                sha1_calc.update(view)
+            if payload_out is not None:
+                payload_out.write(view)
+        offset += size
+    table.total_size = offset
+    if compute_fingerprint and table.frame_count:
+        table.fingerprint = sha1_calc.hexdigest()
+    return table
+
+
+def scan_range(file_obj, start, end=None, stop_offsets=None, reader=None):
+    """Build a FrameTable for the frames that begin inside a byte range.
+
+    Scanning starts at an arbitrary offset, so the first few "frames"
+    might just be false syncs inside of a real frame.  It is up to the
+    caller to reconcile the result with a scan of the preceding range.
+
+    Args:
+      file_obj: A seekable file-like object.
+      start: The offset at which to start scanning.
+      end: If set, stop at the first frame that begins at or after
+        this offset.
+      stop_offsets: If set, a collection of offsets; stop at the first
+        frame that begins at one of them.
+      reader: The name of the block_reader backend used to read
+        file_obj.  If None, the default backend is used.
+
+    Returns:
+      A (table, next_offset) pair, where next_offset is the offset of
+      the frame we stopped at, or None if the end of the file was reached.
+      All offsets in the table are measured from the start of file_obj.
+    """
+    file_obj.seek(start)
+    table = FrameTable()
+    offset = start
+    for hdr, view in mp3_frame.split_views(file_obj, reader=reader):
+        size = len(view)
+        if hdr is None:
+            table._add_junk(offset, size)
+        else:
+            if ((end is not None and offset >= end)
+                or (stop_offsets is not None and offset in stop_offsets)):
+                table.total_size = offset
+                return table, offset
+            table._add_frame(offset, hdr, size)
+        offset += size
+    table.total_size = offset
+    return table, None
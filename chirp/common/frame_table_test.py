@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import cStringIO
+import os
+import unittest
+
+from chirp.common import ROOT_DIR
+from chirp.common import frame_table
+from chirp.common import id3_header
+from chirp.common import mp3_frame
+from chirp.common import mp3_header
+
+
+TEST_MP3 = os.path.join(ROOT_DIR, "library/testdata/analyzer_test/test001.mp3")
+
+
+class FrameTableTest(unittest.TestCase):
+
+    def test_build(self):
+        frame = mp3_frame.dead_air(1)
+        data = (id3_header.create_test_header(77).ljust(77, "\0")
+                + frame * 10 + "junk" + "more junk" + frame * 5)
+        payload = cStringIO.StringIO()
+        table = frame_table.build(cStringIO.StringIO(data),
+                                  payload_out=payload)
+        self.assertEqual(15, table.frame_count)
+        self.assertEqual(len(data), table.total_size)
+        frame_size = table.first_hdr.frame_size
+        self.assertEqual(15 * frame_size, table.frame_size)
+        self.assertEqual(frame * 15, payload.getvalue())
+        self.assertEqual(77, table.offsets[0])
+        self.assertFalse(table.is_vbr())
+        self.assertEqual(table.first_hdr.bit_rate_kbps,
+                         table.average_bit_rate_kbps())
+        # The two pieces of junk are coalesced.
+        self.assertEqual([0, 77 + 10 * frame_size], list(table.junk_offsets))
+        self.assertEqual([77, 13], list(table.junk_sizes))
+        self.assertEqual([(77, 10 * frame_size),
+                          (77 + 10 * frame_size + 13, 5 * frame_size)],
+                         table.payload_ranges())
+        self.assertEqual(None, table.mismatch_index)
+
+        empty = frame_table.build(cStringIO.StringIO("junk"))
+        self.assertEqual(0, empty.frame_count)
+        self.assertEqual(None, empty.first_hdr)
+        self.assertEqual(None, empty.fingerprint)
+        self.assertEqual(None, empty.average_bit_rate_kbps())
+        self.assertEqual([], empty.payload_ranges())
+
+    def test_mismatch(self):
+        hdr = mp3_header.parse(mp3_frame.dead_air(1))
+        other = mp3_header.MP3Header(sampling_rate_hz=48000,
+                                     bit_rate_kbps=hdr.bit_rate_kbps,
+                                     channels=hdr.channels,
+                                     protected=hdr.protected,
+                                     padding=False)
+        table = frame_table.FrameTable()
+        table._add_frame(0, hdr, hdr.frame_size)
+        table._add_frame(hdr.frame_size, hdr, hdr.frame_size)
+        table._add_frame(2 * hdr.frame_size, other, other.frame_size)
+        self.assertEqual(2, table.mismatch_index)
+        self.assertTrue(table.mismatch_hdr is other)
+
+    def test_extend(self):
+        hdr = mp3_header.parse(mp3_frame.dead_air(1))
+        # A bogus first frame, with a different bit rate, protection
+        # and channel mode.
+        bogus = mp3_header.from_key(mp3_header.to_key(mp3_header.MP3Header(
+                    sampling_rate_hz=hdr.sampling_rate_hz,
+                    bit_rate_kbps=320, channels=mp3_header.MONO,
+                    protected=not hdr.protected, padding=True)))
+        other = frame_table.FrameTable()
+        other._add_frame(0, bogus, 7)
+        for i in xrange(3):
+            other._add_frame(7 + i * hdr.frame_size, hdr, hdr.frame_size)
+
+        merged = frame_table.FrameTable()
+        merged.extend(other, 1)
+        self.assertTrue(merged.first_hdr is hdr)
+        self.assertEqual(list(other.offsets[1:]), list(merged.offsets))
+        self.assertEqual(list(other.keys[1:]), list(merged.keys))
+        self.assertFalse(merged.is_vbr())
+
+        # Extending a table that already has frames keeps its header.
+        merged.extend(other)
+        self.assertTrue(merged.first_hdr is hdr)
+        self.assertEqual(7, merged.frame_count)
+
+    def test_serialize(self):
+        table = frame_table.build(open(TEST_MP3, "rb"))
+        self.assertTrue(table.is_vbr())
+        data = table.serialize()
+        # The serialized table should be much smaller than the MP3.
+        self.assertTrue(len(data) < table.total_size / 100)
+        self.assertEqual(table, frame_table.deserialize(data))
+        self.assertEqual(None, frame_table.deserialize("garbage"))
+        self.assertEqual(None, frame_table.deserialize(data[:-1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -75,12 +75,14 @@ def parse_size(data, offset=0):
     return None
 
 
-def find_size(data):
+def find_size(data, offset=0):
     """Find the size and offset of the next ID3 frame in a data buffer.
 
     Args:
       data: a buffer containing a slice of an audio file that possibly
         contains an ID3 frame
+      offset: If set, start looking for the ID3 frame at this offset.
+        The returned offset is always measured from the start of data.
     
     Returns:
       A 2-tuple of the form(size, offset).
@@ -88,14 +90,15 @@ def find_size(data):
         offset.  Otherwise a frame of size "size" (in bytes) begins at
         the given offset.
     """
-    i = data.find("ID3")
+    i = data.find("ID3", offset)
     if i == -1:
-        if data.endswith("I"):
-            return None, len(data)-1
-        elif data.endswith("ID"):
-            return None, len(data)-2
+        len_data = len(data)
+        if data.endswith("I") and len_data - 1 >= offset:
+            return None, len_data-1
+        elif data.endswith("ID") and len_data - 2 >= offset:
+            return None, len_data-2
         else:
-            return None, len(data)
+            return None, max(len_data, offset)
     if len(data) < i + 10:
         return None, i
     size = parse_size(data, offset=i)
@@ -97,6 +97,16 @@ class ID3HeaderTest(unittest.TestCase):
         self.assertEqual((test_cooked_size, 3),
                          id3_header.find_size("xIx" + header + padding))
 
+        # Offsets are always measured from the start of the buffer.
+        self.assertEqual((None, 2), id3_header.find_size("xI", offset=2))
+        self.assertEqual((None, 3), id3_header.find_size("xxxID", offset=2))
+        self.assertEqual((None, 5), id3_header.find_size("xxxID", offset=4))
+        self.assertEqual((test_cooked_size, 3),
+                         id3_header.find_size("xIx" + header, offset=1))
+        self.assertEqual((test_cooked_size, len(header) + 3),
+                         id3_header.find_size(header + "xxx" + header,
+                                              offset=1))
+
 
 if __name__ == "__main__":
     unittest.main()
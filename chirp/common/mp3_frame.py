@@ -3,24 +3,28 @@ Convert a stream into a sequence of MPEG audio frames.
 
 """
 
+import sys
+
+from chirp.common import block_reader
 from chirp.common import id3_header
 from chirp.common import mp3_header
 
 
-# The size of the chunks of data we read from file_obj.  The largest
-# possible MP3 frame is 1045 bytes; this value should be larger than
-# that.  Keeping the value low helps performance by minimizing the
-# number of string copies.
-_READ_SIZE = 4 << 10  # 4k
+# When fewer than this many unconsumed bytes remain in our buffer, we
+# pull in the next block.  The largest possible MP3 frame is 1045
+# bytes; this value should be larger than that.
+_READ_SIZE = block_reader.BUFFERED_READ_SIZE
 
 
-def split(file_obj, expected_hdr=None):
+def split(file_obj, expected_hdr=None, reader=None):
     """Extract a sequence of MPEG audio frames from a file-like object.
     
     Args:
       file_obj: A file-like object
       expected_hdr: If given, only yield frames matching this MP3Header
         template
+      reader: The name of the block_reader backend used to read
+        file_obj.  If None, the default backend is used.
 
     Yields:
       A (hdr, data_buffer) pair.
@@ -28,16 +32,17 @@ def split(file_obj, expected_hdr=None):
       was found inside the stream.  Otherwise 'hdr' is an MP3Header object
       and 'data_buffer' contains the MP3 frame.
     """
-    def block_generator():
-        while True:
-            block = file_obj.read(_READ_SIZE)
-            if not block:
-                break
-            yield block
+    return split_blocks(block_reader.read_blocks(file_obj, reader),
+                        expected_hdr=expected_hdr)
+
 
-    for hdr, data_buffer in split_blocks(block_generator(),
-                                         expected_hdr=expected_hdr):
-        yield hdr, data_buffer
+def split_views(file_obj, expected_hdr=None, reader=None):
+    """Like split(), but yields memoryviews instead of copied strings.
+
+    See split_blocks_views() for details.
+    """
+    return split_blocks_views(block_reader.read_blocks(file_obj, reader),
+                              expected_hdr=expected_hdr)
 
 
 def split_blocks(block_iter, expected_hdr=None):
@@ -55,7 +60,38 @@ def split_blocks(block_iter, expected_hdr=None):
       was found inside the stream.  Otherwise 'hdr' is an MP3Header object
       and 'data_buffer' contains the MP3 frame.
     """
+    for hdr, view in split_blocks_views(block_iter, expected_hdr=expected_hdr):
+        yield hdr, view.tobytes()
+
+
+def split_blocks_views(block_iter, expected_hdr=None):
+    """Zero-copy version of split_blocks().
+
+    Rather than slicing a fresh string for every frame, this keeps a
+    read position into the current buffer and hands out memoryviews of
+    it.  Bytes are only copied when the buffer is refilled, and then
+    only the unconsumed tail (which is always shorter than _READ_SIZE)
+    is copied.  Since the underlying buffers are immutable strings, the
+    returned views remain valid after the generator has moved on.
+
+    Args:
+      block_iter: An iterable object that yields a sequence of data
+        blocks.
+      expected_hdr: If given, only yield frames matching this MP3Header
+        template
+
+    Yields:
+      A (hdr, view) pair.
+      If 'hdr' is None, 'view' is a memoryview of non-MPEG-audio junk that
+      was found inside the stream.  Otherwise 'hdr' is an MP3Header object
+      and 'view' is a memoryview of the MP3 frame.
+    """
+    block_iter = iter(block_iter)
     buffered = ''
+    view = memoryview(buffered)
+    # Our position inside of 'buffered'.  Everything before this
+    # offset has already been yielded.
+    pos = 0
     current_hdr = None
     at_end_of_stream = False
     to_be_skipped = 0
@@ -66,7 +102,7 @@ def split_blocks(block_iter, expected_hdr=None):
             assert current_hdr is None
             # If we don't have anything in our buffer, pull in the
             # next block.
-            if not buffered:
+            if pos == len(buffered):
                 try:
                     buffered = block_iter.next()
                 except StopIteration:
@@ -75,26 +111,29 @@ def split_blocks(block_iter, expected_hdr=None):
                         "between frames (probably ID3 headers).\n")
                     at_end_of_stream = True
                     break
+                view = memoryview(buffered)
+                pos = 0
             # If the buffer contains less than the amount of data to
             # be skipped, yield it all and update to_be_skipped.
-            # Otherwise slice the amount to be skipped off of the
+            # Otherwise yield the amount to be skipped off of the
             # front of the buffer.
-            if len(buffered) <= to_be_skipped:
-                yield None, buffered
-                to_be_skipped -= len(buffered)
-                buffered = ''
+            available = len(buffered) - pos
+            if available <= to_be_skipped:
+                yield None, view[pos:]
+                to_be_skipped -= available
+                pos = len(buffered)
             else:
-                yield None, buffered[:to_be_skipped]
-                buffered = buffered[to_be_skipped:]
+                yield None, view[pos:pos + to_be_skipped]
+                pos += to_be_skipped
                 to_be_skipped = 0
 
         # We try to have at least _READ_SIZE bytes of data buffered.
-        if len(buffered) < _READ_SIZE:
-            # To avoid excess string copies, we collect data in a list
-            # until we have the desired amount, then concatenate it all
-            # at the end.
-            buffered_list = [ buffered ]
-            buffered_size = len(buffered)
+        if len(buffered) - pos < _READ_SIZE:
+            # Collect data in a list until we have the desired amount,
+            # then concatenate it all at the end.  Only the unconsumed
+            # tail of the old buffer gets copied.
+            buffered_list = [ buffered[pos:] ]
+            buffered_size = len(buffered) - pos
             while buffered_size < _READ_SIZE:
                 try:
                     next_block = block_iter.next()
@@ -104,39 +143,47 @@ def split_blocks(block_iter, expected_hdr=None):
                 buffered_list.append(next_block)
                 buffered_size += len(next_block)
             buffered = ''.join(buffered_list)
+            view = memoryview(buffered)
+            pos = 0
 
         # Are we at the end of the file?  If so, break out of the
         # "while True:" loop
-        if not buffered:
+        if pos == len(buffered):
             break
 
         # Do we have an MP3 header?  If so, yield the frame and then
-        # slice it off of our buffer.
+        # advance past it.
         if current_hdr:
-            current_frame = buffered[:current_hdr.frame_size]
+            frame_end = pos + current_hdr.frame_size
             # If we found a full-length frame, yield it.  Otherwise
             # return the truncated frame as junk.  (We can be sure not
             # to throw away a valid frame since we buffer at least the
             # next _READ_SIZE bytes, and _READ_SIZE is larger than any
             # possible MP3 frame.
-            if len(current_frame) != current_hdr.frame_size:
+            if frame_end > len(buffered):
                 current_hdr = None
-            yield current_hdr, current_frame
+                frame_end = len(buffered)
+            yield current_hdr, view[pos:frame_end]
             current_hdr = None
-            buffered = buffered[len(current_frame):]
-
-        # Look for the next ID3 header.
-        id3_size, id3_offset = id3_header.find_size(buffered)
+            pos = frame_end
 
         # Look for the next MP3 header.
-        next_hdr, offset = mp3_header.find(buffered, expected_hdr=expected_hdr)
-
-        # If we see an ID3 header before the next MP3 header, skip past the
-        # ID3.  We do this out of paranoia, since an ID3 header might contain
-        # false synch.
-        if id3_size is not None and id3_offset < offset:
-            to_be_skipped = id3_offset + id3_size
-            continue
+        next_hdr, offset = mp3_header.find(buffered, expected_hdr=expected_hdr,
+                                           offset=pos)
+
+        # Look for the next ID3 header.  Only an ID3 header that starts
+        # before the next MP3 header matters, so we never search past it;
+        # this keeps us from rescanning a large buffer once per frame.
+        id3_offset = buffered.find("ID3", pos, offset + 2)
+        if id3_offset != -1:
+            id3_size, id3_offset = id3_header.find_size(buffered,
+                                                        offset=id3_offset)
+            # If we see an ID3 header before the next MP3 header, skip
+            # past the ID3.  We do this out of paranoia, since an ID3
+            # header might contain false synch.
+            if id3_size is not None and id3_offset < offset:
+                to_be_skipped = id3_offset - pos + id3_size
+                continue
         
         # We are starting on this header.
         current_hdr = next_hdr
@@ -144,15 +191,15 @@ def split_blocks(block_iter, expected_hdr=None):
         # If we cannot make any progress and are at the end of the
         # stream, just return what we have buffered as junk and then
         # break out of the loop
-        if (current_hdr, offset) == (None, 0) and at_end_of_stream:
-            if buffered:
-                yield None, buffered
+        if current_hdr is None and offset == pos and at_end_of_stream:
+            if pos < len(buffered):
+                yield None, view[pos:]
             break
 
         # Did we find junk before the next frame?  If so, yield it.
-        if offset > 0:
-            yield None, buffered[:offset]
-            buffered = buffered[offset:]
+        if offset > pos:
+            yield None, view[pos:offset]
+            pos = offset
 
 
 def split_one_block(data, expected_hdr=None):
@@ -58,6 +58,9 @@ class SplitTest(unittest.TestCase):
             split_stream = list(mp3_frame.split(stream))
             split_stream_from_blocks = list(mp3_frame.split_blocks(iter(seq)))
             split_stream_from_one_block = mp3_frame.split_one_block(data)
+            split_stream_from_views = [
+                (view_hdr, view.tobytes())
+                for view_hdr, view in mp3_frame.split_blocks_views(iter(seq))]
             # Make sure that the sequences of header/frame data pairs
             # returned by mp3_frame.split(), mp3_frame.split_blocks()
             # and mp3_frame.split_one_block() matche what we would
@@ -84,6 +87,24 @@ class SplitTest(unittest.TestCase):
                 self.assertEqual(str(hdr1), str(hdr2))
                 self.assertEqual(data1, data2)
 
+            self.assertEqual(len(seq), len(split_stream_from_views))
+            for (hdr1, data1), (hdr2, data2) in zip(
+                split_stream, split_stream_from_views):
+                self.assertEqual(str(hdr1), str(hdr2))
+                self.assertEqual(data1, data2)
+
+    def test_split_views_stay_valid(self):
+        raw_hdr, hdr = mp3_header_test.VALID_MP3_HEADERS.items()[0]
+        frame_data = raw_hdr.ljust(hdr.frame_size, "a")
+        seq = 50 * [ "junk", frame_data ]
+        # Hold on to every view until the whole stream has been split;
+        # the views handed out earlier must not have been clobbered.
+        views = list(mp3_frame.split_views(cStringIO.StringIO(''.join(seq))))
+        self.assertEqual(len(seq), len(views))
+        for expected_data, (actual_hdr, view) in zip(seq, views):
+            self.assertTrue(isinstance(view, memoryview))
+            self.assertEqual(expected_data, view.tobytes())
+
 
 class DeadAirTest(unittest.TestCase):
 
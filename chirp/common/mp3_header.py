@@ -9,6 +9,13 @@ This file is based on information found at:
 
 import struct
 
+# NumPy is optional; without it, find() steps over false syncs one at a
+# time.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Channel codes
 STEREO = 0
 JOINT_STEREO = 1
@@ -39,6 +46,35 @@ _PADDING_TABLE = (False, True)
 # Every MP3 frame contains exactly 1152 samples.
 _SAMPLES_PER_FRAME = 1152
 
+# The top 10 bits of a header are always set; they are the start of
+# the 11-bit frame sync.  The remaining 22 bits are examined below.
+_SYNC_SHIFT = 22
+_SYNC_BITS = 0x3FF
+
+# The 16 bits that follow those 10 sync bits (the last sync bit, the
+# version, the layer, the protection bit, the bit rate, the sampling
+# rate, the padding bit, the private bit and the channel mode) fully
+# determine the header we produce.  The low 6 bits (mode extension,
+# copyright, original and emphasis) are ignored.
+_KEY_SHIFT = 6
+_KEY_MASK = 0xFFFF
+
+# These are the mask and value of a raw header that identify the frame
+# as being part of MPEG version 1 and layer III.
+_MPEG1_LAYER3_MASK = 0xFFFE0000
+_MPEG1_LAYER3_VALUE = 0xFFFA0000
+
+_unpack_from = struct.Struct('>I').unpack_from
+
+# Once find() has stepped over this many false syncs, it assumes that it
+# is inside of junk and, if NumPy is available, switches to checking
+# every candidate sync in bulk.
+_MAX_FALSE_SYNCS = 64
+
+# The size of the first window that the bulk search examines.  Each
+# subsequent window is twice as large.
+_BULK_WINDOW_SIZE = 4096
+
 
 def _match_eq(x, y):
     """Check equality, with None treated as a wildcard."""
@@ -62,8 +98,14 @@ class MP3Header(object):
         milliseconds
 
     In a template for use with the match method, some of the above may be None.
+
+    The headers returned by parse() and find() are shared between all
+    frames with the same header bits, and are immutable; use copy() to
+    get a header that can be modified.
     """
 
+    _frozen = False
+
     def __init__(self, sampling_rate_hz=None, bit_rate_kbps=None,
                  channels=None, protected=None, padding=None):
         self.sampling_rate_hz = sampling_rate_hz
@@ -87,6 +129,23 @@ class MP3Header(object):
         if sampling_rate_hz is not None:
             self.duration_ms = _SAMPLES_PER_FRAME * (1000.0 / sampling_rate_hz)
 
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise AttributeError("Shared MP3Header objects are immutable")
+        object.__setattr__(self, name, value)
+
+    def _freeze(self):
+        object.__setattr__(self, "_frozen", True)
+        return self
+
+    def copy(self):
+        """Returns a new, modifiable MP3Header equal to this one."""
+        return MP3Header(sampling_rate_hz=self.sampling_rate_hz,
+                         bit_rate_kbps=self.bit_rate_kbps,
+                         channels=self.channels,
+                         protected=self.protected,
+                         padding=self.padding)
+
     def is_complete(self):
         """Returns True if this is a fully-specified header."""
         return (self.sampling_rate_hz is not None
@@ -127,28 +186,20 @@ class MP3Header(object):
         return '[MP3Header %s]' % ' '.join(attributes)
 
 
-def parse(data, offset=0):
-    """Extract an MP3 header from the front of a data buffer.
+def _decode_key(key):
+    """Build the MP3Header described by the 16 significant header bits.
 
-    MP3 headers consist of 4 bytes, so this function will always fail
-    (and return None) if 'data' is not at least that long.
- 
     Args:
-      data: A string containing an MP3 frame
-      offset: If set, start looking for the MP3 frame at this offset
+      key: An integer containing bits 6 through 21 of a raw header.
 
     Returns:
-      An MP3Header object, or None if 'data' is not prefixed by a
-      valid header.
+      An MP3Header object, or None if those bits do not describe a
+      valid MPEG version 1 layer III header.
     """
-    if len(data) < offset + 4:
-        return None
-
-    frame_data = struct.unpack_from('>I', data, offset=offset)[0]
-    # 0xff is used as the frame synch byte in MPEG audio.
+    frame_data = (_SYNC_BITS << _SYNC_SHIFT) | (key << _KEY_SHIFT)
     # This particular condition identifies the frame as being part
     # of MPEG version 1 and layer III.
-    if (frame_data >> 16) & 0xFFFE != 0xFFFA:
+    if frame_data & _MPEG1_LAYER3_MASK != _MPEG1_LAYER3_VALUE:
         return None
 
     protected_raw = (frame_data >> 16) & 0x1
@@ -186,7 +237,147 @@ def parse(data, offset=0):
                      channels=channels)
 
 
-def find(data, expected_hdr=None):
+def _build_header_table():
+    """Decode every possible set of significant header bits up front.
+
+    Returns:
+      A list indexed by the 16 significant header bits.  Each entry is
+      either None or a shared, immutable MP3Header.  Keys that differ
+      only in ignored bits map to the same instance.
+    """
+    table = [None] * (_KEY_MASK + 1)
+    interned = {}
+    for key in xrange(_KEY_MASK + 1):
+        hdr = _decode_key(key)
+        if hdr is None:
+            continue
+        attrs = (hdr.protected, hdr.bit_rate_kbps, hdr.sampling_rate_hz,
+                 hdr.padding, hdr.channels)
+        if attrs not in interned:
+            interned[attrs] = hdr._freeze()
+        table[key] = interned[attrs]
+    return table
+
+_HEADER_TABLE = _build_header_table()
+
+
+def parse(data, offset=0):
+    """Extract an MP3 header from the front of a data buffer.
+
+    MP3 headers consist of 4 bytes, so this function will always fail
+    (and return None) if 'data' is not at least that long.
+ 
+    Args:
+      data: A string containing an MP3 frame
+      offset: If set, start looking for the MP3 frame at this offset
+
+    Returns:
+      A shared, immutable MP3Header object, or None if 'data' is not
+      prefixed by a valid header.
+    """
+    if len(data) < offset + 4:
+        return None
+    frame_data = _unpack_from(data, offset)[0]
+    # 0xff is used as the frame synch byte in MPEG audio.
+    if frame_data >> _SYNC_SHIFT != _SYNC_BITS:
+        return None
+    return _HEADER_TABLE[(frame_data >> _KEY_SHIFT) & _KEY_MASK]
+
+
+def from_key(key):
+    """Returns the shared MP3Header for a set of significant header bits.
+
+    Args:
+      key: An integer containing bits 6 through 21 of a raw header, as
+        returned by to_key().
+
+    Returns:
+      A shared, immutable MP3Header object, or None if the key does not
+      describe a valid header.
+    """
+    return _HEADER_TABLE[key]
+
+
+# Maps values of MP3Header attributes back to their raw encodings.
+_PROTECTED_TO_RAW = dict((v, i) for i, v in enumerate(_PROTECTED_TABLE))
+_BIT_RATE_KBPS_TO_RAW = dict(
+    (v, i) for i, v in enumerate(_BIT_RATE_KBPS_TABLE) if v)
+_SAMPLING_RATE_HZ_TO_RAW = dict(
+    (v, i) for i, v in enumerate(_SAMPLING_RATE_HZ_TABLE))
+_PADDING_TO_RAW = dict((v, i) for i, v in enumerate(_PADDING_TABLE))
+_CHANNELS_TO_RAW = dict((v, v) for v in (STEREO, JOINT_STEREO,
+                                         DUAL_MONO, MONO))
+
+# (attribute name, raw value lookup, bit position, bit mask)
+_TEMPLATE_FIELDS = (
+    ("protected", _PROTECTED_TO_RAW, 16, 0x1),
+    ("bit_rate_kbps", _BIT_RATE_KBPS_TO_RAW, 12, 0xF),
+    ("sampling_rate_hz", _SAMPLING_RATE_HZ_TO_RAW, 10, 0x3),
+    ("padding", _PADDING_TO_RAW, 9, 0x1),
+    ("channels", _CHANNELS_TO_RAW, 6, 0x3),
+)
+
+def to_key(hdr):
+    """Encode a complete MP3Header as its 16 significant header bits.
+
+    This is the inverse of from_key().
+
+    Args:
+      hdr: A complete MP3Header object.
+
+    Returns:
+      An integer key.
+
+    Raises:
+      KeyError: if hdr cannot be represented by a raw header.
+    """
+    key = (_MPEG1_LAYER3_VALUE >> _KEY_SHIFT) & _KEY_MASK
+    for name, to_raw, shift, _ in _TEMPLATE_FIELDS:
+        key |= to_raw[getattr(hdr, name)] << (shift - _KEY_SHIFT)
+    return key
+
+
+# A (mask, value) pair that no raw header can ever match.
+_NEVER_MATCHES = (0, 1)
+
+_compiled_templates = {}
+
+
+def compile_template(template):
+    """Compile an MP3Header template into an integer mask/value pair.
+
+    Args:
+      template: An MP3Header object, some of whose attributes may be None.
+
+    Returns:
+      A (mask, value) pair of integers.  A raw 32-bit header word w
+      describes a valid header matching the template if and only if
+      (w & mask) == value and parse() accepts w.
+    """
+    attrs = tuple(getattr(template, name) for name, _, _, _ in
+                  _TEMPLATE_FIELDS)
+    compiled = _compiled_templates.get(attrs)
+    if compiled is not None:
+        return compiled
+    mask = _MPEG1_LAYER3_MASK
+    value = _MPEG1_LAYER3_VALUE
+    for attr, (_, to_raw, shift, bits) in zip(attrs, _TEMPLATE_FIELDS):
+        if attr is None:
+            continue
+        raw = to_raw.get(attr)
+        if raw is None:
+            # No raw header can possibly match this template.
+            compiled = _NEVER_MATCHES
+            break
+        mask |= bits << shift
+        value |= raw << shift
+    else:
+        compiled = (mask, value)
+    _compiled_templates[attrs] = compiled
+    return compiled
+
+
+def find(data, expected_hdr=None, offset=0):
     """Find the next MP3 header in a data buffer.
 
     Args:
@@ -194,6 +385,8 @@ def find(data, expected_hdr=None):
       expected_hdr: an optional template that the returned header
         must match; specifying this can help avoid accidentally finding
         spurious frames inside a corrupted stream
+      offset: If set, start looking for the MP3 header at this offset.
+        The returned offset is always measured from the start of data.
 
     Returns:
       A 2-tuple of the form (hdr, offset).
@@ -201,8 +394,14 @@ def find(data, expected_hdr=None):
         Otherwise hdr is an MP3Header object describing the frame that begins
         at the offset.
     """
-    i = 0
+    if expected_hdr is None:
+        mask, value = _MPEG1_LAYER3_MASK, _MPEG1_LAYER3_VALUE
+    else:
+        mask, value = compile_template(expected_hdr)
+    table = _HEADER_TABLE
+    i = offset
     len_data = len(data)
+    false_syncs = 0
     while i < len_data:
         i = data.find('\xff', i)
         # No frame synch byte found
@@ -211,17 +410,79 @@ def find(data, expected_hdr=None):
         # We found a possible frame, but there is not enough data.
         if i+4 > len_data:
             return None, i
-        # Pull out the header; if it matches the expected header
-        # template, return it.
-        hdr = parse(data, offset=i)
-        if hdr and (expected_hdr is None or hdr.match(expected_hdr)):
-            return hdr, i
+        # Pull out the raw header; if it matches the expected header
+        # template, look up the corresponding MP3Header.  Note that
+        # the mask always covers the 10 leading sync bits.
+        frame_data = _unpack_from(data, i)[0]
+        if frame_data & mask == value:
+            hdr = table[(frame_data >> _KEY_SHIFT) & _KEY_MASK]
+            if hdr is not None:
+                return hdr, i
         # Otherwise this was not actually the beginning of a new frame,
         # so move forward one byte and keep looking.
         i += 1
+        false_syncs += 1
+        if false_syncs == _MAX_FALSE_SYNCS and numpy is not None:
+            return _find_bulk(data, mask, value, i)
     return None, len_data
 
 
+_valid_key_array = None
+
+
+def _get_valid_key_array():
+    """Returns a NumPy array of flags, True for each valid header key."""
+    global _valid_key_array
+    if _valid_key_array is None:
+        _valid_key_array = numpy.array(
+            [hdr is not None for hdr in _HEADER_TABLE], dtype=numpy.bool_)
+    return _valid_key_array
+
+
+def _find_bulk(data, mask, value, offset):
+    """NumPy implementation of find(), for use inside of junk.
+
+    Rather than examining one sync byte at a time, this finds and checks
+    every candidate sync in a window of data at once.  The windows grow
+    geometrically, so a header that follows a little junk is found
+    without examining the rest of the buffer.  The result is identical
+    to that of find().
+    """
+    len_data = len(data)
+    valid_keys = _get_valid_key_array()
+    mask = numpy.uint32(mask)
+    value = numpy.uint32(value)
+    window_size = _BULK_WINDOW_SIZE
+    start = offset
+    while start + 4 <= len_data:
+        end = min(len_data, start + window_size + 3)
+        raw = numpy.frombuffer(data, dtype=numpy.uint8,
+                               count=end - start, offset=start)
+        # Each candidate must be followed by 3 more bytes in the window.
+        candidates = numpy.flatnonzero(raw[:-3] == 0xFF)
+        if len(candidates):
+            words = ((numpy.uint32(0xFF) << 24)
+                     | (raw[candidates + 1].astype(numpy.uint32) << 16)
+                     | (raw[candidates + 2].astype(numpy.uint32) << 8)
+                     | raw[candidates + 3].astype(numpy.uint32))
+            keys = (words >> _KEY_SHIFT) & _KEY_MASK
+            matches = numpy.flatnonzero(((words & mask) == value)
+                                        & valid_keys[keys])
+            if len(matches):
+                first = matches[0]
+                return (_HEADER_TABLE[int(keys[first])],
+                        start + int(candidates[first]))
+        # The last 3 bytes of this window start the next one.
+        start = end - 3
+        window_size *= 2
+    # There is no complete header; like find(), report the first sync
+    # byte whose header is truncated by the end of the data.
+    i = data.find('\xff', max(offset, len_data - 3))
+    if i == -1:
+        return None, len_data
+    return None, i
+
+
 def from_mutagen(mutagen_mp3):
     """Construct a MP3Header from a mutagen.mp3.MP3 object.
 
@@ -4,8 +4,11 @@
 ### A unit test for mp3_header.py
 ###
 
+import random
+import struct
 import unittest
 import sys
+import mock
 import mutagen.mp3
 from chirp.common import mp3_header
 
@@ -63,6 +66,78 @@ class ParseHeaderTest(unittest.TestCase):
         for invalid in INVALID_MP3_HEADERS:
             self.assertTrue(mp3_header.parse(invalid) is None)
 
+    def test_parse_all_headers(self):
+        # Check the precomputed header table against a direct decoding
+        # of every possible set of significant header bits.
+        for key in xrange(1 << 16):
+            frame_data = 0xFFC00000 | (key << 6) | 0x15
+            raw = struct.pack(">I", frame_data)
+            hdr = mp3_header.parse(raw)
+            if ((frame_data >> 16) & 0xFFFE != 0xFFFA
+                or (frame_data >> 12) & 0xF in (0, 0xF)
+                or (frame_data >> 10) & 0x3 == 3):
+                self.assertTrue(hdr is None)
+                continue
+            self.assertTrue(hdr is not None)
+            self.assertTrue(hdr.is_complete())
+            self.assertEqual(not (frame_data >> 16) & 0x1, hdr.protected)
+            self.assertEqual(
+                mp3_header._BIT_RATE_KBPS_TABLE[(frame_data >> 12) & 0xF],
+                hdr.bit_rate_kbps)
+            self.assertEqual(
+                mp3_header._SAMPLING_RATE_HZ_TABLE[(frame_data >> 10) & 0x3],
+                hdr.sampling_rate_hz)
+            self.assertEqual(bool((frame_data >> 9) & 0x1), hdr.padding)
+            self.assertEqual((frame_data >> 6) & 0x3, hdr.channels)
+            self.assertTrue(hdr is mp3_header.from_key(
+                    mp3_header.to_key(hdr)))
+            self.assertTrue(hdr is mp3_header.from_key(
+                    mp3_header.to_key(hdr.copy())))
+            # The private bit is ignored, so both values share a header.
+            self.assertTrue(
+                hdr is mp3_header.parse(struct.pack(">I",
+                                                    frame_data ^ (1 << 8))))
+        # The leading sync bits must all be set.
+        self.assertTrue(mp3_header.parse('\xfe\xfb\x90\x64') is None)
+        self.assertTrue(mp3_header.parse('\xff\x7b\x90\x64') is None)
+
+    def test_shared_headers_are_immutable(self):
+        raw_hdr, expected_hdr = VALID_MP3_HEADERS.items()[0]
+        hdr = mp3_header.parse(raw_hdr)
+        self.assertTrue(hdr is mp3_header.parse(raw_hdr))
+        self.assertRaises(AttributeError, setattr, hdr, "padding", None)
+        hdr_copy = hdr.copy()
+        self.assertTrue(hdr_copy is not hdr)
+        self.assertEqual(str(hdr), str(hdr_copy))
+        self.assertEqual(hdr.frame_size, hdr_copy.frame_size)
+        hdr_copy.padding = None
+        self.assertEqual(expected_hdr.padding, hdr.padding)
+
+    def test_compile_template(self):
+        for raw_hdr, hdr in VALID_MP3_HEADERS.items():
+            frame_data = struct.unpack(">I", raw_hdr)[0]
+            for template in (
+                mp3_header.MP3Header(),
+                mp3_header.MP3Header(sampling_rate_hz=44100),
+                mp3_header.MP3Header(sampling_rate_hz=48000),
+                mp3_header.MP3Header(bit_rate_kbps=192),
+                mp3_header.MP3Header(bit_rate_kbps=192.0, padding=True),
+                mp3_header.MP3Header(bit_rate_kbps=123.456),
+                mp3_header.MP3Header(channels=mp3_header.STEREO,
+                                     protected=False),
+                mp3_header.MP3Header(protected=True),
+                ):
+                mask, value = mp3_header.compile_template(template)
+                self.assertEqual(hdr.match(template),
+                                 frame_data & mask == value)
+                found_hdr, offset = mp3_header.find(
+                    raw_hdr, expected_hdr=template)
+                if hdr.match(template):
+                    self.assertEqual(0, offset)
+                    self.assertTrue(found_hdr.match(hdr))
+                else:
+                    self.assertEqual((None, len(raw_hdr)), (found_hdr, offset))
+
     def test_match(self):
         a = mp3_header.MP3Header(sampling_rate_hz=44100,
                                  bit_rate_kbps=128)
@@ -95,6 +170,39 @@ class ParseHeaderTest(unittest.TestCase):
                 self.assertTrue(found_hdr is not None)
                 self.assertTrue(hdr.match(found_hdr))
 
+                # Searching from a non-zero offset returns offsets
+                # relative to the start of the buffer.
+                found_hdr, offset = mp3_header.find(
+                    raw_hdr + 'xx' + test_data, offset=1)
+                self.assertEqual(len(raw_hdr) + 2 + test_data.find(raw_hdr),
+                                 offset)
+                self.assertTrue(hdr.match(found_hdr))
+
+    def test_find__in_junk(self):
+        rand = random.Random(12345)
+        chunks = list(VALID_MP3_HEADERS) + [
+            "junk", "\xff" * 100, "\xff\xfb", "\xff\xff\xfb\x90"]
+        templates = (None, mp3_header.MP3Header(padding=True))
+        for _ in xrange(200):
+            data = "".join(rand.choice(chunks)
+                           for _ in xrange(rand.randint(0, 20)))
+            offset = rand.randint(0, len(data))
+            for template in templates:
+                # Search one sync at a time...
+                with mock.patch.object(mp3_header, "numpy", None):
+                    expected = mp3_header.find(data, expected_hdr=template,
+                                               offset=offset)
+                # ...and then in bulk, with windows small enough that
+                # most searches span several of them.
+                if mp3_header.numpy is not None:
+                    with mock.patch.multiple(mp3_header,
+                                             _MAX_FALSE_SYNCS=2,
+                                             _BULK_WINDOW_SIZE=8):
+                        self.assertEqual(
+                            expected,
+                            mp3_header.find(data, expected_hdr=template,
+                                            offset=offset))
+
     def test_from_mutagen(self):
         mp3 = mutagen.mp3.MP3()
 
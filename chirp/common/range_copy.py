@@ -0,0 +1,202 @@
+"""
+Copy byte ranges from one file to another without a trip through Python.
+
+When importing into the library we need to copy the MPEG frames of a
+file, which are a few large contiguous ranges of the source file, onto
+the end of a newly-written ID3 tag.  Reading those ranges into a string
+and writing it back out costs a full in-memory copy of every track.
+Instead, this module asks the kernel to do the copying, using one of:
+
+  "copy_file_range": Copies entirely inside the kernel, and on some
+    filesystems (including NFS and SMB) without moving the data
+    through the client at all.  Requires Linux 4.5 or later.
+  "sendfile": Copies inside the kernel via the page cache.
+  "chunked": Plain reads and writes of 1MB chunks.  This always works.
+
+copy_ranges() starts with the best method available and falls back to
+the next one whenever the kernel says that a method is not supported
+for the pair of files involved (for example, copy_file_range across
+two different filesystems on older kernels).
+
+The SHA1 of the copied data is computed along the way.  For the kernel
+methods the source is memory-mapped and hashed straight from the page
+cache, which the copy has just filled.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import mmap
+import os
+import sys
+
+
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+CHUNKED = "chunked"
+
+ALL_METHODS = (COPY_FILE_RANGE, SENDFILE, CHUNKED)
+
+# The size of the reads and writes used by the chunked method.  This
+# is also the most we ask the kernel to copy in a single call.
+CHUNK_SIZE = 1 << 20  # 1MB
+
+# If the kernel returns one of these, the method cannot be used to copy
+# between the files in question and we should fall back to another.
+_UNSUPPORTED_ERRNOS = frozenset([
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.EBADF, errno.ETXTBSY, errno.EPERM])
+
+
+class _Unsupported(Exception):
+    """Raised when a copy method cannot be used."""
+
+
+def _find_libc_function(name, argtypes):
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = argtypes
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_copy_file_range = _find_libc_function(
+    "copy_file_range",
+    [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint])
+
+_sendfile = _find_libc_function(
+    "sendfile64",
+    [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+     ctypes.c_size_t])
+
+
+def available_methods():
+    """Returns the copy methods that might work on this system, best first."""
+    methods = []
+    if _copy_file_range is not None:
+        methods.append(COPY_FILE_RANGE)
+    if _sendfile is not None:
+        methods.append(SENDFILE)
+    methods.append(CHUNKED)
+    return methods
+
+
+def _call_kernel(method, src_fd, dst_fd, offset, length):
+    """Copy up to length bytes starting at offset in a single call.
+
+    The source's file position is not used or changed; the data is
+    written at, and advances, the destination's file position.
+
+    Returns:
+      The number of bytes copied, which is 0 at the end of the source.
+
+    Raises:
+      _Unsupported: if the kernel refuses to use this method.
+      OSError: on a real I/O error.
+    """
+    c_offset = ctypes.c_int64(offset)
+    while True:
+        if method == COPY_FILE_RANGE:
+            copied = _copy_file_range(src_fd, ctypes.byref(c_offset), dst_fd,
+                                      None, length, 0)
+        else:
+            copied = _sendfile(dst_fd, src_fd, ctypes.byref(c_offset), length)
+        if copied >= 0:
+            return copied
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+        if err in _UNSUPPORTED_ERRNOS:
+            raise _Unsupported(err)
+        raise OSError(err, os.strerror(err))
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _copy_chunked(src_fd, dst_fd, offset, length, hasher):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        chunk = os.read(src_fd, min(CHUNK_SIZE, length - copied))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        _write_all(dst_fd, chunk)
+        copied += len(chunk)
+    return copied
+
+
+def copy_ranges(src_path, ranges, dst_path, methods=None):
+    """Append byte ranges of one file onto the end of another.
+
+    Args:
+      src_path: The path of the file to copy from.
+      ranges: A sequence of (offset, size) pairs, in the source file.
+      dst_path: The path of an existing file to append the data to.
+      methods: The copy methods to try, in order.  If None, every
+        method available on this system is tried, best first.
+
+    Returns:
+      A (method, sha1) pair.  method is the last method that was used,
+      and sha1 is the SHA1 of all of the copied data, as 40 hex digits.
+
+    Raises:
+      IOError: if the source file is shorter than the ranges imply.
+      OSError: if the files cannot be opened, read or written.
+    """
+    if methods is None:
+        methods = available_methods()
+    methods = [m for m in methods if m in available_methods()]
+    if CHUNKED not in methods:
+        methods.append(CHUNKED)
+    hasher = hashlib.sha1()
+    src_fd = os.open(src_path, os.O_RDONLY)
+    src_map = None
+    try:
+        # O_APPEND is not allowed with copy_file_range, so we position
+        # ourselves at the end of the destination by hand.
+        dst_fd = os.open(dst_path, os.O_WRONLY)
+        try:
+            os.lseek(dst_fd, 0, os.SEEK_END)
+            for offset, size in ranges:
+                end = offset + size
+                while offset < end:
+                    method = methods[0]
+                    if method == CHUNKED:
+                        copied = _copy_chunked(src_fd, dst_fd, offset,
+                                               end - offset, hasher)
+                    else:
+                        try:
+                            copied = _call_kernel(
+                                method, src_fd, dst_fd, offset,
+                                min(CHUNK_SIZE, end - offset))
+                        except _Unsupported:
+                            methods.pop(0)
+                            continue
+                        if copied > 0:
+                            if src_map is None:
+                                src_map = mmap.mmap(src_fd, 0,
+                                                    access=mmap.ACCESS_READ)
+                            hasher.update(buffer(src_map, offset, copied))
+                    if copied == 0:
+                        raise IOError("%s ended at byte %d, expected %d"
+                                      % (src_path, offset, end))
+                    offset += copied
+        finally:
+            os.close(dst_fd)
+    finally:
+        if src_map is not None:
+            src_map.close()
+        os.close(src_fd)
+    return methods[0], hasher.hexdigest()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from chirp.common import range_copy
+
+
+class RangeCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.data = "".join(chr(i % 251) for i in xrange(3 << 20))
+        self.src_path = os.path.join(self.test_dir, "src")
+        out = open(self.src_path, "wb")
+        out.write(self.data)
+        out.close()
+        self.dst_path = os.path.join(self.test_dir, "dst")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_copy_ranges(self):
+        ranges = [(10, 100), (1000, (2 << 20) + 17), (len(self.data) - 5, 5)]
+        expected = "".join(self.data[offset:offset + size]
+                           for offset, size in ranges)
+        for method in range_copy.available_methods():
+            out = open(self.dst_path, "wb")
+            out.write("header")
+            out.close()
+            used, sha1 = range_copy.copy_ranges(self.src_path, ranges,
+                                                self.dst_path,
+                                                methods=[method])
+            self.assertEqual(method, used)
+            self.assertEqual(hashlib.sha1(expected).hexdigest(), sha1)
+            self.assertEqual("header" + expected,
+                             open(self.dst_path, "rb").read())
+
+    def test_short_source(self):
+        open(self.dst_path, "wb").close()
+        for method in range_copy.available_methods():
+            self.assertRaises(IOError, range_copy.copy_ranges,
+                              self.src_path, [(len(self.data) - 10, 20)],
+                              self.dst_path, methods=[method])
+
+    def test_fallback(self):
+        open(self.dst_path, "wb").close()
+        def unsupported(*args):
+            raise range_copy._Unsupported()
+        with mock.patch.object(range_copy, "_call_kernel", unsupported):
+            used, sha1 = range_copy.copy_ranges(self.src_path, [(0, 1000)],
+                                                self.dst_path)
+        self.assertEqual(range_copy.CHUNKED, used)
+        self.assertEqual(hashlib.sha1(self.data[:1000]).hexdigest(), sha1)
+        self.assertEqual(self.data[:1000], open(self.dst_path, "rb").read())
+
+
+if __name__ == "__main__":
+    unittest.main()
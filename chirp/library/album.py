@@ -2,13 +2,18 @@
 Code for dealing with albums.  Albums are collections of related AudioFiles.
 """
 
+import collections
+import copy
 import hashlib
-import os
+import multiprocessing
+import sys
+from chirp.common import dir_scan
 from chirp.library import artists
 from chirp.library import audio_file
 from chirp.library import constants
 from chirp.library import import_file
 from chirp.library import order
+from chirp.library import scan_cache
 from chirp.library import titles
 from chirp.library import ufid
 
@@ -125,8 +130,16 @@ def _standardize_tags(all_au_files, new_album_name=None):
 
 class Album(object):
     
-    def __init__(self, all_au_files):
+    def __init__(self, all_au_files, spool=None):
+        """Constructor.
+
+        Args:
+          all_au_files: The AudioFile objects for the album's tracks.
+          spool: An optional payload_spool.PayloadSpool.  If given, it
+            controls the payloads of the album's tracks.
+        """
         self.all_au_files = list(all_au_files)
+        self._spool = spool
         # Compute the album ID.
         self.album_id = _compute_album_id(self.all_au_files)
         if self.album_id is not None:
@@ -165,7 +178,10 @@ class Album(object):
 
     def drop_payloads(self):
         for au in self.all_au_files:
-            au.payload = None
+            if self._spool is not None:
+                self._spool.release(au)
+            else:
+                au.payload = None
 
     def ensure_payloads(self):
         for au in self.all_au_files:
@@ -173,6 +189,8 @@ class Album(object):
                 new_au = audio_file.scan(au.path)
                 assert new_au.fingerprint == au.fingerprint
                 au.payload = new_au.payload
+                if self._spool is not None:
+                    self._spool.add(au)
 
     def title(self):
         """Returns the album's title."""
@@ -229,7 +247,104 @@ class Album(object):
         return prefix + suffix
         
 
-def from_directory(dirpath, fast=False):
+# When standardizing in a process pool, allow this many albums per
+# worker to be in flight at once.
+_MAX_PENDING_PER_WORKER = 2
+
+
+def _standardize_album(all_au_files, new_album_name):
+    """Standardize a single album.  This might run in a worker process.
+
+    Returns:
+      An (all_au_files, error) pair.  If standardization succeeded,
+      all_au_files holds the standardized files (in the order they were
+      given) and error is None.  Otherwise all_au_files is None and
+      error is the ImportFileError or AlbumError that was raised.
+    """
+    try:
+        Album(all_au_files).standardize(new_album_name)
+    except (import_file.ImportFileError, AlbumError), ex:
+        return None, ex
+    return all_au_files, None
+
+
+def _standardize_in_pool(albums, workers, new_album_name):
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    max_pending = workers * _MAX_PENDING_PER_WORKER
+
+    def finish(alb, sent_au_files, async_result):
+        std_au_files, error = async_result.get()
+        if error is None:
+            # Copy the standardized tags back onto the original files,
+            # rather than replacing them: they hold the payloads (which
+            # we never send to the workers), and a payload spool keeps
+            # track of them.
+            for au, std_au in zip(sent_au_files, std_au_files):
+                au.mutagen_id3 = std_au.mutagen_id3
+                au.album_id = std_au.album_id
+            alb._sort()
+            alb._tpe1_breakdown = None
+        return alb, error
+
+    try:
+        try:
+            for alb in albums:
+                sent_au_files = list(alb.all_au_files)
+                au_copies = []
+                for au in sent_au_files:
+                    au = copy.copy(au)
+                    au.payload = None
+                    au_copies.append(au)
+                pending.append((alb, sent_au_files, pool.apply_async(
+                            _standardize_album, (au_copies, new_album_name))))
+                while len(pending) >= max_pending:
+                    yield finish(*pending.popleft())
+        except Exception:
+            # Report on the albums we already have before passing along
+            # the error, just as if we had been working one at a time.
+            exc_info = sys.exc_info()
+            while pending:
+                yield finish(*pending.popleft())
+            raise exc_info[0], exc_info[1], exc_info[2]
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def standardize_albums(albums, workers=1, new_album_name=None):
+    """Standardize a sequence of albums, possibly in parallel.
+
+    Args:
+      albums: An iterable of Album objects.
+      workers: The number of processes used to standardize albums.  If
+        greater than 1, the albums are standardized in a process pool,
+        several at a time.
+      new_album_name: Passed along to Album.standardize.
+
+    Yields:
+      (alb, error) pairs, in the same order as the albums were given.
+      If the album was successfully standardized, error is None and the
+      album object has been updated.  Otherwise error is the
+      ImportFileError or AlbumError that was raised.
+    """
+    if workers > 1:
+        for result in _standardize_in_pool(albums, workers, new_album_name):
+            yield result
+        return
+    for alb in albums:
+        try:
+            alb.standardize(new_album_name)
+        except (import_file.ImportFileError, AlbumError), ex:
+            yield alb, ex
+        else:
+            yield alb, None
+
+
+def from_directory(dirpath, fast=False, cache=None, get_payload=False,
+                   spool=None):
     """Creates Album objects from the files in a directory.
 
     Found audio files are grouped into albums based on their TALB tags.
@@ -238,15 +353,22 @@ def from_directory(dirpath, fast=False):
     Args:
       dirpath: The path to the directory to scan for audio files.
       fast: If True, do a fast scan when analyzing the audio files.
+      cache: An optional scan_cache.ScanCache.  Files found in the
+        cache will not have their payloads set.
+      get_payload: If True, keep the MPEG frames of each file in its
+        'payload' field.  Has no effect on fast scans.
+      spool: An optional payload_spool.PayloadSpool.  If given, the
+        payloads are kept under its memory budget.
 
     Returns:
       A list of Album objects.
     """
     by_talb = {}
-    for basename in os.listdir(dirpath):
-        file_path = os.path.join(dirpath, basename)
+    for entry in dir_scan.scan_dir(dirpath):
+        basename = entry.name
+        file_path = entry.path
         # Skip anything that isn't a regular file.
-        if not os.path.isfile(file_path):
+        if not entry.is_file():
             continue
         # Skip dotfiles
         if basename.startswith("."):
@@ -254,17 +376,18 @@ def from_directory(dirpath, fast=False):
         # Must have mp3 as the extension.
         if not basename.lower().endswith(".mp3"):
             continue
-        if fast:
-            au_file = audio_file.scan_fast(file_path)
-        else:
-            au_file = audio_file.scan(file_path)
+        au_file = scan_cache.scan(file_path, cache, fast=fast,
+                                  get_payload=get_payload)
         # Silently skip anything that seems bogus.
         if not au_file:
             continue
+        if spool is not None:
+            spool.add(au_file)
         if not "TALB" in au_file.mutagen_id3:
             raise AlbumError("Missing TALB tag on %s" % file_path)
         talb = au_file.mutagen_id3["TALB"].text[0]
         by_talb.setdefault(talb, []).append(au_file)
 
-    return [Album(all_au_files) for all_au_files in by_talb.values()]
+    return [Album(all_au_files, spool=spool)
+            for all_au_files in by_talb.values()]
             
@@ -1,10 +1,18 @@
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import mutagen.id3
 
+from chirp.common import ROOT_DIR
 from chirp.library import album
 from chirp.library import audio_file
+from chirp.library import payload_spool
+
+
+TEST_MP3 = os.path.join(ROOT_DIR, "library/testdata/analyzer_test/test001.mp3")
 
 
 class AlbumTest(unittest.TestCase):
@@ -61,6 +69,119 @@ class AlbumTest(unittest.TestCase):
         self.assertRaises(album.AlbumError,
                           album._standardize_tags, test_alb)
 
+    def test_standardize_albums(self):
+        def make_albums(spool=None):
+            albums = []
+            for n in range(1, 6):
+                all_au_files = self.create_test_album(n)
+                for au_file in all_au_files:
+                    au_file.fingerprint = "%038x%02d" % (n, int(
+                            au_file.fingerprint, 16))
+                    au_file.duration_ms = 1000
+                    au_file.frame_count = 10
+                    au_file.frame_size = 100
+                    au_file.path = au_file.fingerprint
+                    au_file.payload = "payload %s" % au_file.path
+                alb = album.Album(all_au_files, spool=spool)
+                if spool is not None:
+                    for au_file in all_au_files:
+                        spool.add(au_file)
+                alb.set_volume_and_import_timestamp(0xff, 1230000000)
+                albums.append(alb)
+            # Break the third album.
+            albums[2].all_au_files[0].mutagen_id3["TALB"].text = ["Other"]
+            return albums
+
+        serial = list(album.standardize_albums(make_albums()))
+        spool = payload_spool.PayloadSpool()
+        albums = make_albums(spool)
+        originals = [list(alb.all_au_files) for alb in albums]
+        parallel = list(album.standardize_albums(albums, workers=2))
+        self.assertEqual(5, len(parallel))
+        for (serial_alb, serial_error), (alb, error) in zip(serial, parallel):
+            self.assertEqual(serial_alb.album_id, alb.album_id)
+            self.assertEqual(type(serial_error), type(error))
+            self.assertEqual(str(serial_error), str(error))
+            if error is None:
+                self.assertEqual(
+                    [sorted(map(repr, x.mutagen_id3.values()))
+                     for x in serial_alb.all_au_files],
+                    [sorted(map(repr, x.mutagen_id3.values()))
+                     for x in alb.all_au_files])
+                for au_file in alb.all_au_files:
+                    self.assertEqual("payload %s" % au_file.path,
+                                     au_file.payload)
+        self.assertTrue(isinstance(parallel[2][1], album.AlbumError))
+        # The albums still hold the original AudioFile objects, so the
+        # spool can release their payloads.
+        for (alb, _), all_au_files in zip(parallel, originals):
+            self.assertEqual(sorted(map(id, all_au_files)),
+                             sorted(map(id, alb.all_au_files)))
+            alb.drop_payloads()
+        self.assertEqual(0, spool.in_memory_bytes)
+
+        # Errors from building the album in the worker are returned too.
+        all_au_files = make_albums()[0].all_au_files
+        all_au_files[0].album_id += 1
+        std_au_files, error = album._standardize_album(all_au_files, None)
+        self.assertEqual(None, std_au_files)
+        self.assertTrue(isinstance(error, album.AlbumError))
+
+        # Errors from the source of the albums are passed along, after
+        # the albums that came before them.
+        def broken_albums():
+            for alb in make_albums()[:3]:
+                yield alb
+            raise ValueError("broken")
+        results = []
+        try:
+            for result in album.standardize_albums(broken_albums(),
+                                                   workers=2):
+                results.append(result)
+        except ValueError:
+            pass
+        else:
+            self.fail("ValueError not raised")
+        self.assertEqual(3, len(results))
+
+    def test_from_directory_payloads(self):
+        test_dir = tempfile.mkdtemp()
+        try:
+            for i in range(1, 4):
+                path = os.path.join(test_dir, "%d.mp3" % i)
+                shutil.copy(TEST_MP3, path)
+                id3 = mutagen.id3.ID3(path)
+                id3.add(mutagen.id3.TALB(text=["Album"], encoding=3))
+                id3.add(mutagen.id3.TRCK(text=["%d/3" % i], encoding=3))
+                id3.save()
+
+            # By default, no payloads are kept.
+            albums = album.from_directory(test_dir)
+            self.assertEqual(1, len(albums))
+            self.assertEqual(3, len(albums[0].all_au_files))
+            for au_file in albums[0].all_au_files:
+                self.assertEqual(None, au_file.payload)
+
+            # With a small budget, all but the newest payload is spilled.
+            payload_size = albums[0].all_au_files[0].frame_size
+            spool = payload_spool.PayloadSpool(budget_bytes=payload_size)
+            albums = album.from_directory(test_dir, get_payload=True,
+                                          spool=spool)
+            alb = albums[0]
+            self.assertEqual(payload_size, spool.in_memory_bytes)
+            self.assertEqual(2 * payload_size, spool.spilled_bytes)
+            for au_file in alb.all_au_files:
+                self.assertEqual(payload_size, len(au_file.payload))
+            alb.drop_payloads()
+            self.assertEqual(0, spool.in_memory_bytes)
+            self.assertEqual(0, spool.spilled_bytes)
+            alb.ensure_payloads()
+            self.assertEqual(payload_size, spool.in_memory_bytes)
+            self.assertEqual(2 * payload_size, spool.spilled_bytes)
+            spool.close()
+        finally:
+            shutil.rmtree(test_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
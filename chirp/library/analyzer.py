@@ -2,8 +2,9 @@
 
 import cStringIO
 import hashlib
+import multiprocessing
 import os
-from chirp.common import mp3_frame
+from chirp.common import frame_table
 
 
 # Files with fewer than this many MPEG frames will be rejected as
@@ -13,6 +14,14 @@ _MINIMUM_FRAMES = 100
 _MINIMUM_REASONABLE_FILE_SIZE = 100<<10  # Files should be larger than 100k...
 _MAXIMUM_REASONABLE_FILE_SIZE = 20<<20   # ...and smaller than 20MB.
 
+# analyze_parallel() gives each worker a range of at least this many
+# bytes; smaller files are analyzed sequentially.
+_MINIMUM_CHUNK_SIZE = 8<<20  # 8MB
+
+# The size of the reads used to fingerprint the payload of a file
+# analyzed by analyze_parallel().
+_HASH_READ_SIZE = 1<<20  # 1MB
+
 
 class InvalidFileError(Exception):
     """Raised when a file appears to be invalid or somehow corrupted."""
@@ -20,13 +29,17 @@ class InvalidFileError(Exception):
 
 # TODO(trow): Some of the validity checks in this function might be
 # too strict.
-def analyze(file_obj, au_file, compute_fingerprint=True, get_payload=True):
+def analyze(file_obj, au_file, compute_fingerprint=True, get_payload=True,
+            reader=None):
     """Populate an AudioFile object with information extracted from a file.
 
     Args:
       file_obj: A file-like object.
       au_file: An AudioFile object to store the results of the analysis in.
       compute_fingerprint: If False, do not compute a fingerprint.
+      get_payload: If False, do not store the MPEG frames in au_file.
+      reader: The name of the block_reader backend used to read
+        file_obj.  If None, the default backend is used.
 
     Returns:
       The same AudioFile object that was passed in as au_file, which
@@ -35,80 +48,197 @@ def analyze(file_obj, au_file, compute_fingerprint=True, get_payload=True):
     Raises:
       InvalidFileError: if the file appears to be corrupted.
     """
-    au_file.frame_count = 0
-    au_file.frame_size = 0
-    au_file.duration_ms = 0
-    sha1_calc = hashlib.sha1()  # unused if compute_fingerprint is False.
     payload = cStringIO.StringIO()  # unused if get_payload is False.
+    table = frame_table.build(file_obj,
+                              compute_fingerprint=compute_fingerprint,
+                              payload_out=(payload if get_payload else None),
+                              reader=reader)
+    populate(au_file, table)
+    if get_payload:
+        au_file.payload = payload.getvalue()
+    return au_file
 
-    bit_rate_kbps_sum = 0
-    expected_hdr = None
-    first_bit_rate_kbps = None
-    is_vbr = False
 
-    for hdr, data_buffer in mp3_frame.split(file_obj):
-        if hdr is None:
-            continue
+def populate(au_file, table):
+    """Populate an AudioFile object from a FrameTable.
 
-        au_file.frame_count += 1
-        au_file.frame_size += len(data_buffer)
-        au_file.duration_ms += hdr.duration_ms
-        if compute_fingerprint:
-            sha1_calc.update(data_buffer)
-        if get_payload:
-            payload.write(data_buffer)
-
-        # If we've seen a valid header previously, make sure that all of the
-        # fields that should match do actually match.
-        if expected_hdr:
-            if not hdr.match(expected_hdr):
-                raise InvalidFileError(
-                    "Bad header: found %s, expected %s (path=%s)" % (
-                        hdr, expected_hdr, au_file.path))
-            # Keep track of if this is a variable bit-rate file.
-            if hdr.bit_rate_kbps != first_bit_rate_kbps:
-                is_vbr = True
-
-        # Add this frame's bit rate to our sum; we will use this to compute
-        # the average bit rate.
-        bit_rate_kbps_sum += hdr.bit_rate_kbps
-
-        # If this is the first header we've seen, make a copy and then blank
-        # out the fields that can vary.  All future headers are expected to
-        # match this template.
-        if expected_hdr is None:
-            expected_hdr = hdr
-            first_bit_rate_kbps = expected_hdr.bit_rate_kbps
-            expected_hdr.bit_rate_kbps = None  # Might be a VBR file.
-            expected_hdr.padding = None  # Not all frames are padded.
-            expected_hdr.frame_size = None
-            # You'd think that this would be constant, but MP3s
-            # encountered in the wild prove otherwise.
-            expected_hdr.protected = None
+    Args:
+      au_file: An AudioFile object to store the results of the analysis in.
+      table: A FrameTable describing the file.
+
+    Returns:
+      The same AudioFile object that was passed in as au_file.
 
+    Raises:
+      InvalidFileError: if the file appears to be corrupted.
+    """
+    # All headers are expected to match a template made from the first
+    # header, with the fields that can vary blanked out.
+    expected_hdr = None
+    if table.first_hdr is not None:
+        expected_hdr = table.first_hdr.copy()
+        expected_hdr.bit_rate_kbps = None  # Might be a VBR file.
+        expected_hdr.padding = None  # Not all frames are padded.
+        expected_hdr.frame_size = None
+        # You'd think that this would be constant, but MP3s
+        # encountered in the wild prove otherwise.
+        expected_hdr.protected = None
+
+    if table.mismatch_hdr is not None:
+        raise InvalidFileError(
+            "Bad header: found %s, expected %s (path=%s)" % (
+                table.mismatch_hdr, expected_hdr, au_file.path))
+
+    au_file.frame_count = table.frame_count
     if au_file.frame_count < _MINIMUM_FRAMES:
         raise InvalidFileError("Found only %d MPEG frames"
                                % au_file.frame_count)
 
-    # Add the bit rate back into the template header, then return it.
-    # If this is a VBR file, use the average bit rate instead.
-    if is_vbr:
-        expected_hdr.bit_rate_kbps = (
-            float(bit_rate_kbps_sum) / au_file.frame_count)
+    # Add the bit rate back into the template header.  If this is a
+    # VBR file, use the average bit rate instead.
+    if table.is_vbr():
+        expected_hdr.bit_rate_kbps = table.average_bit_rate_kbps()
     else:
-        expected_hdr.bit_rate_kbps = first_bit_rate_kbps
+        expected_hdr.bit_rate_kbps = table.first_hdr.bit_rate_kbps
 
-    # Finishing populating and then return the AudioFile object.
     au_file.mp3_header = expected_hdr
+    au_file.frame_size = table.frame_size
     # Round the duration down to an integral number of microseconds.
-    au_file.duration_ms = int(au_file.duration_ms)
-    if compute_fingerprint:
-        au_file.fingerprint = sha1_calc.hexdigest()
-    if get_payload:
-        au_file.payload = payload.getvalue()
+    au_file.duration_ms = int(table.duration_ms)
+    au_file.payload_ranges = table.payload_ranges()
+    if table.fingerprint is not None:
+        au_file.fingerprint = table.fingerprint
     return au_file
 
 
+def _scan_chunk(args):
+    """Runs in a worker process; scans a single range of a file."""
+    path, start, end, reader = args
+    f_in = open(path, "rb")
+    try:
+        table, next_offset = frame_table.scan_range(f_in, start, end,
+                                                    reader=reader)
+    finally:
+        f_in.close()
+    # Serialized tables are compact, and keep the headers shared.
+    return table.serialize(), next_offset
+
+
+def _merge_chunks(f_in, ranges, results, reader=None):
+    """Stitch the scans of consecutive ranges into a single FrameTable.
+
+    The scan of the first range starts at the beginning of the file, so
+    it is exactly what a sequential scan would see.  Each later scan
+    started at an arbitrary offset, so its first few frames might be
+    bogus.  We know where a sequential scan would find the first frame
+    of each range: it is the next_offset returned by the scan of the
+    previous range.  If that frame is not in the range's scan, we
+    rescan from it until we converge with the worker's frames.
+
+    Returns:
+      A (table, segments) pair, where table contains the merged frames
+      and segments is a list of the tables that contributed to it.
+    """
+    merged = frame_table.FrameTable()
+    segments = []
+    next_offset = 0
+    for (start, end), (table, chunk_next_offset) in zip(ranges, results):
+        if next_offset is None:
+            break
+        # A sequential scan would not find any frames in this range.
+        if next_offset >= end:
+            continue
+        index = dict((offset, i) for i, offset in enumerate(table.offsets))
+        if next_offset not in index:
+            fixup, next_offset = frame_table.scan_range(
+                f_in, next_offset, end, stop_offsets=index, reader=reader)
+            merged.extend(fixup)
+            segments.append(fixup)
+            if next_offset not in index:
+                continue
+        merged.extend(table, index[next_offset])
+        segments.append(table)
+        next_offset = chunk_next_offset
+    return merged, segments
+
+
+def analyze_parallel(path, au_file, compute_fingerprint=True,
+                     workers=None, chunk_size=None, reader=None):
+    """Analyze a large MP3 file using several processes.
+
+    The file is split into byte ranges which are scanned in parallel,
+    and the results are reconciled so that au_file ends up exactly as
+    it would after a call to analyze().  The payload is not stored.
+
+    Args:
+      path: The path to an MP3 file.
+      au_file: An AudioFile object to store the results of the analysis in.
+      compute_fingerprint: If False, do not compute a fingerprint.
+      workers: The number of worker processes.  If None, one per CPU.
+      chunk_size: The minimum size of each worker's range of the file.
+      reader: The name of the block_reader backend used to read
+        the file.  If None, the default backend is used.
+
+    Returns:
+      The same AudioFile object that was passed in as au_file.
+
+    Raises:
+      InvalidFileError: if the file appears to be corrupted.
+    """
+    size = os.stat(path).st_size
+    workers = workers or multiprocessing.cpu_count()
+    num_chunks = min(workers, size / (chunk_size or _MINIMUM_CHUNK_SIZE))
+    f_in = open(path, "rb")
+    try:
+        if num_chunks < 2:
+            return analyze(f_in, au_file,
+                           compute_fingerprint=compute_fingerprint,
+                           get_payload=False, reader=reader)
+
+        bounds = [size * i / num_chunks for i in xrange(num_chunks + 1)]
+        ranges = zip(bounds, bounds[1:])
+        pool = multiprocessing.Pool(num_chunks)
+        try:
+            results = pool.map(_scan_chunk, [(path, start, end, reader)
+                                             for start, end in ranges])
+        finally:
+            pool.close()
+            pool.join()
+        results = [(frame_table.deserialize(data), next_offset)
+                   for data, next_offset in results]
+        table, segments = _merge_chunks(f_in, ranges, results, reader=reader)
+
+        # If there are any inconsistent headers, let a sequential
+        # analysis produce the exact same error that it always would.
+        # (This also catches the rare case where a worker's first,
+        # bogus frame had an unusual header.)
+        for seg in segments:
+            if seg.first_hdr is None:
+                continue
+            if (seg.mismatch_hdr is not None
+                or seg.first_hdr.sampling_rate_hz
+                   != table.first_hdr.sampling_rate_hz
+                or seg.first_hdr.channels != table.first_hdr.channels):
+                f_in.seek(0)
+                return analyze(f_in, au_file,
+                               compute_fingerprint=compute_fingerprint,
+                               get_payload=False, reader=reader)
+
+        if compute_fingerprint and table.frame_count:
+            sha1_calc = hashlib.sha1()
+            for offset, length in table.payload_ranges():
+                f_in.seek(offset)
+                while length > 0:
+                    data = f_in.read(min(length, _HASH_READ_SIZE))
+                    sha1_calc.update(data)
+                    length -= len(data)
+            table.fingerprint = sha1_calc.hexdigest()
+        table.total_size = size
+    finally:
+        f_in.close()
+    return populate(au_file, table)
+
+
 def sample_and_analyze(au_file, mp3_path_list):
     """Pick a representative file from a list of filenames and analyze it.
 
@@ -2,9 +2,13 @@
 import os
 
 import cStringIO
+import random
+import shutil
+import tempfile
 import unittest
 
 from chirp.common import ROOT_DIR
+from chirp.common import mp3_frame
 from chirp.library import analyzer
 from chirp.library import audio_file
 
@@ -45,6 +49,54 @@ class AnalyzerTest(unittest.TestCase):
         self.assertEqual(None, au_file.mutagen_id3)
         self.assertEqual(None, au_file.path)
 
+    def assert_parallel_matches(self, path, chunk_size):
+        expected = audio_file.AudioFile()
+        stream = open(path)
+        analyzer.analyze(stream, expected, get_payload=False)
+        stream.close()
+        au_file = audio_file.AudioFile()
+        analyzer.analyze_parallel(path, au_file, workers=8,
+                                  chunk_size=chunk_size)
+        for attr in ("fingerprint", "frame_count", "frame_size",
+                     "duration_ms"):
+            self.assertEqual(getattr(expected, attr), getattr(au_file, attr))
+        self.assertEqual(str(expected.mp3_header), str(au_file.mp3_header))
+        self.assertEqual(expected.mp3_header.bit_rate_kbps,
+                         au_file.mp3_header.bit_rate_kbps)
+
+    def test_parallel(self):
+        # Tiny chunks force the workers to start in the middle of frames,
+        # so the boundary reconciliation gets a workout.
+        f = os.path.join(ROOT_DIR,
+                         "library/testdata/analyzer_test/test001.mp3")
+        for chunk_size in (5000, 7777, 20000, 1 << 20):
+            self.assert_parallel_matches(f, chunk_size)
+
+        test_dir = tempfile.mkdtemp()
+        try:
+            # Junk between frames.
+            rand = random.Random(0)
+            junk = "".join(rand.choice("\xff\x90\x00ID3")
+                           for _ in xrange(3000))
+            path = os.path.join(test_dir, "junky.mp3")
+            out = open(path, "wb")
+            out.write(mp3_frame.dead_air(5000) + junk
+                      + mp3_frame.dead_air(5000) + junk[:100])
+            out.close()
+            for chunk_size in (1000, 3001, 10000):
+                self.assert_parallel_matches(path, chunk_size)
+
+            # Both paths reject the same corrupted file.
+            path = os.path.join(test_dir, "short.mp3")
+            out = open(path, "wb")
+            out.write(mp3_frame.dead_air(1000) + junk)
+            out.close()
+            self.assertRaises(analyzer.InvalidFileError,
+                              analyzer.analyze_parallel, path,
+                              audio_file.AudioFile(), chunk_size=1000)
+        finally:
+            shutil.rmtree(test_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
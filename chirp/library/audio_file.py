@@ -35,6 +35,9 @@ class AudioFile(object):
         for this file.
       path: The file's path, or None if the path is not known
         (or is not defined because of our context).
+      payload_ranges: A list of (offset, size) pairs giving the
+        locations of the MPEG frames in the file at 'path', or None
+        if they are not known.
     """
     volume = None
     import_timestamp = None
@@ -51,6 +54,7 @@ class AudioFile(object):
     path = None
     
     payload = None
+    payload_ranges = None
 
     def __eq__(self, other):
         def _mutagen_id3_set(obj):
@@ -169,6 +173,175 @@ def _get_mp3(path):
     return mp3
 
 
+# The size of our first read when scanning tags.  Most tags are
+# smaller than this, so usually no second read is needed.
+_FAST_READ_SIZE = 64 << 10
+
+# mutagen's MPEGInfo looks at this many bytes after the ID3 tag to find
+# the first MPEG frames.
+_MPEG_PROBE_SIZE = 32768
+
+
+class _NeedMoreData(Exception):
+    """Raised when parsing needs data beyond what we read."""
+
+
+class _PrefixFile(object):
+    """A read-only file-like object holding the start of a file.
+
+    Reads beyond the end of the held data raise _NeedMoreData, unless
+    the held data extends to the end of the file.
+    """
+
+    def __init__(self, data, size):
+        self._data = data
+        self.size = size
+        self._pos = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size < 0:
+            end = self.size
+        else:
+            end = min(self._pos + size, self.size)
+        if end > len(self._data):
+            raise _NeedMoreData()
+        data = self._data[self._pos:end]
+        self._pos = max(self._pos, end)
+        return data
+
+    def close(self):
+        pass
+
+
+# The errors that mean a file's start is not a tag and audio we can
+# parse ourselves.  Anything else (in particular, an AttributeError from
+# a mutagen that lacks the internals we use) is a bug and propagates.
+_PARSE_ERRORS = (_NeedMoreData, EOFError, ValueError, struct.error,
+                 mutagen.id3.error, mutagen.mp3.error)
+
+
+def _load_id3_prefix(tags, filename, prefix_file):
+    """Loads ID3v2 tags from a _PrefixFile rather than from a path.
+
+    This mirrors mutagen.id3.ID3.load, except that a missing ID3v2 tag
+    (which would send mutagen off to look for an ID3v1 tag at the end
+    of the file) is reported with _NeedMoreData.  mutagen 1.16 can only
+    load tags from a path, so this calls its private helpers; that is
+    why requirements/prod.txt pins the mutagen version.
+
+    Args:
+      tags: An empty mutagen.id3.ID3 object to load the tags into.
+      filename: The path the data came from, or None.
+      prefix_file: A _PrefixFile holding the start of the file.
+    """
+    tags.filename = filename
+    tags._ID3__known_frames = None
+    tags._ID3__fileobj = prefix_file
+    tags._ID3__filesize = prefix_file.size
+    try:
+        try:
+            tags._ID3__load_header()
+        except (EOFError, mutagen.id3.ID3NoHeaderError,
+                mutagen.id3.ID3UnsupportedVersionError):
+            raise _NeedMoreData()
+        if (2, 3, 0) <= tags.version:
+            frames = mutagen.id3.Frames
+        elif (2, 2, 0) <= tags.version:
+            frames = mutagen.id3.Frames_2_2
+        data = tags._ID3__fullread(tags.size - 10)
+        for frame in tags._ID3__read_frames(data, frames=frames):
+            if isinstance(frame, mutagen.id3.Frame):
+                tags.add(frame)
+            else:
+                tags.unknown_frames.append(frame)
+    finally:
+        del tags._ID3__fileobj
+        del tags._ID3__filesize
+    tags.update_to_v24()
+
+
+def parse_id3_tag(data):
+    """Parse an ID3v2 tag that is held in memory.
+
+    Unlike mutagen, this never touches the file the tag came from.  The
+    text tags are returned exactly as they were stored, without being
+    cleaned up.
+
+    Args:
+      data: A string starting with a complete ID3v2 tag.
+
+    Returns:
+      A mutagen.id3.ID3 object, or None if data does not start with
+      a complete, valid ID3v2 tag.
+    """
+    tags = mutagen.id3.ID3()
+    try:
+        _load_id3_prefix(tags, None, _PrefixFile(data, len(data)))
+    except _PARSE_ERRORS:
+        return None
+    return tags
+
+
+def _read_prefix(path):
+    """Read the ID3v2 tag and first MPEG frames of a file.
+
+    This does at most two bounded reads: one of _FAST_READ_SIZE bytes,
+    and if the tag turns out to be larger than that, one more for the
+    rest of the tag and the audio after it.
+
+    Returns:
+      A _PrefixFile.
+    """
+    f_in = open(path, "rb")
+    try:
+        size = os.fstat(f_in.fileno()).st_size
+        data = f_in.read(_FAST_READ_SIZE)
+        needed = _MPEG_PROBE_SIZE
+        if data.startswith("ID3") and len(data) >= 10:
+            needed += mutagen.id3.BitPaddedInt(data[6:10]) + 10
+        needed = min(needed, size)
+        if len(data) < needed:
+            data += f_in.read(needed - len(data))
+    finally:
+        f_in.close()
+    return _PrefixFile(data, size)
+
+
+def _get_mp3_fast(path):
+    """Like _get_mp3, but only reads the start of the file.
+
+    The result is identical to what _get_mp3 would return; if the file
+    does not look like a well-formed MP3 with an ID3v2 tag, we just
+    call _get_mp3.
+    """
+    try:
+        prefix_file = _read_prefix(path)
+        tags = mutagen.id3.ID3()
+        _load_id3_prefix(tags, path, prefix_file)
+        # This mirrors mutagen.id3.ID3FileType.load.
+        mp3 = mutagen.mp3.MP3.__new__(mutagen.mp3.MP3)
+        mp3.filename = path
+        mp3.tags = tags
+        mp3.info = mutagen.mp3.MPEGInfo(prefix_file, tags.size)
+    except _PARSE_ERRORS:
+        # Let mutagen handle (and complain about) anything unusual.
+        return _get_mp3(path)
+    # Automatically clean up the text tags.
+    for tag in mp3.itervalues():
+        id3_text.standardize(tag)
+    return mp3
+
+
 def _tag_to_int(au_file, tag_key):
     tag = au_file.mutagen_id3.get(tag_key)
     if tag is None:
@@ -201,7 +374,7 @@ def scan_fast(path, _read_id3_hook=None):
     """
     au_file = AudioFile()
     au_file.path = path
-    au_file.mutagen_id3 = (_read_id3_hook or _get_mp3)(path)
+    au_file.mutagen_id3 = (_read_id3_hook or _get_mp3_fast)(path)
     if au_file.mutagen_id3 is None:
         return None
 
@@ -232,7 +405,7 @@ def scan_fast(path, _read_id3_hook=None):
     return au_file
     
 
-def scan(path, _read_id3_hook=None):
+def scan(path, _read_id3_hook=None, get_payload=True, table=None):
     """Produce an AudioFile object for the file at 'path'.
 
     This function inspects the entire file, computing the fingerprint
@@ -248,6 +421,10 @@ def scan(path, _read_id3_hook=None):
         returns mutagen ID3 data.  Passing in None (the default) uses
         a default implementation.  This argument should only be used
         for testing.
+      get_payload: If False, the 'payload' field is not set.
+      table: An optional frame_table.FrameTable describing the file at
+        'path', for example one kept in the scan cache.  If given, the
+        frames are not read again, and the 'payload' field is not set.
 
     Returns:
       An AudioFile object describing the file at 'path', or None if it
@@ -259,9 +436,12 @@ def scan(path, _read_id3_hook=None):
     if au_file.mutagen_id3 is None:
         return None
 
+    if table is not None:
+        return analyzer.populate(au_file, table)
+
     file_obj = open(path)
     try:
-        analyzer.analyze(file_obj, au_file)
+        analyzer.analyze(file_obj, au_file, get_payload=get_payload)
     finally:
         file_obj.close()
 
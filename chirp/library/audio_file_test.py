@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import mutagen.id3
 import mutagen.mp3
+from mock import patch
 
 from chirp.common import mp3_header, ROOT_DIR
 from chirp.library import audio_file
@@ -198,6 +201,67 @@ class AudioFileTest(unittest.TestCase):
         self.assertEqual(123454321, fast_au_file.album_id)
         self.assertEqual(None, slow_au_file.album_id)
 
+    def assert_fast_tags_match(self, path, expect_fallback=False):
+        expected = audio_file._get_mp3(path)
+        with patch.object(audio_file, "_get_mp3",
+                          wraps=audio_file._get_mp3) as mock_get_mp3:
+            actual = audio_file._get_mp3_fast(path)
+            self.assertEqual(expect_fallback, mock_get_mp3.called)
+        self.assertEqual(type(expected), type(actual))
+        self.assertEqual(type(expected.tags), type(actual.tags))
+        self.assertEqual(sorted(repr(x) for x in expected.itervalues()),
+                         sorted(repr(x) for x in actual.itervalues()))
+        if expected.tags is not None:
+            self.assertEqual(expected.tags.size, actual.tags.size)
+            self.assertEqual(expected.tags.version, actual.tags.version)
+        self.assertEqual(expected.info.__dict__, actual.info.__dict__)
+
+    def test_get_mp3_fast(self):
+        for name in ("no_chirp_tags.mp3", "has_chirp_tags.mp3"):
+            self.assert_fast_tags_match(os.path.join(TESTDATA, name))
+
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, "test.mp3")
+            # A tag that is too big for our first read.
+            shutil.copy(os.path.join(TESTDATA, "has_chirp_tags.mp3"), path)
+            tags = mutagen.id3.ID3(path)
+            tags.add(mutagen.id3.APIC(encoding=0, mime="image/jpeg", type=3,
+                                      desc=u"", data="\0" * (100 << 10)))
+            tags.save()
+            self.assert_fast_tags_match(path)
+            # No ID3v2 tag at all.
+            mutagen.id3.delete(path)
+            self.assert_fast_tags_match(path, expect_fallback=True)
+            # Not an MP3 at all.
+            open(path, "w").write("ID3 this is not an MP3 file")
+            self.assertEqual(None, audio_file._get_mp3_fast(path))
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_get_mp3_fast__mutagen_internals_missing(self):
+        # If mutagen no longer has the private helpers we rely on, we
+        # should fail loudly rather than quietly falling back to the
+        # slow path for every file.
+        path = os.path.join(TESTDATA, "has_chirp_tags.mp3")
+        with patch.object(mutagen.id3.ID3, "_ID3__read_frames", new=None):
+            with patch.object(audio_file, "_get_mp3") as mock_get_mp3:
+                self.assertRaises(TypeError, audio_file._get_mp3_fast, path)
+                self.assertRaises(TypeError, audio_file.parse_id3_tag,
+                                  open(path, "rb").read())
+                self.assertFalse(mock_get_mp3.called)
+
+    def test_parse_id3_tag(self):
+        path = os.path.join(TESTDATA, "has_chirp_tags.mp3")
+        expected = mutagen.id3.ID3(path)
+        data = open(path, "rb").read()
+        tags = audio_file.parse_id3_tag(data[:expected.size])
+        self.assertEqual(sorted(repr(x) for x in expected.values()),
+                         sorted(repr(x) for x in tags.values()))
+        # A truncated tag cannot be parsed.
+        self.assertEqual(None, audio_file.parse_id3_tag(data[:100]))
+        self.assertEqual(None, audio_file.parse_id3_tag("not a tag"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,12 +1,45 @@
 """Crawler: recursively walk a file tree, returning info about found MP3s.
 """
 
+import collections
 import logging
+import multiprocessing
 import os
 import sys
 import mutagen.mp3
 
+from chirp.common import dir_scan
 from chirp.library import audio_file
+from chirp.library import scan_cache
+
+
+# When scanning in a process pool, allow this many files per worker to
+# be in flight at once.
+_MAX_PENDING_PER_WORKER = 4
+
+
+def _scan_file(full_path, fast):
+    """Scan a single file.  This might run in a worker process.
+
+    The file's MPEG frames are never read into its payload, so only the
+    scan results need to be sent back from a worker.  Anyone who needs
+    the frames can find them through the AudioFile's payload_ranges.
+
+    Returns:
+      An (au_file, skip_reason) pair.  If the scan failed, au_file is
+      None and skip_reason describes the problem.
+    """
+    try:
+        if fast:
+            return audio_file.scan_fast(full_path), None
+        else:
+            return audio_file.scan(full_path, get_payload=False), None
+    except Exception, ex:
+        # TODO(trow): Here we should really only catch
+        # the exceptions we expect audio_file.scan and
+        # .scan_fast to raise.
+        logging.error("Skipping file %s: %s", full_path, str(ex))
+        return None, str(ex)
 
 
 class Crawler(object):
@@ -21,7 +54,8 @@ class Crawler(object):
         file that was not crawled for an interesting reason.
     """
 
-    def __init__(self, fast=False, directory_filter=None):
+    def __init__(self, fast=False, directory_filter=None, cache=None,
+                 workers=1, stat_threads=dir_scan.DEFAULT_STAT_THREADS):
         """Constructor.
 
         Args:
@@ -29,9 +63,19 @@ class Crawler(object):
           directory_filter: An optional callable; if not None, it
             is applied to each directory name that is encountered,
             and the directory is only crawled if True is returned.
+          cache: An optional scan_cache.ScanCache.
+          workers: The number of processes used to scan files.  If
+            greater than 1, files are scanned in a process pool; the
+            results are still yielded in the same order.  If None,
+            one process per CPU is used.
+          stat_threads: The number of threads used to stat the files
+            in each directory.
         """
         self._directory_filter = directory_filter
         self._fast = fast
+        self._cache = cache
+        self._workers = workers or multiprocessing.cpu_count()
+        self._stat_threads = stat_threads
         self._all_roots = []
         self._reset()
         self._current_dir = None
@@ -50,83 +94,157 @@ class Crawler(object):
         """Add a path to the list of roots to be crawled."""
         self._all_roots.append(root_path)
         
-    def _remove_ignored_directories(self, this_current_dir, dirnames):
+    def _remove_ignored_directories(self, this_current_dir, dir_entries):
         # Filter out directories that should not be recursively crawled.
-        dirnames_to_be_crawled = []
-        for name in dirnames:
-            if not name.startswith("."):
-                dirnames_to_be_crawled.append(name)
+        entries_to_be_crawled = []
+        for entry in dir_entries:
+            if not entry.name.startswith("."):
+                entries_to_be_crawled.append(entry)
             else:
-                full_name = os.path.join(this_current_dir, name)
-                self.skipped_directories.append(full_name)
-        return sorted(dirnames_to_be_crawled)
+                self.skipped_directories.append(entry.path)
+        return sorted(entries_to_be_crawled, key=lambda entry: entry.name)
 
-    def __iter__(self):
-        """Iterator that yields a sequence of crawled MP3s.
+    def _walk(self):
+        """Walk the roots, yielding the files that should be scanned.
 
         Yields:
-          An AudioFile object.
+          (dirpath, full_path, stat_obj, skip_reason) tuples, in crawl
+          order.  If skip_reason is not None, the file should be
+          skipped for that reason and stat_obj is None.
         """
-        self._reset()
-
-        yielded_size = 0
+        # Reuse the same stat threads for every directory.
+        stat_pool = dir_scan.StatPool(self._stat_threads)
+        try:
+            for walked in self._walk_roots(stat_pool):
+                yield walked
+        finally:
+            stat_pool.close()
+
+    def _walk_roots(self, stat_pool):
         for root_path in self._all_roots:
-            for self._current_dir, dirnames, filenames in os.walk(root_path):
+            for dirpath, dir_entries, file_entries in dir_scan.walk(
+                root_path):
 
                 # We do not recursively descend into these directoryies.
-                dirnames[:] = self._remove_ignored_directories(
-                    self._current_dir, dirnames)
+                dir_entries[:] = self._remove_ignored_directories(
+                    dirpath, dir_entries)
 
                 # If a directory filter has been specified, use it to know
                 # when to silently skip any files in a single directory.
                 if (self._directory_filter
-                    and not self._directory_filter(self._current_dir)):
+                    and not self._directory_filter(dirpath)):
                     continue
 
-                # Now walk across each file in this dir, yielding a
-                # stream of AudioFile objects.
-                for name in filenames:
-                    full_path = os.path.join(self._current_dir, name)
-
-                    # Skip files with the wrong sorts of names.  These are
-                    # not logged.
-                    if name.startswith("."):
-                        continue
-
-                    if not name.lower().endswith(".mp3"):
-                        self.skipped_files.append(
-                            (full_path, "Invalid filename"))
+                # Skip files with the wrong sorts of names.  Dot-files
+                # are not logged.
+                file_entries = [entry for entry in file_entries
+                                if not entry.name.startswith(".")]
+                mp3_entries = [entry for entry in file_entries
+                               if entry.name.lower().endswith(".mp3")]
+
+                # Stat all of the MP3s in this directory at once.
+                stats = dict(zip(
+                        (entry.path for entry in mp3_entries),
+                        stat_pool.stat_entries(mp3_entries)))
+
+                for entry in file_entries:
+                    if entry.path not in stats:
+                        yield dirpath, entry.path, None, "Invalid filename"
                         continue
-                    
-                    # Stat the file, and skip the files when that
-                    # operation fails.
-                    try:
-                        stat_obj = os.stat(full_path)
-                    except (IOError, OSError), ex:
-                        self.skipped_files.append((full_path, str(ex)))
+                    # Skip the files when the stat failed.
+                    stat_obj, ex = stats[entry.path]
+                    if ex is not None:
+                        yield dirpath, entry.path, None, str(ex)
                         continue
+                    yield dirpath, entry.path, stat_obj, None
 
-                    try:
-                        if self._fast:
-                            au_file = audio_file.scan_fast(full_path)
-                        else:
-                            au_file = audio_file.scan(full_path)
-                    except Exception, ex:
-                        # TODO(trow): Here we should really only catch
-                        # the exceptions we expect audio_file.scan and
-                        # .scan_fast to raise.
-                        self.skipped_files.append((full_path, str(ex)))
-                        logging.error("Skipping file %s: %s",
-                                      full_path, str(ex))
-                        continue
+    def _scan_serially(self, walked):
+        """Scan each walked file, one at a time.
+
+        Yields:
+          (dirpath, full_path, au_file, skip_reason) tuples, in crawl order.
+        """
+        for dirpath, full_path, stat_obj, skip_reason in walked:
+            if skip_reason is not None:
+                yield dirpath, full_path, None, skip_reason
+                continue
+            key = scan_cache.file_key(full_path, stat_obj)
+            au_file = None
+            if self._cache is not None:
+                au_file = self._cache.get(key, self._fast)
+            if au_file is None:
+                au_file, skip_reason = _scan_file(full_path, self._fast)
+                if au_file is not None and self._cache is not None:
+                    self._cache.put(key, au_file, self._fast)
+            yield dirpath, full_path, au_file, skip_reason
+
+    def _scan_in_pool(self, walked):
+        """Scan the walked files in a pool of worker processes.
+
+        At most _MAX_PENDING_PER_WORKER files per worker are in flight
+        at once, so we never get too far ahead of our consumer.  The
+        cache is only ever touched from this process.
 
+        Yields:
+          (dirpath, full_path, au_file, skip_reason) tuples, in crawl order.
+        """
+        pool = multiprocessing.Pool(self._workers)
+        pending = collections.deque()
+        max_pending = self._workers * _MAX_PENDING_PER_WORKER
+
+        def finish(item):
+            dirpath, full_path, key, au_file, skip_reason, async_result = item
+            if async_result is not None:
+                au_file, skip_reason = async_result.get()
+                if au_file is not None and self._cache is not None:
+                    self._cache.put(key, au_file, self._fast)
+            return dirpath, full_path, au_file, skip_reason
+
+        try:
+            for dirpath, full_path, stat_obj, skip_reason in walked:
+                key = au_file = async_result = None
+                if skip_reason is None:
+                    key = scan_cache.file_key(full_path, stat_obj)
+                    if self._cache is not None:
+                        au_file = self._cache.get(key, self._fast)
                     if au_file is None:
-                        self.skipped_files.append((full_path,
-                                                   "Not an MP3 (No tags?)"))
-                        continue
+                        async_result = pool.apply_async(
+                            _scan_file, (full_path, self._fast))
+                pending.append((dirpath, full_path, key, au_file, skip_reason,
+                                async_result))
+                while len(pending) >= max_pending:
+                    yield finish(pending.popleft())
+            while pending:
+                yield finish(pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
 
-                    # Remember this directory, then yield the AudioFile.
-                    self.directories_seen.add(self._current_dir)
-                    yield au_file
+    def __iter__(self):
+        """Iterator that yields a sequence of crawled MP3s.
+
+        Yields:
+          An AudioFile object.  Its payload is not set; see
+          Album.ensure_payloads.
+        """
+        self._reset()
 
-            
+        walked = self._walk()
+        if self._workers > 1:
+            scanned = self._scan_in_pool(walked)
+        else:
+            scanned = self._scan_serially(walked)
+
+        for self._current_dir, full_path, au_file, skip_reason in scanned:
+            if skip_reason is not None:
+                self.skipped_files.append((full_path, skip_reason))
+                continue
+
+            if au_file is None:
+                self.skipped_files.append((full_path,
+                                           "Not an MP3 (No tags?)"))
+                continue
+
+            # Remember this directory, then yield the AudioFile.
+            self.directories_seen.add(self._current_dir)
+            yield au_file
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
 import os
+import shutil
+import tempfile
 import unittest
 
 from chirp.common import ROOT_DIR
 from chirp.library import crawler
 from chirp.library import fingerprint
+from chirp.library import scan_cache
 
 
 TESTDATA = os.path.join(ROOT_DIR, "library/testdata/crawler_test")
@@ -59,6 +62,39 @@ class CrawlerTest(unittest.TestCase):
             os.path.join(TESTDATA, "test_tree/A/invalid_file.mp3"),
             crawl.skipped_files[0][0])
 
+    def crawl_tree(self, **kwargs):
+        crawl = crawler.Crawler(**kwargs)
+        crawl.add_root(os.path.join(TESTDATA, "test_tree"))
+        au_files = list(crawl)
+        return au_files, crawl.skipped_files, crawl.directories_seen
+
+    def test_parallel_crawling(self):
+        test_dir = tempfile.mkdtemp()
+        try:
+            cache = scan_cache.ScanCache(os.path.join(test_dir, "cache"))
+            for fast in (False, True):
+                expected = self.crawl_tree(fast=fast)
+                self.assertEqual(15, len(expected[0]))
+                # Run twice with a cache, so that we see both hits and
+                # misses.
+                for kwargs in ({}, {"cache": cache}, {"cache": cache}):
+                    au_files, skipped_files, dirs_seen = self.crawl_tree(
+                        fast=fast, workers=3, **kwargs)
+                    self.assertEqual([au.path for au in expected[0]],
+                                     [au.path for au in au_files])
+                    self.assertEqual([au.fingerprint for au in expected[0]],
+                                     [au.fingerprint for au in au_files])
+                    # Payloads are never read.
+                    self.assertEqual(
+                        set([None]),
+                        set(au.payload for au in expected[0] + au_files))
+                    self.assertEqual(expected[1], skipped_files)
+                    self.assertEqual(expected[2], dirs_seen)
+            self.assertEqual(30, cache.hits)
+            cache.close()
+        finally:
+            shutil.rmtree(test_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
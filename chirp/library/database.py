@@ -9,109 +9,495 @@ operations are:
   * Get all audio files that were part of a particular import
     (Database.get_by_import)
   * Find a single audio file by it's fingerprint (Database.get_by_fingerprint)
+  * Find which of many fingerprints are already in the library
+    (Database.get_existing_fingerprints)
+  * Get the raw rows of a table that belong to some audio files
+    (Database.get_rows_by_fingerprint)
   * Transactionally add N new audio files, grouped into a single import
     (Database.begin_add, Database.update)
   * Write a single audio file's updated ID3 tags into the database
     (Database.update)
+  * Write many audio files' updated ID3 tags into the database in a
+    single transaction (Database.update_many)
+  * Transactionally remove audio files and all of their ID3 tags
+    (Database.delete_audio_files)
+  * Create any missing indexes and refresh the query planner's
+    statistics (Database.analyze)
+  * Drop old ID3 tags from the tag history, along with the tags of
+    files that are no longer in the library (Database.compact_tags)
+  * Return unused space in the database file to the filesystem
+    (Database.reclaim_space)
+  * Regenerate the table of current tags from the full tag history
+    (Database.rebuild_current_tags)
+  * Convert ID3 tags stored in the old repr() format into the
+    structured tag_json format (Database.migrate_tag_encoding)
+  * Convert the database to the current schema version
+    (Database.migrate_schema)
+  * Find the audio files that have been added, updated or deleted
+    since a previous point in the change log
+    (Database.changes_since, Database.current_change_cursor)
 
 Extending the functionality of this module to support other operations
 is *strongly* discouraged.
 
-This is the *only* code that should write to either the audio_files or
-id3_tags tables.  Everyone and everything else should treat those
-tables as read-only.
+This is the *only* code that should write to the audio_files, id3_tags,
+current_id3_tags or changes tables.  Everyone and everything else should
+treat those tables as read-only.
 TODO(trow): This should be enforced by db permissions in our final prod
 environment.
 """
 
 import sqlite3
+import threading
 
 import mutagen.id3
 
+from chirp.common import bloom
 from chirp.common import timestamp
 from chirp.library import audio_file
 from chirp.library import schema
+from chirp.library import tag_codec
 
 
-def _insert(target, table_name, insert_tuple):
-    """Shorthand for inserting a tuple of items into a table."""
-    sql = "INSERT INTO %s VALUES (%s)" % (
-        table_name,
-        ",".join(["?"] * len(insert_tuple)))
-    target.execute(sql, insert_tuple)
+# sqlite allows at most 999 parameters in a single statement, so we
+# look up fingerprints (and read audio files) in chunks of this size.
+_FINGERPRINT_CHUNK_SIZE = 500
 
+# The default false positive rate of the fingerprint prefilter.
+_FINGERPRINT_FILTER_ERROR_RATE = 0.001
 
-def _insert_tags(conn, fingerprint, timestamp, mutagen_id3):
-    """Insert an audio file's ID3 tags into the database.
+# How long to wait for another connection's lock before giving up.
+_BUSY_TIMEOUT_SECONDS = 60
+
+# When gathering statistics for the query planner, look at no more
+# than about this many rows of each index.
+_ANALYSIS_LIMIT = 1000
+
+# The most change log entries that changes_since reads at once.
+_CHANGE_BATCH_SIZE = 10000
+
+# The tables whose rows belong to a single audio file.
+_FINGERPRINT_TABLES = ("audio_files", "id3_tags", "current_id3_tags")
+
+# The value of PRAGMA auto_vacuum when it is set to INCREMENTAL.
+_AUTO_VACUUM_INCREMENTAL = 2
+
+# The kinds of change recorded in the change log.
+CHANGE_ADD = "add"
+CHANGE_UPDATE = "update"
+CHANGE_DELETE = "delete"
+
+# Settings applied to every connection: memory-map up to 256MB of the
+# database file, and keep a 64MB page cache.
+_CONNECTION_PRAGMAS = (
+    "PRAGMA mmap_size=%d" % (256 << 20),
+    "PRAGMA cache_size=-%d" % (64 << 10),
+)
+
+
+# Maps (table name, number of columns) to an INSERT statement.  Reusing
+# the exact same SQL string lets the sqlite3 module reuse its prepared
+# statement.
+_insert_sql_cache = {}
+
+
+def _insert_sql(table_name, num_columns):
+    """Returns the SQL to insert a row of num_columns items into a table."""
+    key = (table_name, num_columns)
+    sql = _insert_sql_cache.get(key)
+    if sql is None:
+        sql = "INSERT INTO %s VALUES (%s)" % (
+            table_name,
+            ",".join(["?"] * num_columns))
+        _insert_sql_cache[key] = sql
+    return sql
+
+
+def _insert_many(target, table_name, all_insert_tuples):
+    """Insert a list of equal-length tuples into a table."""
+    if all_insert_tuples:
+        target.executemany(
+            _insert_sql(table_name, len(all_insert_tuples[0])),
+            all_insert_tuples)
+
+
+def _has_table(conn, table_name):
+    """Returns True if the database contains a particular table."""
+    cursor = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+        (table_name,))
+    return cursor.fetchone() is not None
+
+
+def _has_tag_json(conn):
+    """Returns True if the id3_tags table has a tag_json column."""
+    cursor = conn.execute("PRAGMA table_info(id3_tags)")
+    return any(row[1] == "tag_json" for row in cursor)
+
+
+def _in_list(items):
+    """Returns the placeholders for an IN clause over a list of items."""
+    return ",".join("?" * len(items))
+
+
+class NoChangeLogError(Exception):
+    """Raised when reading the change log of a database without one."""
+
+
+class _Layout(object):
+    """Describes how a particular database stores the library.
+
+    All of the differences between the schema versions are handled
+    here and in the functions that are given a _Layout, so that the
+    rest of this module (and its callers) do not need to care which
+    version they are using.
+
+    Attributes:
+      version: The database's schema version.
+      has_tag_json: True if the id3_tags table has a tag_json column.
+      has_current_tags: True if there is a current_id3_tags table.
+      has_changes: True if there is a changes table.
+    """
+
+    def __init__(self, conn):
+        self.version = conn.execute("PRAGMA user_version").fetchone()[0] or 1
+        self.has_tag_json = self.version >= 2 or _has_tag_json(conn)
+        self.has_current_tags = _has_table(conn, "current_id3_tags")
+        self.has_changes = _has_table(conn, "changes")
+
+    def fingerprint_param(self, fingerprint):
+        """Convert a fingerprint into a query parameter."""
+        if self.version >= 2:
+            return schema.fingerprint_to_db(fingerprint)
+        return fingerprint
+
+
+def _next_tag_seqs(conn, timestamp, fingerprint_params):
+    """Find the next free seq for tags with a particular timestamp.
+
+    Only used with version 2 schemas.
+
+    Returns:
+      A dict mapping str() of fingerprint parameters to the first unused
+      seq for that fingerprint's tags with this timestamp.  Fingerprints
+      without any such tags are omitted.
+    """
+    next_seqs = {}
+    for i in xrange(0, len(fingerprint_params), _FINGERPRINT_CHUNK_SIZE):
+        chunk = fingerprint_params[i:i + _FINGERPRINT_CHUNK_SIZE]
+        sql = ("SELECT fingerprint, MAX(seq) FROM id3_tags"
+               " WHERE timestamp=? AND fingerprint IN (%s)"
+               " GROUP BY fingerprint" % _in_list(chunk))
+        for fingerprint, max_seq in conn.execute(sql, [timestamp] + chunk):
+            next_seqs[str(fingerprint)] = max_seq + 1
+    return next_seqs
+
+
+def _insert_tags(conn, layout, timestamp, all_au_files, new_files=False):
+    """Insert audio files' ID3 tags into the database.
     
     Args:
       conn: The database connection.
-      fingerprint: The audio file's fingerprint.
+      layout: A _Layout describing the database.
       timestamp: A timestamp associated with these tags.  When initially
         importing a file into the library, this should be equal to the
         import timestamp.
-      mutagen_id3: A mutagen.id3.ID3 object containing the file's tags
+      all_au_files: A sequence of AudioFile objects.  Each file's
+        fingerprint and mutagen_id3 attributes are used.
+      new_files: True if the files are being added to the library, and
+        so cannot already have any tags.
+    """
+    if layout.version >= 2:
+        next_seqs = {}
+        if not new_files:
+            next_seqs = _next_tag_seqs(
+                conn, timestamp,
+                [layout.fingerprint_param(au_file.fingerprint)
+                 for au_file in all_au_files])
+        all_tag_tuples = []
+        for au_file in all_au_files:
+            fingerprint_param = layout.fingerprint_param(au_file.fingerprint)
+            seq = next_seqs.get(str(fingerprint_param), 0)
+            for tag in au_file.mutagen_id3.itervalues():
+                all_tag_tuples.append(schema.tag_tuple_to_v2(
+                        schema.id3_tag_to_tuple(au_file.fingerprint,
+                                                timestamp, tag),
+                        seq))
+                seq += 1
+            next_seqs[str(fingerprint_param)] = seq
+        _insert_many(conn, "id3_tags", all_tag_tuples)
+    else:
+        all_tag_tuples = [
+            schema.id3_tag_to_tuple(au_file.fingerprint, timestamp, tag)
+            for au_file in all_au_files
+            for tag in au_file.mutagen_id3.itervalues()]
+        if layout.has_tag_json:
+            _insert_many(conn, "id3_tags", all_tag_tuples)
+        else:
+            _insert_many(conn, "id3_tags",
+                         [tag_tuple[:schema.ID3_TAGS_LEGACY_COLUMNS]
+                          for tag_tuple in all_tag_tuples])
+    if layout.has_current_tags:
+        _update_current_tags(conn, timestamp, all_tag_tuples, new_files)
+
+
+def _update_current_tags(conn, timestamp, all_tag_tuples, new_files):
+    """Keep the current_id3_tags table in sync with new tags.
+
+    Args:
+      conn: The database connection.
+      timestamp: The timestamp of the new tags.
+      all_tag_tuples: The new rows that were added to the id3_tags table.
+      new_files: True if the files cannot already have any current tags.
+    """
+    if not new_files:
+        fingerprints = sorted(set(tag_tuple[0]
+                                  for tag_tuple in all_tag_tuples))
+        newer = set()
+        stale = []
+        for i in xrange(0, len(fingerprints), _FINGERPRINT_CHUNK_SIZE):
+            chunk = fingerprints[i:i + _FINGERPRINT_CHUNK_SIZE]
+            sql = ("SELECT fingerprint, MAX(timestamp) FROM current_id3_tags"
+                   " WHERE fingerprint IN (%s) GROUP BY fingerprint"
+                   % _in_list(chunk))
+            for fingerprint, current_timestamp in conn.execute(sql, chunk):
+                if current_timestamp > timestamp:
+                    # The file already has newer tags.
+                    newer.add(str(fingerprint))
+                elif current_timestamp < timestamp:
+                    stale.append(fingerprint)
+        for i in xrange(0, len(stale), _FINGERPRINT_CHUNK_SIZE):
+            chunk = stale[i:i + _FINGERPRINT_CHUNK_SIZE]
+            sql = ("DELETE FROM current_id3_tags"
+                   " WHERE fingerprint IN (%s)" % _in_list(chunk))
+            conn.execute(sql, chunk)
+        if newer:
+            all_tag_tuples = [tag_tuple for tag_tuple in all_tag_tuples
+                              if str(tag_tuple[0]) not in newer]
+    _insert_many(conn, "current_id3_tags", all_tag_tuples)
+
+
+def _log_changes(conn, layout, fingerprints, change):
+    """Record changes to audio files in the change log.
+
+    This must be called in the same transaction as the changes
+    themselves, so that the log's order is the commit order.  Nothing
+    is recorded in databases without a change log; migrate_schema adds
+    one.
+
+    Args:
+      conn: The database connection.
+      layout: A _Layout describing the database.
+      fingerprints: The fingerprints of the changed audio files.
+      change: One of CHANGE_ADD, CHANGE_UPDATE or CHANGE_DELETE.
+    """
+    if not layout.has_changes:
+        return
+    now = timestamp.now()
+    conn.executemany(
+        "INSERT INTO changes (timestamp, fingerprint, change)"
+        " VALUES (?, ?, ?)",
+        [(now, layout.fingerprint_param(fp), change)
+         for fp in fingerprints])
+
+
+def _decode_tag(mutagen_repr, tag_json):
+    """Turn a row of the id3_tags table back into a mutagen ID3 tag.
+
+    Rows written before the tag_json column existed (or whose tags
+    could not be encoded) fall back to evaluating the old repr().
     """
-    for tag in mutagen_id3.itervalues():
-        tag_tuple = schema.id3_tag_to_tuple(fingerprint, timestamp, tag)
-        _insert(conn, "id3_tags", tag_tuple)
+    if tag_json is not None:
+        return tag_codec.decode(tag_json)
+    return eval(mutagen_repr, mutagen.id3.__dict__, {})
 
 
-def _get_tags(conn, au_file, cutoff_timestamp):
-    """Get the ID3 tags for a particular audio file.
+def _get_tags(conn, layout, au_files, cutoff_timestamp):
+    """Get the ID3 tags for a batch of audio files.
 
     Args:
       conn: The database connection.
-      au_file: The audio file these tags are for.  The fingerprint is read
-        from this object in order to determine which ID3 tags to pull out
-        of the database.  The tags that are found are stored into this
-        object's mutagen_id3 attribute.
+      layout: A _Layout describing the database.
+      au_files: A list of at most _FINGERPRINT_CHUNK_SIZE audio files.
+        The fingerprints are read from these objects in order to
+        determine which ID3 tags to pull out of the database.  The tags
+        that are found are stored into each object's mutagen_id3
+        attribute.
       cutoff_timestamp: Ignore any timestamps from after this timestamp.
 
-    We always populate au_file.mutagen_id3 with the set of tags with the
-    greatest possible timestamp.
+    We always populate each au_file.mutagen_id3 with the set of tags with
+    the greatest possible timestamp.  All of the tags are fetched with a
+    single query, which only needs to look at the full tag history if
+    there is a cutoff_timestamp or no current_id3_tags table.
 
     Returns:
-      True if we found tags for this au_file, False otherwise.
+      True if we found tags for every one of the au_files, False
+      otherwise.
     """
-    sql = ("SELECT timestamp, mutagen_repr FROM id3_tags"
-           " WHERE fingerprint=\"%s\"" % au_file.fingerprint)
+    by_fingerprint = {}
+    for au_file in au_files:
+        au_file.mutagen_id3 = mutagen.id3.ID3()
+        by_fingerprint[au_file.fingerprint] = au_file
+    if not by_fingerprint:
+        return True
+    params = [layout.fingerprint_param(fp) for fp in by_fingerprint]
+    if cutoff_timestamp is None and layout.has_current_tags:
+        sql = ("SELECT fingerprint, mutagen_repr, tag_json"
+               " FROM current_id3_tags WHERE fingerprint IN (%s)"
+               % _in_list(params))
+        return _add_tags(conn.execute(sql, params), by_fingerprint)
+    # Find the greatest timestamp for each file, and then only fetch
+    # the tags with that timestamp.
+    latest_sql = ("SELECT fingerprint, MAX(timestamp) AS max_timestamp"
+                  " FROM id3_tags WHERE fingerprint IN (%s)"
+                  % _in_list(params))
     if cutoff_timestamp is not None:
-        sql += " AND timestamp <= %d" % cutoff_timestamp
-    # Get the tags out in decreasing order, so we always see the
-    # greatest possible timestamp first.
-    sql += " ORDER BY timestamp DESC"
-
-    cursor = conn.execute(sql)
-    au_file.mutagen_id3 = mutagen.id3.ID3()
-    max_timestamp = None
-    while True:
-        item = cursor.fetchone()
-        if item is None:
-            break
-        this_timestamp, this_repr = item
-        # We only want to return tags from a single timestamp.
-        if max_timestamp is None:
-            max_timestamp = this_timestamp
-        elif max_timestamp != this_timestamp:
-            break
-        tag = eval(this_repr, mutagen.id3.__dict__, {})
-        au_file.mutagen_id3.add(tag)
-    # max_timestamp is None if and only if we didn't find any
-    # matching rows.
-    return (max_timestamp is not None)
-
-
-def _audio_file_generator(conn, sql):
-    """Turns a SQL query into a generator of AudioFile objects."""
-    cursor = conn.execute(sql)
+        latest_sql += " AND timestamp <= ?"
+        params.append(cutoff_timestamp)
+    latest_sql += " GROUP BY fingerprint"
+    sql = ("SELECT tags.fingerprint, tags.mutagen_repr, %s"
+           " FROM (%s) AS latest, id3_tags AS tags"
+           " WHERE tags.fingerprint = latest.fingerprint"
+           " AND tags.timestamp = latest.max_timestamp" % (
+            "tags.tag_json" if layout.has_tag_json else "NULL", latest_sql))
+    return _add_tags(conn.execute(sql, params), by_fingerprint)
+
+
+def _add_tags(cursor, by_fingerprint):
+    """Add tags read from the database to audio files.
+
+    Args:
+      cursor: Yields (fingerprint, mutagen_repr, tag_json) tuples.
+      by_fingerprint: A dict mapping fingerprints to AudioFile objects.
+
+    Returns:
+      True if we found tags for every one of the audio files, False
+      otherwise.
+    """
+    found = set()
+    for this_fingerprint, this_repr, this_json in cursor:
+        this_fingerprint = schema.fingerprint_from_db(this_fingerprint)
+        by_fingerprint[this_fingerprint].mutagen_id3.add(
+            _decode_tag(this_repr, this_json))
+        found.add(this_fingerprint)
+    return len(found) == len(by_fingerprint)
+
+
+def _audio_file_generator(conn, sql, params=()):
+    """Turns a SQL query into a generator of AudioFile objects.
+
+    Audio files are read in pages, and the tags for each page are
+    fetched together.
+    """
+    layout = _Layout(conn)
+    cursor = conn.execute(sql, params)
     while True:
-        au_file_tuple = cursor.fetchone()
-        if au_file_tuple is None:
+        page = [schema.tuple_to_audio_file(au_file_tuple)
+                for au_file_tuple in cursor.fetchmany(_FINGERPRINT_CHUNK_SIZE)]
+        if not page:
             return
-        au_file = schema.tuple_to_audio_file(au_file_tuple)
-        assert _get_tags(conn, au_file, None)
-        yield au_file
+        assert _get_tags(conn, layout, page, None)
+        for au_file in page:
+            yield au_file
+
+
+def _begin_write(conn):
+    """Start a write transaction, and find out how to write.
+
+    The database's layout is only checked once we hold the write lock,
+    so that it cannot be migrated out from under us.  The connection is
+    switched to manage its transactions explicitly: otherwise the
+    sqlite3 module would commit (and so give up the lock) before the
+    PRAGMA statements that _Layout runs.  conn.commit() and
+    conn.rollback() still end the transaction as usual.
+
+    Returns:
+      A _Layout object.
+    """
+    conn.isolation_level = None
+    conn.execute("BEGIN IMMEDIATE")
+    return _Layout(conn)
+
+
+def _fill_current_tags(conn, layout):
+    """Create and populate the current_id3_tags table.
+
+    Any existing current_id3_tags table must already have been dropped.
+
+    Args:
+      conn: The database connection, inside a transaction.
+      layout: A _Layout describing the id3_tags table.
+    """
+    if layout.version >= 2:
+        conn.execute(schema.create_id3_tags_table_v2 % "current_id3_tags")
+        columns = "tags.*"
+    else:
+        conn.execute(schema.create_current_id3_tags_table)
+        conn.execute(schema.create_current_id3_tags_index)
+        columns = ("tags.fingerprint, tags.timestamp, tags.frame_id,"
+                   " tags.value, tags.mutagen_repr, %s" % (
+                "tags.tag_json" if layout.has_tag_json else "NULL"))
+    conn.execute(
+        "INSERT INTO current_id3_tags SELECT %s"
+        " FROM (SELECT fingerprint, MAX(timestamp) AS max_timestamp"
+        "       FROM id3_tags GROUP BY fingerprint) AS latest,"
+        " id3_tags AS tags"
+        " WHERE tags.fingerprint = latest.fingerprint"
+        " AND tags.timestamp = latest.max_timestamp" % columns)
+
+
+def _copy_to_v2(conn, layout, table_name, last_rowid, batch_size):
+    """Copy a batch of rows from a version 1 table to its version 2 copy.
+
+    The version 2 copy of a table is named with a "_v2" suffix.  Rows
+    are copied in rowid order; the rowid of each id3_tags row becomes
+    its seq.
+
+    Args:
+      conn: The database connection.
+      layout: The _Layout of the version 1 tables.
+      table_name: Either "audio_files" or "id3_tags".
+      last_rowid: Only copy rows after this one.
+      batch_size: The maximum number of rows to copy.
+
+    Returns:
+      A (last rowid, number of rows) tuple describing the rows that
+      were copied.  If there were no rows to copy, the last rowid is
+      None.
+    """
+    if table_name == "audio_files":
+        rows = conn.execute(
+            "SELECT rowid, * FROM audio_files WHERE rowid > ?"
+            " ORDER BY rowid LIMIT ?", (last_rowid, batch_size)).fetchall()
+        all_insert_tuples = [
+            schema.audio_file_to_tuple(schema.tuple_to_audio_file(row[1:]),
+                                       schema_version=2)
+            for row in rows]
+    else:
+        rows = conn.execute(
+            "SELECT rowid, fingerprint, timestamp, frame_id, value,"
+            " mutagen_repr, %s FROM id3_tags WHERE rowid > ?"
+            " ORDER BY rowid LIMIT ?" % (
+                "tag_json" if layout.has_tag_json else "NULL"),
+            (last_rowid, batch_size)).fetchall()
+        all_insert_tuples = []
+        for row in rows:
+            rowid, tag_tuple = row[0], list(row[1:])
+            tag_tuple[0] = schema.fingerprint_from_db(tag_tuple[0])
+            if tag_tuple[5] is None:
+                tag_tuple[5] = tag_codec.encode(
+                    eval(tag_tuple[4], mutagen.id3.__dict__, {}))
+            all_insert_tuples.append(
+                schema.tag_tuple_to_v2(tuple(tag_tuple), rowid))
+    if not rows:
+        return None, 0
+    # Replace rather than insert, since an interrupted migration may
+    # have already copied some of these rows.
+    conn.executemany(
+        "INSERT OR REPLACE INTO %s_v2 VALUES (%s)" % (
+            table_name, _in_list(all_insert_tuples[0])),
+        all_insert_tuples)
+    return rows[-1][0], len(rows)
 
 
 class Database(object):
@@ -122,30 +508,111 @@ class Database(object):
 
         Args:
           name: A string identifying the database to connect to.
+
+        Nothing is written to the database here.  Each thread that
+        reads from the database gets its own read-only connection, which
+        is held open until close() is called.  Database objects can also
+        be used as context managers, which close those connections on
+        exit.
         """
         self._name = name
-        # All database reads use this shared connection.  Each transaction
-        # writes via its own private connection.
-        self._shared_conn = self._get_connection()
+        # All database reads use per-thread read connections.  Each
+        # transaction writes via its own private connection.
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        self._closed = False
+        # An optional BloomFilter holding every fingerprint in the library.
+        self._fingerprint_filter = None
+
+    def __enter__(self):
+        return self
 
-    def _get_connection(self):
-        """Construct a new database connection."""
-        return sqlite3.connect(self._name)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_connection(self, bulk=False, wal=True):
+        """Construct a new database connection for writing.
+
+        Args:
+          bulk: If True, the connection will be used for a large write.
+            Commits on it are not synced to disk immediately; in WAL
+            mode the database stays consistent if we crash, but the
+            most recent transactions might be lost.
+          wal: If True, put the database into WAL mode, so that readers
+            never wait for writers (or vice versa), and so that several
+            processes can safely share the same catalog.  The setting
+            is stored in the database, so this only does any work the
+            first time we write to a catalog that is not yet in WAL
+            mode.
+        """
+        conn = sqlite3.connect(self._name, timeout=_BUSY_TIMEOUT_SECONDS)
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if wal:
+            conn.execute("PRAGMA journal_mode=WAL")
+        if bulk:
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _get_read_connection(self):
+        """Returns the calling thread's read-only connection."""
+        if self._closed:
+            raise sqlite3.ProgrammingError(
+                "Cannot operate on a closed database.")
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # close() may be called from any thread, so we can't let the
+            # sqlite3 module insist on the creating thread.
+            conn = sqlite3.connect(self._name, timeout=_BUSY_TIMEOUT_SECONDS,
+                                   check_same_thread=False)
+            for pragma in _CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            conn.execute("PRAGMA query_only=ON")
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close all of the database's read connections.
+
+        The Database object cannot be used for reads after this is
+        called.  It is safe to call close() more than once.
+        """
+        self._closed = True
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns = []
 
     def create_tables(self):
         """Create a new set of database tables.
 
+        The database is put into WAL mode once the tables exist.
+
         Returns:
           True if the operation succeeds, False otherwise.
         """
-        conn = self._get_connection()
+        conn = self._get_connection(wal=False)
         try:
-            conn.execute(schema.create_audio_files_table)
-            conn.execute(schema.create_audio_files_index)
-            conn.execute(schema.create_id3_tags_table)
-            conn.execute(schema.create_id3_tags_index)
+            # This only has an effect on a brand new database, and so
+            # must come before any tables are created or the database
+            # is put into WAL mode.  See reclaim_space.
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute(schema.create_audio_files_table_v2 % "audio_files")
+            conn.execute(schema.create_id3_tags_table_v2 % "id3_tags")
+            conn.execute(
+                schema.create_id3_tags_table_v2 % "current_id3_tags")
+            conn.execute(schema.create_changes_table)
+            for sql in schema.create_audio_files_access_indexes:
+                conn.execute(sql)
+            conn.execute("PRAGMA user_version=%d" % schema.SCHEMA_VERSION)
+            conn.execute("PRAGMA journal_mode=WAL")
         except sqlite3.OperationalError, ex:
             return False
+        finally:
+            conn.close()
         return True
 
     def get_all(self):
@@ -156,13 +623,13 @@ class Database(object):
         """
         sql = ("SELECT * FROM audio_files"
                " ORDER BY import_timestamp desc, album_id")
-        return _audio_file_generator(self._shared_conn, sql)
+        return _audio_file_generator(self._get_read_connection(), sql)
 
     def get_all_imports(self):
         """Returns all volume/import timestamp pairs."""
         sql = ("SELECT DISTINCT volume, import_timestamp FROM audio_files"
                " ORDER BY import_timestamp")
-        cursor = self._shared_conn.execute(sql)
+        cursor = self._get_read_connection().execute(sql)
         while True:
             this_tuple = cursor.fetchone()
             if this_tuple is None:
@@ -175,7 +642,7 @@ class Database(object):
                " WHERE volume=\"%d\""
                " AND import_timestamp=\"%d\""
                " ORDER BY album_id") % (vol, import_timestamp)
-        return _audio_file_generator(self._shared_conn, sql)
+        return _audio_file_generator(self._get_read_connection(), sql)
 
     def get_by_fingerprint(self, fingerprint):
         """Find an audio file by it's fingerprint.
@@ -187,12 +654,111 @@ class Database(object):
           An AudioFile object, or None if there is no file with the
           specified fingerprint.
         """
-        sql = ("SELECT * FROM audio_files "
-               " WHERE fingerprint=\"%s\"" % fingerprint)
-        for au_file in _audio_file_generator(self._shared_conn, sql):
+        sql = "SELECT * FROM audio_files WHERE fingerprint=?"
+        conn = self._get_read_connection()
+        params = (_Layout(conn).fingerprint_param(fingerprint),)
+        for au_file in _audio_file_generator(conn, sql, params):
             return au_file
         return None
 
+    def get_existing_fingerprints(self, fingerprints):
+        """Find out which of a collection of fingerprints are in the library.
+
+        This is much cheaper than calling get_by_fingerprint on each one,
+        since no tags are fetched and the lookups are batched.  If the
+        fingerprint prefilter has been built (see
+        rebuild_fingerprint_filter), fingerprints that it rules out never
+        reach the database at all.
+
+        Args:
+          fingerprints: An iterable of fingerprints.
+
+        Returns:
+          The set of those fingerprints that belong to an audio file in
+          the library.
+        """
+        candidates = set(fingerprints)
+        if self._fingerprint_filter is not None:
+            candidates = set(fp for fp in candidates
+                             if fp in self._fingerprint_filter)
+        conn = self._get_read_connection()
+        layout = _Layout(conn)
+        candidates = sorted(layout.fingerprint_param(fp) for fp in candidates)
+        found = set()
+        for i in xrange(0, len(candidates), _FINGERPRINT_CHUNK_SIZE):
+            chunk = candidates[i:i + _FINGERPRINT_CHUNK_SIZE]
+            sql = ("SELECT fingerprint FROM audio_files"
+                   " WHERE fingerprint IN (%s)" % _in_list(chunk))
+            found.update(schema.fingerprint_from_db(row[0])
+                         for row in conn.execute(sql, chunk))
+        return found
+
+    def get_rows_by_fingerprint(self, table_name, fingerprints):
+        """Returns the raw rows of a table that belong to some audio files.
+
+        This is meant for tools that show people exactly what is stored
+        in the library, whatever the schema version.
+
+        Args:
+          table_name: One of "audio_files", "id3_tags" or
+            "current_id3_tags".
+          fingerprints: A sequence of fingerprints.
+
+        Returns:
+          A list of sqlite3.Row objects, whose fingerprint columns hold
+          hex strings, as they do in version 1 schemas.
+        """
+        if table_name not in _FINGERPRINT_TABLES:
+            raise ValueError("Unknown table: %s" % table_name)
+        conn = self._get_read_connection()
+        layout = _Layout(conn)
+        columns = "*"
+        if layout.version >= 2:
+            columns = ", ".join(
+                "lower(hex(fingerprint)) AS fingerprint"
+                if row[1] == "fingerprint" else row[1]
+                for row in conn.execute("PRAGMA table_info(%s)" % table_name))
+        params = [layout.fingerprint_param(fp) for fp in fingerprints]
+        rows = []
+        for i in xrange(0, len(params), _FINGERPRINT_CHUNK_SIZE):
+            chunk = params[i:i + _FINGERPRINT_CHUNK_SIZE]
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute("SELECT %s FROM %s WHERE fingerprint IN (%s)" % (
+                    columns, table_name, _in_list(chunk)), chunk)
+            rows.extend(cursor.fetchall())
+        return rows
+
+    def rebuild_fingerprint_filter(
+        self, error_rate=_FINGERPRINT_FILTER_ERROR_RATE):
+        """(Re)build the in-memory prefilter of library fingerprints.
+
+        The filter is kept up to date as files are added through this
+        Database object, but it must be rebuilt to see files added by
+        anyone else.
+
+        Args:
+          error_rate: The filter's false positive rate.  False positives
+            just cost an extra database lookup.
+
+        Returns:
+          The number of fingerprints in the filter.
+        """
+        conn = self._get_read_connection()
+        count = conn.execute(
+            "SELECT COUNT(*) FROM audio_files").fetchone()[0]
+        # Leave room for the files we are likely to add.
+        fp_filter = bloom.BloomFilter(int(count * 1.25) + 10000, error_rate)
+        for (fingerprint,) in conn.execute(
+            "SELECT fingerprint FROM audio_files"):
+            fp_filter.add(schema.fingerprint_from_db(fingerprint))
+        self._fingerprint_filter = fp_filter
+        return len(fp_filter)
+
+    def drop_fingerprint_filter(self):
+        """Stop using the fingerprint prefilter, and free its memory."""
+        self._fingerprint_filter = None
+
     def begin_add(self, volume, import_timestamp):
         """Begin a new transaction for adding files to the database.
 
@@ -205,22 +771,521 @@ class Database(object):
         Returns:
           An _AddTransaction object.
         """
-        conn = self._get_connection()
-        return _AddTransaction(volume, import_timestamp, conn)
+        conn = self._get_connection(bulk=True)
+        return _AddTransaction(volume, import_timestamp, conn, self)
 
     def update(self, au_file, timestamp):
+        """Write a single audio file's updated ID3 tags into the database.
+
+        Args:
+          au_file: An AudioFile object.  Its current mutagen_id3 tags
+            are stored under the given timestamp.
+          timestamp: The timestamp for the new tags.
+        """
+        self.update_many([au_file], timestamp)
+
+    def update_many(self, all_au_files, timestamp):
+        """Write many audio files' updated ID3 tags into the database.
+
+        All of the tags are written in a single transaction, so this is
+        much faster than calling update() on each file.
+
+        Args:
+          all_au_files: A sequence of AudioFile objects.
+          timestamp: The timestamp for the new tags.
+        """
+        conn = self._get_connection(bulk=True)
+        try:
+            layout = _begin_write(conn)
+            _insert_tags(conn, layout, timestamp, all_au_files)
+            _log_changes(conn, layout, [au.fingerprint for au in all_au_files],
+                         CHANGE_UPDATE)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def delete_audio_files(self, fingerprints):
+        """Remove audio files and all of their ID3 tags from the library.
+
+        Everything is deleted in a single transaction, which also
+        records the deletions in the change log.
+
+        Args:
+          fingerprints: The fingerprints of the audio files to delete.
+
+        Returns:
+          The set of fingerprints that were deleted.  Any others were
+          not in the library.
+        """
+        deleted = []
+        conn = self._get_connection()
+        try:
+            layout = _begin_write(conn)
+            for fingerprint in sorted(set(fingerprints)):
+                params = (layout.fingerprint_param(fingerprint),)
+                conn.execute(
+                    "DELETE FROM id3_tags WHERE fingerprint=?", params)
+                if layout.has_current_tags:
+                    conn.execute(
+                        "DELETE FROM current_id3_tags WHERE fingerprint=?",
+                        params)
+                if conn.execute(
+                    "DELETE FROM audio_files WHERE fingerprint=?",
+                    params).rowcount:
+                    deleted.append(fingerprint)
+            _log_changes(conn, layout, deleted, CHANGE_DELETE)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return set(deleted)
+
+    def _get_change_log_connection(self):
+        """Returns a read connection to a database with a change log.
+
+        Databases created before the change log was added only get one
+        when they are converted by migrate_schema (see
+        do_migrate_schema.py); until then, nothing that is written to
+        them is logged.
+        """
+        conn = self._get_read_connection()
+        if not _Layout(conn).has_changes:
+            raise NoChangeLogError(
+                "%s has no change log; run do_migrate_schema.py to add one"
+                % self._name)
+        return conn
+
+    def changes_since(self, cursor, limit=_CHANGE_BATCH_SIZE):
+        """Find the audio files that have changed since a cursor.
+
+        To follow the library, start with a cursor of 0 (or with the
+        value of current_change_cursor), and pass the returned cursor
+        into the next call.  An empty list of changes means that the
+        caller is caught up.
+
+        Args:
+          cursor: 0 to start at the beginning of the change log, or a
+            cursor returned by an earlier call.
+          limit: The most change log entries to read in this call.
+
+        Returns:
+          A (cursor, changes) tuple.  changes is a list of
+          (fingerprint, change) tuples in commit order, where change is
+          one of CHANGE_ADD, CHANGE_UPDATE or CHANGE_DELETE.  A file
+          that changed more than once only appears once, at the
+          position of (and with the kind of) its most recent change.
+
+        Raises:
+          NoChangeLogError: The database does not have a change log.
+        """
+        rows = self._get_change_log_connection().execute(
+            "SELECT seq, fingerprint, change FROM changes"
+            " WHERE seq > ? ORDER BY seq LIMIT ?",
+            (cursor, limit)).fetchall()
+        if not rows:
+            return cursor, []
+        latest = {}
+        for seq, fingerprint, change in rows:
+            latest[schema.fingerprint_from_db(fingerprint)] = (seq, change)
+        changes = sorted(latest.iteritems(), key=lambda item: item[1][0])
+        return rows[-1][0], [(fp, change) for fp, (_, change) in changes]
+
+    def current_change_cursor(self):
+        """Returns a cursor for the end of the change log.
+
+        Passing this to changes_since returns only changes that are
+        committed after this is called.
+
+        Raises:
+          NoChangeLogError: The database does not have a change log.
+        """
+        seq = self._get_change_log_connection().execute(
+            "SELECT MAX(seq) FROM changes").fetchone()[0]
+        return seq or 0
+
+    def analyze(self):
+        """Refresh the statistics that sqlite uses to plan queries.
+
+        Any missing indexes are created first.  This should be run
+        after large changes to the library, such as an import.
+        """
+        conn = self._get_connection(bulk=True)
+        try:
+            for sql in schema.create_audio_files_access_indexes:
+                conn.execute(sql)
+            conn.execute("PRAGMA analysis_limit=%d" % _ANALYSIS_LIMIT)
+            conn.execute("ANALYZE")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def compact_tags(self, keep, archive_name=None,
+                     batch_size=_FINGERPRINT_CHUNK_SIZE):
+        """Drop old ID3 tags from the tag history.
+
+        Only the tags with the keep greatest timestamps are kept for
+        each audio file.  The tags of files that are no longer in the
+        library are dropped altogether, from both the id3_tags and
+        current_id3_tags tables.  Files are processed in batches that
+        are each committed separately, so the library remains usable
+        while this runs, and it can be interrupted and run again.  Each
+        batch holds the write lock from the moment it decides which tags
+        to drop until they are gone, so concurrent imports and updates
+        simply wait for it.
+
+        Args:
+          keep: The number of sets of tags to keep for each file.  This
+            must be at least 1, so that every file keeps its current
+            tags.
+          archive_name: If not None, the path of a sqlite database into
+            which every dropped id3_tags row is copied before it is
+            deleted.  It is given an id3_tags table with the same
+            columns as ours.
+          batch_size: The number of files to compact in each
+            transaction.
+
+        Yields:
+          A (files, old, orphaned) tuple after each batch, giving the
+          running count of files checked, of rows dropped because they
+          were too old, and of rows dropped because their file is no
+          longer in the library.
+
+        Raises:
+          ValueError: if keep is less than 1.
+        """
+        if keep < 1:
+            raise ValueError("Must keep at least one set of tags")
+        conn = self._get_connection(bulk=True)
+        archive_conn = None
+        try:
+            if archive_name is not None:
+                archive_conn = sqlite3.connect(
+                    archive_name, timeout=_BUSY_TIMEOUT_SECONDS)
+                create_sql = conn.execute(
+                    "SELECT sql FROM sqlite_master"
+                    " WHERE type='table' AND name='id3_tags'").fetchone()[0]
+                archive_conn.execute(create_sql.replace(
+                        "CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+                archive_conn.commit()
+            num_files = num_old = num_orphaned = 0
+            last_fingerprint = None
+            while True:
+                layout = _begin_write(conn)
+                try:
+                    sql = "SELECT DISTINCT fingerprint FROM id3_tags"
+                    params = []
+                    if last_fingerprint is not None:
+                        sql += " WHERE fingerprint > ?"
+                        params.append(last_fingerprint)
+                    sql += " ORDER BY fingerprint LIMIT ?"
+                    chunk = [fp for (fp,) in
+                             conn.execute(sql, params + [batch_size])]
+                    if not chunk:
+                        conn.commit()
+                        break
+                    last_fingerprint = chunk[-1]
+                    in_list = _in_list(chunk)
+                    existing = set(str(fp) for (fp,) in conn.execute(
+                            "SELECT fingerprint FROM audio_files"
+                            " WHERE fingerprint IN (%s)" % in_list, chunk))
+                    all_timestamps = {}
+                    for fp, ts in conn.execute(
+                        "SELECT fingerprint, timestamp FROM id3_tags"
+                        " WHERE fingerprint IN (%s)"
+                        " GROUP BY fingerprint, timestamp" % in_list, chunk):
+                        all_timestamps.setdefault(str(fp), []).append(ts)
+                    archived = []
+                    for fp in chunk:
+                        if str(fp) in existing:
+                            timestamps = sorted(all_timestamps[str(fp)],
+                                                reverse=True)
+                            if len(timestamps) <= keep:
+                                continue
+                            where = "fingerprint=? AND timestamp<?"
+                            params = (fp, timestamps[keep - 1])
+                        else:
+                            where = "fingerprint=?"
+                            params = (fp,)
+                        if archive_conn is not None:
+                            archived.extend(conn.execute(
+                                    "SELECT * FROM id3_tags WHERE " + where,
+                                    params))
+                        num_rows = conn.execute(
+                            "DELETE FROM id3_tags WHERE " + where,
+                            params).rowcount
+                        if str(fp) in existing:
+                            num_old += num_rows
+                        else:
+                            num_orphaned += num_rows
+                            if layout.has_current_tags:
+                                conn.execute(
+                                    "DELETE FROM current_id3_tags"
+                                    " WHERE fingerprint=?", (fp,))
+                    # Make sure that the archive has everything before
+                    # we actually drop anything.
+                    if archived:
+                        _insert_many(archive_conn, "id3_tags", archived)
+                        archive_conn.commit()
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                num_files += len(chunk)
+                yield num_files, num_old, num_orphaned
+        finally:
+            conn.close()
+            if archive_conn is not None:
+                archive_conn.close()
+
+    def reclaim_space(self):
+        """Return unused space in the database file to the filesystem.
+
+        New databases use incremental auto-vacuum, so this only needs to
+        release their free pages, which is quick.  An older database is
+        switched over by running a full VACUUM, which rewrites the whole
+        file and blocks writers until it is done; that only happens the
+        first time this is called.
+        """
         conn = self._get_connection()
-        _insert_tags(conn, au_file.fingerprint, timestamp, au_file.mutagen_id3)
-        conn.commit()
+        try:
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if auto_vacuum == _AUTO_VACUUM_INCREMENTAL:
+                conn.execute("PRAGMA incremental_vacuum").fetchall()
+            else:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            # The file only shrinks once the WAL has been copied back
+            # into it.
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        finally:
+            conn.close()
+
+    def rebuild_current_tags(self):
+        """Regenerate the current_id3_tags table from the tag history.
+
+        The table is created if it does not already exist.  This is
+        needed after upgrading an older database, or if anything other
+        than this module has written to the id3_tags table.  The rebuild
+        happens in a single transaction, so readers never see a
+        partially-built table.
+
+        Returns:
+          The number of rows in the new current_id3_tags table.
+        """
+        conn = self._get_connection(bulk=True)
+        # Manage the transaction ourselves: otherwise the sqlite3 module
+        # would commit before each of the DROP and CREATE statements.
+        conn.isolation_level = None
+        try:
+            layout = _begin_write(conn)
+            conn.execute("DROP TABLE IF EXISTS current_id3_tags")
+            _fill_current_tags(conn, layout)
+            count = conn.execute(
+                "SELECT COUNT(*) FROM current_id3_tags").fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return count
+
+    def migrate_tag_encoding(self, batch_size=1000):
+        """Convert stored ID3 tags to the structured tag_json format.
+
+        The tag_json column is added to the id3_tags table if necessary,
+        and then filled in for existing rows of both the id3_tags and
+        current_id3_tags tables, in batches of rows.  Each
+        batch is committed separately, so the library remains usable
+        while this runs, and an interrupted migration can simply be
+        started again.  Until a row has been converted, reads fall back
+        to its mutagen_repr column.
+
+        Databases using schema version 2 always store tag_json, so
+        there is nothing to do for them.
+
+        Args:
+          batch_size: The number of rows to convert in each transaction.
+
+        Yields:
+          A (converted, skipped) tuple after each batch, giving the
+          running count of rows that were converted and of rows whose
+          tags cannot be encoded (which keep using mutagen_repr).
+        """
+        conn = self._get_connection(bulk=True)
+        try:
+            if _Layout(conn).version >= 2:
+                return
+            if not _has_tag_json(conn):
+                conn.execute("ALTER TABLE id3_tags ADD COLUMN tag_json TEXT")
+                conn.commit()
+            all_table_names = ["id3_tags"]
+            if _has_table(conn, "current_id3_tags"):
+                all_table_names.append("current_id3_tags")
+            converted = skipped = 0
+            for table_name in all_table_names:
+                last_rowid = -1
+                while True:
+                    rows = conn.execute(
+                        "SELECT rowid, mutagen_repr FROM %s"
+                        " WHERE rowid > ? AND tag_json IS NULL"
+                        " ORDER BY rowid LIMIT ?" % table_name,
+                        (last_rowid, batch_size)).fetchall()
+                    if not rows:
+                        break
+                    updates = []
+                    for rowid, mutagen_repr in rows:
+                        tag_json = tag_codec.encode(
+                            eval(mutagen_repr, mutagen.id3.__dict__, {}))
+                        if tag_json is None:
+                            skipped += 1
+                        else:
+                            updates.append((tag_json, rowid))
+                    conn.executemany(
+                        "UPDATE %s SET tag_json=? WHERE rowid=?" % table_name,
+                        updates)
+                    conn.commit()
+                    converted += len(updates)
+                    last_rowid = rows[-1][0]
+                    yield converted, skipped
+        finally:
+            conn.close()
+
+    def migrate_schema(self, batch_size=5000, vacuum=True):
+        """Convert the database to the current schema version.
+
+        New copies of the audio_files and id3_tags tables are built
+        alongside the old ones, in batches of rows that are each
+        committed separately, so the library remains usable while this
+        runs.  Then, in a single short transaction, anything written
+        in the meantime is copied over, the old tables are replaced by
+        the new ones, and current_id3_tags is rebuilt.  An interrupted
+        migration can simply be started again.
+
+        The database is also given a change log, if it does not already
+        have one.  That is all that is done to a database that already
+        uses the current schema version.
+
+        Args:
+          batch_size: The number of rows to copy in each transaction.
+          vacuum: If True, finish by running VACUUM to return the space
+            used by the old tables to the filesystem.
+
+        Yields:
+          A (table name, rows copied) tuple after each batch, and a
+          ("current_id3_tags", rows) tuple once the migration is
+          complete.
+        """
+        conn = self._get_connection(bulk=True)
+        try:
+            conn.execute(schema.create_changes_table)
+            conn.commit()
+            layout = _Layout(conn)
+            if layout.version >= schema.SCHEMA_VERSION:
+                return
+            if not _has_table(conn, "audio_files_v2"):
+                conn.execute(
+                    schema.create_audio_files_table_v2 % "audio_files_v2")
+            if not _has_table(conn, "id3_tags_v2"):
+                conn.execute(schema.create_id3_tags_table_v2 % "id3_tags_v2")
+            conn.commit()
+            # Pick up where an interrupted migration left off.
+            last_rowids = {
+                "audio_files": -1,
+                "id3_tags": conn.execute(
+                    "SELECT MAX(seq) FROM id3_tags_v2").fetchone()[0],
+                }
+            if last_rowids["id3_tags"] is None:
+                last_rowids["id3_tags"] = -1
+            for table_name in ("audio_files", "id3_tags"):
+                copied = 0
+                while True:
+                    last_rowid, num_rows = _copy_to_v2(
+                        conn, layout, table_name, last_rowids[table_name],
+                        batch_size)
+                    conn.commit()
+                    if not num_rows:
+                        break
+                    copied += num_rows
+                    last_rowids[table_name] = last_rowid
+                    yield table_name, copied
+
+            # Manage the final transaction ourselves, since the sqlite3
+            # module would otherwise commit before each DDL statement.
+            conn.isolation_level = None
+            layout = _begin_write(conn)
+            try:
+                # Copy anything that was written since the last batch.
+                for table_name in ("audio_files", "id3_tags"):
+                    while True:
+                        last_rowid, num_rows = _copy_to_v2(
+                            conn, layout, table_name,
+                            last_rowids[table_name], batch_size)
+                        if not num_rows:
+                            break
+                        last_rowids[table_name] = last_rowid
+                # Forget any files that were deleted during the copy.
+                remaining = set(
+                    schema.fingerprint_from_db(fp) for (fp,) in
+                    conn.execute("SELECT fingerprint FROM audio_files"))
+                deleted = [
+                    fp for (fp,) in
+                    conn.execute("SELECT fingerprint FROM audio_files_v2")
+                    if schema.fingerprint_from_db(fp) not in remaining]
+                for i in xrange(0, len(deleted), _FINGERPRINT_CHUNK_SIZE):
+                    chunk = deleted[i:i + _FINGERPRINT_CHUNK_SIZE]
+                    for table_name in ("audio_files_v2", "id3_tags_v2"):
+                        conn.execute(
+                            "DELETE FROM %s WHERE fingerprint IN (%s)" % (
+                                table_name, _in_list(chunk)),
+                            chunk)
+                conn.execute("DROP TABLE IF EXISTS current_id3_tags")
+                for table_name in ("audio_files", "id3_tags"):
+                    conn.execute("DROP TABLE %s" % table_name)
+                    conn.execute("ALTER TABLE %s_v2 RENAME TO %s" % (
+                            table_name, table_name))
+                for sql in schema.create_audio_files_access_indexes:
+                    conn.execute(sql)
+                conn.execute("PRAGMA user_version=%d" % schema.SCHEMA_VERSION)
+                layout = _Layout(conn)
+                _fill_current_tags(conn, layout)
+                count = conn.execute(
+                    "SELECT COUNT(*) FROM current_id3_tags").fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if vacuum:
+                conn.execute("VACUUM")
+            yield "current_id3_tags", count
+        finally:
+            conn.close()
 
 
 class _AddTransaction(object):
-    """Encapsulates a database transaction."""
+    """Encapsulates a database transaction.
 
-    def __init__(self, volume, import_timestamp, conn):
+    New rows are held in memory and written with a single executemany
+    per table by flush(), which commit() calls.
+    """
+
+    def __init__(self, volume, import_timestamp, conn, db=None):
         self._volume = volume
         self._import_timestamp = import_timestamp
         self._conn = conn
+        self._db = db
+        self._added_fingerprints = []
+        # The files that have been added but not yet written, and their
+        # audio_files rows.
+        self._pending_au_files = []
+        self._pending_tuples = []
+        # We don't take the write lock until the first add().
+        self._layout = None
 
     def add(self, au_file):
         """Add a new audio file to the transaction.
@@ -241,10 +1306,31 @@ class _AddTransaction(object):
             assert au_file.import_timestamp == self._import_timestamp
         au_file.import_timestamp = self._import_timestamp
 
-        _insert(self._conn, "audio_files", schema.audio_file_to_tuple(au_file))
-        _insert_tags(self._conn,
-                     au_file.fingerprint, au_file.import_timestamp,
-                     au_file.mutagen_id3)
+        if self._layout is None:
+            self._layout = _begin_write(self._conn)
+        self._pending_au_files.append(au_file)
+        self._pending_tuples.append(
+            schema.audio_file_to_tuple(au_file, self._layout.version))
+
+    def flush(self):
+        """Write the files added so far into the transaction.
+
+        Errors in the new rows, such as a fingerprint that is already
+        in the library, are raised here.  Nothing is visible to anyone
+        else until commit() is called.
+
+        It is an error to call flush() after either commit() or revert().
+        """
+        assert self._conn is not None
+        if not self._pending_au_files:
+            return
+        _insert_many(self._conn, "audio_files", self._pending_tuples)
+        _insert_tags(self._conn, self._layout, self._import_timestamp,
+                     self._pending_au_files, new_files=True)
+        self._added_fingerprints.extend(
+            au_file.fingerprint for au_file in self._pending_au_files)
+        self._pending_au_files = []
+        self._pending_tuples = []
 
     def commit(self):
         """Commit the transaction.
@@ -252,9 +1338,17 @@ class _AddTransaction(object):
         This method may be called at most once.  It is an error to
         call commit() after calling revert().
         """
-        assert self._conn is not None
+        self.flush()
+        if self._layout is not None:
+            _log_changes(self._conn, self._layout, self._added_fingerprints,
+                         CHANGE_ADD)
         self._conn.commit()
+        self._conn.close()
         self._conn = None
+        # Keep the database's fingerprint prefilter up to date.
+        if self._db is not None and self._db._fingerprint_filter is not None:
+            for fingerprint in self._added_fingerprints:
+                self._db._fingerprint_filter.add(fingerprint)
 
     def revert(self):
         """Revert the transaction.
@@ -263,5 +1357,8 @@ class _AddTransaction(object):
         revert() after calling commit().
         """
         assert self._conn is not None
+        self._pending_au_files = []
+        self._pending_tuples = []
         self._conn.rollback()
+        self._conn.close()
         self._conn = None
@@ -1,12 +1,16 @@
 
 import os
+import sqlite3
+import threading
 import time
 import unittest
 
+import mock
 import mutagen.id3
 
 from chirp.library import audio_file_test
 from chirp.library import database
+from chirp.library import schema
 
 TEST_DB_NAME_PATTERN = "/tmp/chirp-library-db_test.%d.sqlite"
 
@@ -17,7 +21,10 @@ class DatabaseTest(unittest.TestCase):
         self.db = database.Database(self.name)
 
     def tearDown(self):
-        os.unlink(self.name)
+        self.db.close()
+        for suffix in ("", "-wal", "-shm", ".archive"):
+            if os.path.exists(self.name + suffix):
+                os.unlink(self.name + suffix)
 
     def assert_same_audio_files(self, seq_a, seq_b):
         def _make_dict(seq):
@@ -37,6 +44,41 @@ class DatabaseTest(unittest.TestCase):
         self.assertFalse(self.db.create_tables())
         # Should start out empty.
         self.assertEqual([], list(self.db.get_all()))
+        conn = self.db._get_connection()
+        self.assertEqual("wal", conn.execute(
+                "PRAGMA journal_mode").fetchone()[0])
+        conn.close()
+
+    def test_constructor_does_not_write(self):
+        # Nothing is created.
+        self.assertFalse(os.path.exists(self.name))
+        # An existing database is left alone, even when it is used.
+        conn = sqlite3.connect(self.name)
+        conn.execute(schema.create_audio_files_table)
+        conn.execute(schema.create_id3_tags_table)
+        conn.commit()
+        db = database.Database(self.name)
+        self.assertEqual([], list(db.get_all()))
+        self.assertEqual("delete", conn.execute(
+                "PRAGMA journal_mode").fetchone()[0])
+        # Writing switches the database to WAL mode, but leaves the
+        # schema alone.
+        au_file = audio_file_test.get_test_audio_file(1)
+        au_file.volume = None
+        au_file.import_timestamp = None
+        add_txn = db.begin_add(17, 1230959520)
+        add_txn.add(au_file)
+        add_txn.commit()
+        db.close()
+        conn.close()
+        conn = sqlite3.connect(self.name)
+        self.assertEqual("wal", conn.execute(
+                "PRAGMA journal_mode").fetchone()[0])
+        self.assertEqual(
+            [("audio_files",), ("id3_tags",)],
+            conn.execute("SELECT name FROM sqlite_master"
+                         " WHERE type='table' ORDER BY name").fetchall())
+        conn.close()
 
     def test_add(self):
         all_au_files = [audio_file_test.get_test_audio_file(i)
@@ -96,6 +138,91 @@ class DatabaseTest(unittest.TestCase):
             fetched_au_file = self.db.get_by_fingerprint(au_file.fingerprint)
             self.assertEqual(au_file, fetched_au_file)
 
+    def test_add_batches_rows(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(20)]
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+        add_txn = self.db.begin_add(17, 1230959520)
+        with mock.patch.object(database, "_insert_many",
+                               wraps=database._insert_many) as insert_many:
+            for au_file in all_au_files:
+                add_txn.add(au_file)
+            self.assertFalse(insert_many.called)
+            add_txn.commit()
+        # One call per table, however many files were added.
+        self.assertEqual(
+            [("audio_files", 20), ("id3_tags", 100),
+             ("current_id3_tags", 100)],
+            [(args[1], len(args[2]))
+             for args, _ in insert_many.call_args_list])
+        self.assert_same_audio_files(all_au_files, list(self.db.get_all()))
+
+        # Problems with the new rows are found by flush().
+        add_txn = self.db.begin_add(17, 1230959520)
+        add_txn.add(all_au_files[0])
+        self.assertRaises(sqlite3.IntegrityError, add_txn.flush)
+        add_txn.revert()
+        self.assert_same_audio_files(all_au_files, list(self.db.get_all()))
+
+    def test_get_existing_fingerprints(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(1200)]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files[:700]:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        in_library = set(au.fingerprint for au in all_au_files[:700])
+        all_fps = [au.fingerprint for au in all_au_files]
+
+        self.assertEqual(set(), self.db.get_existing_fingerprints([]))
+        self.assertEqual(in_library,
+                         self.db.get_existing_fingerprints(all_fps))
+
+        # Now with the prefilter.
+        self.assertEqual(700, self.db.rebuild_fingerprint_filter())
+        self.assertEqual(in_library,
+                         self.db.get_existing_fingerprints(all_fps))
+        # Files added through the database are added to the filter.
+        add_txn = self.db.begin_add(17, 1230959521)
+        for au_file in all_au_files[700:]:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        self.assertEqual(set(all_fps),
+                         self.db.get_existing_fingerprints(all_fps))
+        self.db.drop_fingerprint_filter()
+        self.assertEqual(set(all_fps[:10]),
+                         self.db.get_existing_fingerprints(all_fps[:10]))
+
+    def test_get_rows_by_fingerprint(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(3)]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        fingerprints = [all_au_files[0].fingerprint,
+                        all_au_files[2].fingerprint]
+        rows = self.db.get_rows_by_fingerprint("audio_files", fingerprints)
+        self.assertEqual(sorted(fingerprints),
+                         sorted(row["fingerprint"] for row in rows))
+        self.assertEqual([17, 17], [row["volume"] for row in rows])
+        rows = self.db.get_rows_by_fingerprint(
+            "current_id3_tags", fingerprints[:1])
+        self.assertEqual(len(all_au_files[0].mutagen_id3), len(rows))
+        self.assertRaises(ValueError, self.db.get_rows_by_fingerprint,
+                          "sqlite_master", fingerprints)
+
     def test_update(self):
         self.assertTrue(self.db.create_tables())
 
@@ -127,6 +254,675 @@ class DatabaseTest(unittest.TestCase):
         fetched_au_file = self.db.get_by_fingerprint(test_au_file.fingerprint)
         self.assertEqual(test_au_file, fetched_au_file)
 
+    def test_update_many(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(20)]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+
+        for au_file in all_au_files[:10]:
+            au_file.mutagen_id3["TIT2"].text[0] += " changed"
+            au_file.mutagen_id3.add(mutagen.id3.TCOM(text=[u"TCOM"]))
+        self.db.update_many(all_au_files[:10], 1230959600)
+        # An older update only changes the files without newer tags.
+        older = [audio_file_test.get_test_audio_file(i) for i in xrange(20)]
+        self.db.update_many(older[5:15], 1230959550)
+        for au_file in older[10:15]:
+            au_file.volume = 17
+            au_file.import_timestamp = 1230959520
+        expected = all_au_files[:10] + older[10:15] + all_au_files[15:]
+        self.assert_same_audio_files(expected, list(self.db.get_all()))
+
+        # The update is done in a single transaction.
+        broken = audio_file_test.get_test_audio_file(3)
+        broken.mutagen_id3 = None
+        self.assertRaises(AttributeError, self.db.update_many,
+                          [older[0], broken], 1230959700)
+        self.assert_same_audio_files(expected, list(self.db.get_all()))
+
+        self.db.update_many([], 1230959700)
+
+    def test_changes(self):
+        self.assertTrue(self.db.create_tables())
+        self.assertEqual((0, []), self.db.changes_since(0))
+        self.assertEqual(0, self.db.current_change_cursor())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(10)]
+        fingerprints = [au_file.fingerprint for au_file in all_au_files]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        # Reverted transactions are not logged.
+        au_file = audio_file_test.get_test_audio_file(10)
+        au_file.volume = None
+        au_file.import_timestamp = None
+        add_txn = self.db.begin_add(17, 1230959521)
+        add_txn.add(au_file)
+        add_txn.revert()
+
+        cursor, changes = self.db.changes_since(0)
+        self.assertEqual([(fp, database.CHANGE_ADD) for fp in fingerprints],
+                         changes)
+        self.assertEqual(cursor, self.db.current_change_cursor())
+        self.assertEqual((cursor, []), self.db.changes_since(cursor))
+
+        # Files that change more than once are only returned once, in the
+        # position of their most recent change.
+        self.db.update_many(all_au_files[2:5], 1230959600)
+        self.db.update(all_au_files[7], 1230959601)
+        self.db.update(all_au_files[3], 1230959602)
+        new_cursor, changes = self.db.changes_since(cursor)
+        self.assertEqual(
+            [(fingerprints[i], database.CHANGE_UPDATE) for i in (2, 4, 7, 3)],
+            changes)
+        self.assertEqual(new_cursor, self.db.current_change_cursor())
+
+        # The changes can be read a piece at a time.
+        changes = []
+        while True:
+            cursor, some_changes = self.db.changes_since(cursor, limit=2)
+            if not some_changes:
+                break
+            changes.extend(some_changes)
+        self.assertEqual(new_cursor, cursor)
+        self.assertEqual(
+            [(fingerprints[i], database.CHANGE_UPDATE)
+             for i in (2, 3, 4, 7, 3)],
+            changes)
+
+    def test_changes__no_change_log(self):
+        # A version 1 database has no change log until it is migrated.
+        conn = sqlite3.connect(self.name)
+        conn.execute(schema.create_audio_files_table)
+        conn.execute(schema.create_id3_tags_table)
+        conn.commit()
+        conn.close()
+        au_file = audio_file_test.get_test_audio_file(1)
+        au_file.volume = None
+        au_file.import_timestamp = None
+        add_txn = self.db.begin_add(17, 1230959520)
+        add_txn.add(au_file)
+        add_txn.commit()
+        self.assertRaises(database.NoChangeLogError,
+                          self.db.changes_since, 0)
+        self.assertRaises(database.NoChangeLogError,
+                          self.db.current_change_cursor)
+
+        list(self.db.migrate_schema())
+        self.assertEqual((0, []), self.db.changes_since(0))
+        self.db.update(au_file, 1230959600)
+        self.assertEqual([(au_file.fingerprint, database.CHANGE_UPDATE)],
+                         self.db.changes_since(0)[1])
+
+    def test_delete_audio_files(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(10)]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        self.db.update_many(all_au_files[:5], 1230959600)
+        cursor = self.db.current_change_cursor()
+
+        missing = audio_file_test.get_test_audio_file(20).fingerprint
+        doomed = [all_au_files[3].fingerprint, all_au_files[8].fingerprint]
+        self.assertEqual(set(doomed),
+                         self.db.delete_audio_files(doomed + [missing]))
+        self.assert_same_audio_files(
+            all_au_files[:3] + all_au_files[4:8] + all_au_files[9:],
+            list(self.db.get_all()))
+        conn = self.db._get_connection()
+        for table_name in ("id3_tags", "current_id3_tags"):
+            self.assertEqual(0, conn.execute(
+                    "SELECT COUNT(*) FROM %s WHERE fingerprint IN (?, ?)"
+                    % table_name,
+                    [schema.fingerprint_to_db(fp) for fp in doomed]
+                    ).fetchone()[0])
+        conn.close()
+        # Only the files that were actually deleted are logged.
+        self.assertEqual(
+            [(fp, database.CHANGE_DELETE) for fp in doomed],
+            self.db.changes_since(cursor)[1])
+        self.assertEqual(set(), self.db.delete_audio_files(doomed))
+
+    def test_write_lock(self):
+        self.assertTrue(self.db.create_tables())
+        other_conn = sqlite3.connect(self.name, timeout=0)
+
+        def assert_locked():
+            self.assertRaises(sqlite3.OperationalError,
+                              other_conn.execute, "BEGIN IMMEDIATE")
+
+        # The write lock is held from _begin_write until the end of the
+        # transaction, even though the layout is checked in between.
+        conn = self.db._get_connection()
+        layout = database._begin_write(conn)
+        self.assertEqual(schema.SCHEMA_VERSION, layout.version)
+        assert_locked()
+        conn.rollback()
+        other_conn.execute("BEGIN IMMEDIATE")
+        other_conn.rollback()
+        conn.close()
+
+        # The same goes for adding files.
+        au_file = audio_file_test.get_test_audio_file(1)
+        au_file.volume = None
+        au_file.import_timestamp = None
+        add_txn = self.db.begin_add(17, 1230959520)
+        add_txn.add(au_file)
+        assert_locked()
+        add_txn.commit()
+        other_conn.execute("BEGIN IMMEDIATE")
+        other_conn.rollback()
+        other_conn.close()
+        self.assertEqual(au_file,
+                         self.db.get_by_fingerprint(au_file.fingerprint))
+
+    def test_close(self):
+        with database.Database(self.name) as db:
+            self.assertTrue(db.create_tables())
+            self.assertEqual([], list(db.get_all()))
+        self.assertRaises(Exception, db.get_all_imports().next)
+        db.close()
+
+    def test_concurrent_access(self):
+        self.assertTrue(self.db.create_tables())
+        conn = self.db._get_connection()
+        self.assertEqual("wal",
+                         conn.execute("PRAGMA journal_mode").fetchone()[0])
+        conn.close()
+
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(20)]
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files[:10]:
+            add_txn.add(au_file)
+        add_txn.commit()
+
+        # Read from several threads while a write is in progress.  Each
+        # thread gets its own connection, and only sees committed data.
+        add_txn = self.db.begin_add(17, 1230959521)
+        for au_file in all_au_files[10:]:
+            add_txn.add(au_file)
+        results = {}
+        def read(n):
+            results[n] = (list(self.db.get_all()),
+                          self.db._get_read_connection())
+        threads = [threading.Thread(target=read, args=(n,))
+                   for n in xrange(4)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(4, len(results))
+        for fetched, _ in results.values():
+            self.assert_same_audio_files(all_au_files[:10], fetched)
+        self.assertEqual(4, len(set(id(c) for _, c in results.values())))
+        # Reads can't write.
+        self.assertRaises(sqlite3.OperationalError,
+                          self.db._get_read_connection().execute,
+                          "DELETE FROM audio_files")
+        add_txn.commit()
+        self.assert_same_audio_files(all_au_files, list(self.db.get_all()))
+
+    def test_get_all_latest_tags(self):
+        self.assertTrue(self.db.create_tables())
+        # Enough files to span several pages.
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(2 * database._FINGERPRINT_CHUNK_SIZE
+                                        + 7)]
+        for i, au_file in enumerate(all_au_files):
+            au_file.volume = None
+            au_file.import_timestamp = None
+            au_file.album_id = i // 10
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            add_txn.add(au_file)
+        add_txn.commit()
+        # Give some files several generations of tags.
+        for i, au_file in enumerate(all_au_files[::3]):
+            au_file.mutagen_id3["TPE1"].text[0] += " changed"
+            self.db.update(au_file, 1230959520 + 1000)
+            if i % 2:
+                del au_file.mutagen_id3["TALB"]
+                self.db.update(au_file, 1230959520 + 2000)
+
+        fetched = list(self.db.get_all())
+        self.assert_same_audio_files(all_au_files, fetched)
+        # Files come back grouped by album.
+        self.assertEqual(sorted(au.album_id for au in fetched),
+                         [au.album_id for au in fetched])
+        self.assert_same_audio_files(
+            all_au_files, list(self.db.get_by_import(17, 1230959520)))
+        self.assertEqual([], list(self.db.get_by_import(17, 1230959521)))
+
+    def test_current_tags(self):
+        self.assertTrue(self.db.create_tables())
+        au_file = audio_file_test.get_test_audio_file(5)
+        au_file.volume = None
+        au_file.import_timestamp = None
+        add_txn = self.db.begin_add(17, 1230959520)
+        add_txn.add(au_file)
+        add_txn.commit()
+        original_tags = au_file.mutagen_id3
+
+        def get_current_rows():
+            conn = self.db._get_connection()
+            return sorted(
+                (ts, schema.code_to_frame_id(code))
+                for ts, code in conn.execute(
+                    "SELECT timestamp, frame_id FROM current_id3_tags"
+                    " WHERE fingerprint=?",
+                    (schema.fingerprint_to_db(au_file.fingerprint),)))
+
+        self.assertEqual(
+            sorted((1230959520, key) for key in original_tags),
+            get_current_rows())
+
+        # Newer tags replace the current ones.
+        au_file.mutagen_id3 = mutagen.id3.ID3()
+        au_file.mutagen_id3.add(mutagen.id3.TPE1(text=[u"New TPE1"]))
+        self.db.update(au_file, 1230959600)
+        self.assertEqual([(1230959600, "TPE1")], get_current_rows())
+        self.assertEqual(au_file,
+                         self.db.get_by_fingerprint(au_file.fingerprint))
+        newest = au_file.mutagen_id3
+
+        # Older tags go into the history, but are not current.
+        au_file.mutagen_id3 = original_tags
+        self.db.update(au_file, 1230959550)
+        self.assertEqual([(1230959600, "TPE1")], get_current_rows())
+        au_file.mutagen_id3 = newest
+        self.assertEqual(au_file,
+                         self.db.get_by_fingerprint(au_file.fingerprint))
+
+        # Reads come from the current_id3_tags table.
+        conn = self.db._get_connection()
+        conn.execute("DELETE FROM current_id3_tags")
+        conn.commit()
+        self.assertRaises(AssertionError, self.db.get_by_fingerprint,
+                          au_file.fingerprint)
+
+        # A rebuild regenerates the table from the history.
+        self.assertEqual(1, self.db.rebuild_current_tags())
+        self.assertEqual([(1230959600, "TPE1")], get_current_rows())
+        self.assertEqual(au_file,
+                         self.db.get_by_fingerprint(au_file.fingerprint))
+
+        # Databases that predate the table still work, and the rebuild
+        # creates it.
+        conn.execute("DROP TABLE current_id3_tags")
+        conn.commit()
+        self.assertEqual(au_file,
+                         self.db.get_by_fingerprint(au_file.fingerprint))
+        self.db.update(au_file, 1230959700)
+        self.assertEqual(1, self.db.rebuild_current_tags())
+        self.assertEqual([(1230959700, "TPE1")], get_current_rows())
+
+    def test_migrate_tag_encoding(self):
+        # Build a database the way it looked before the tag_json column
+        # was introduced.
+        conn = sqlite3.connect(self.name)
+        conn.execute(schema.create_audio_files_table)
+        conn.execute(schema.create_audio_files_index)
+        conn.execute("CREATE TABLE id3_tags (fingerprint TEXT,"
+                     " timestamp INTEGER, frame_id TEXT, value TEXT,"
+                     " mutagen_repr TEXT)")
+        conn.execute(schema.create_id3_tags_index)
+        conn.commit()
+        conn.close()
+        self.assertFalse(database._has_tag_json(self.db._get_connection()))
+
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(25)]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        # Old-format rows can be read.
+        self.assert_same_audio_files(all_au_files, list(self.db.get_all()))
+
+        num_tags = sum(len(au.mutagen_id3) for au in all_au_files)
+        progress = list(self.db.migrate_tag_encoding(batch_size=40))
+        self.assertEqual((num_tags + 39) // 40, len(progress))
+        self.assertEqual((num_tags, 0), progress[-1])
+        conn = self.db._get_connection()
+        self.assertTrue(database._has_tag_json(conn))
+        self.assertEqual(0, conn.execute(
+                "SELECT COUNT(*) FROM id3_tags"
+                " WHERE tag_json IS NULL").fetchone()[0])
+        self.assert_same_audio_files(all_au_files, list(self.db.get_all()))
+        # Running the migration again is harmless.
+        self.assertEqual([], list(self.db.migrate_tag_encoding()))
+
+        # Tags are decoded from tag_json, not from mutagen_repr, and
+        # rows without tag_json still fall back to mutagen_repr.
+        au_file = all_au_files[0]
+        conn.execute("UPDATE id3_tags SET mutagen_repr='garbage'"
+                     " WHERE fingerprint=? AND frame_id='TPE1'",
+                     (au_file.fingerprint,))
+        conn.execute("UPDATE id3_tags SET tag_json=NULL"
+                     " WHERE fingerprint=? AND frame_id='TIT2'",
+                     (au_file.fingerprint,))
+        conn.commit()
+        self.assertEqual(au_file,
+                         self.db.get_by_fingerprint(au_file.fingerprint))
+
+    def test_migrate_schema(self):
+        # Build a version 1 database.
+        conn = sqlite3.connect(self.name)
+        conn.execute(schema.create_audio_files_table)
+        conn.execute(schema.create_audio_files_index)
+        conn.execute(schema.create_id3_tags_table)
+        conn.execute(schema.create_id3_tags_index)
+        conn.execute(schema.create_current_id3_tags_table)
+        conn.execute(schema.create_current_id3_tags_index)
+        conn.commit()
+        conn.close()
+
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(30)]
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files[:20]:
+            add_txn.add(au_file)
+        add_txn.commit()
+        for au_file in all_au_files[:5]:
+            au_file.mutagen_id3["TIT2"].text[0] += " changed"
+        self.db.update_many(all_au_files[:5], 1230959600)
+        # Some rows from before tags were stored as tag_json.
+        conn = self.db._get_connection()
+        conn.execute("UPDATE id3_tags SET tag_json=NULL WHERE rowid % 3 = 0")
+        conn.commit()
+        self.assert_same_audio_files(all_au_files[:20],
+                                     list(self.db.get_all()))
+
+        # Start migrating, and give up partway through.
+        migration = self.db.migrate_schema(batch_size=7)
+        self.assertEqual(("audio_files", 7), migration.next())
+        self.assertEqual(("audio_files", 14), migration.next())
+        migration.close()
+
+        # Start again.  The library can be read and written while the
+        # migration is running.
+        migration = self.db.migrate_schema(batch_size=7)
+        progress = [migration.next() for _ in xrange(5)]
+        self.assertEqual([("audio_files", 7), ("audio_files", 14),
+                          ("audio_files", 20), ("id3_tags", 7),
+                          ("id3_tags", 14)], progress)
+        add_txn = self.db.begin_add(17, 1230959700)
+        for au_file in all_au_files[20:]:
+            add_txn.add(au_file)
+        add_txn.commit()
+        self.assert_same_audio_files(all_au_files, list(self.db.get_all()))
+        progress = list(migration)
+        self.assertEqual(("current_id3_tags",
+                          sum(len(au.mutagen_id3) for au in all_au_files)),
+                         progress[-1])
+
+        conn = self.db._get_connection()
+        self.assertEqual(schema.SCHEMA_VERSION, conn.execute(
+                "PRAGMA user_version").fetchone()[0])
+        self.assertEqual(
+            ["audio_files", "changes", "current_id3_tags", "id3_tags",
+             "sqlite_sequence"],
+            [row[0] for row in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table'"
+                    " ORDER BY name")])
+        self.assertEqual(0, conn.execute(
+                "SELECT COUNT(*) FROM id3_tags"
+                " WHERE tag_json IS NULL").fetchone()[0])
+        self.assert_same_audio_files(all_au_files, list(self.db.get_all()))
+        self.assert_same_audio_files(
+            all_au_files[:20], list(self.db.get_by_import(17, 1230959520)))
+        self.assertEqual(set(au.fingerprint for au in all_au_files),
+                         self.db.get_existing_fingerprints(
+                             au.fingerprint for au in all_au_files))
+        # Writes go to the new tables.
+        all_au_files[0].mutagen_id3["TIT2"].text[0] += " again"
+        self.db.update(all_au_files[0], 1230959800)
+        self.assertEqual(all_au_files[0], self.db.get_by_fingerprint(
+                all_au_files[0].fingerprint))
+
+        # Migrating again does nothing.
+        self.assertEqual([], list(self.db.migrate_schema()))
+
+    def test_compact_tags(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(30)]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        # The first 10 files end up with 4 sets of tags, the next 10
+        # with 2, and the rest with just 1.
+        for i in xrange(1, 4):
+            for au_file in all_au_files[:10]:
+                au_file.mutagen_id3["TIT2"].text[0] += " changed"
+            self.db.update_many(all_au_files[:10], 1230959520 + 1000 * i)
+        self.db.update_many(all_au_files[10:20], 1230959520 + 1000)
+        # Orphan the tags of the last 5 files.
+        conn = self.db._get_connection()
+        conn.executemany(
+            "DELETE FROM audio_files WHERE fingerprint=?",
+            [(schema.fingerprint_to_db(au_file.fingerprint),)
+             for au_file in all_au_files[25:]])
+        conn.commit()
+
+        self.assertRaises(ValueError, list, self.db.compact_tags(0))
+        archive_name = self.name + ".archive"
+        progress = list(self.db.compact_tags(2, archive_name, batch_size=7))
+        self.assertEqual(5, len(progress))
+        # Each file has 5 tags.
+        self.assertEqual((30, 10 * 2 * 5, 5 * 5), progress[-1])
+        self.assert_same_audio_files(all_au_files[:25],
+                                     list(self.db.get_all()))
+        self.assertEqual(25 * 5, conn.execute(
+                "SELECT COUNT(*) FROM current_id3_tags").fetchone()[0])
+        self.assertEqual(
+            [(1230959520 + 2000,), (1230959520 + 3000,)],
+            conn.execute(
+                "SELECT DISTINCT timestamp FROM id3_tags WHERE fingerprint=?"
+                " ORDER BY timestamp",
+                (schema.fingerprint_to_db(all_au_files[0].fingerprint),)
+                ).fetchall())
+
+        # Everything that was dropped is in the archive.
+        archive_conn = sqlite3.connect(archive_name)
+        self.assertEqual(125, archive_conn.execute(
+                "SELECT COUNT(*) FROM id3_tags").fetchone()[0])
+        self.assertEqual(
+            [(1230959520,), (1230959520 + 1000,)],
+            archive_conn.execute(
+                "SELECT DISTINCT timestamp FROM id3_tags WHERE fingerprint=?"
+                " ORDER BY timestamp",
+                (schema.fingerprint_to_db(all_au_files[0].fingerprint),)
+                ).fetchall())
+        archive_conn.close()
+        conn.close()
+
+        # There is nothing more to do.
+        self.assertEqual((25, 0, 0), list(self.db.compact_tags(2))[-1])
+
+    def test_compact_tags_concurrent_import(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(10)]
+        add_txn = self.db.begin_add(17, 1230959520)
+        for au_file in all_au_files:
+            au_file.volume = None
+            au_file.import_timestamp = None
+            add_txn.add(au_file)
+        add_txn.commit()
+        # Orphan one file's tags.
+        orphan = all_au_files[7]
+        conn = self.db._get_connection()
+        conn.execute("DELETE FROM audio_files WHERE fingerprint=?",
+                     (schema.fingerprint_to_db(orphan.fingerprint),))
+        conn.commit()
+        conn.close()
+
+        # Import the file again just after compaction has decided that
+        # its tags are orphaned.
+        reimported = audio_file_test.get_test_audio_file(7)
+        reimported.volume = None
+        reimported.import_timestamp = None
+        def reimport():
+            other_db = database.Database(self.name)
+            add_txn = other_db.begin_add(18, 1230959600)
+            add_txn.add(reimported)
+            add_txn.commit()
+            other_db.close()
+        reimport_thread = threading.Thread(target=reimport)
+
+        class HookedConnection(sqlite3.Connection):
+            def execute(self, sql, params=()):
+                cursor = sqlite3.Connection.execute(self, sql, params)
+                if (sql.startswith("SELECT fingerprint FROM audio_files")
+                    and not reimport_thread.is_alive()
+                    and reimport_thread.ident is None):
+                    reimport_thread.start()
+                    # Give the import every chance to sneak in.
+                    reimport_thread.join(0.5)
+                return cursor
+        real_connect = sqlite3.connect
+        def connect(*args, **kwargs):
+            kwargs["factory"] = HookedConnection
+            return real_connect(*args, **kwargs)
+        with mock.patch.object(database.sqlite3, "connect", connect):
+            progress = list(self.db.compact_tags(1))
+        reimport_thread.join()
+        self.assertEqual((10, 0, 5), progress[-1])
+
+        # The import waited for compaction, so it kept all of its tags.
+        self.assertEqual(reimported, self.db.get_by_fingerprint(
+                reimported.fingerprint))
+        conn = self.db._get_connection()
+        self.assertEqual(5, conn.execute(
+                "SELECT COUNT(*) FROM id3_tags WHERE fingerprint=?",
+                (schema.fingerprint_to_db(orphan.fingerprint),)
+                ).fetchone()[0])
+        conn.close()
+
+    def test_reclaim_space(self):
+        self.assertTrue(self.db.create_tables())
+        conn = self.db._get_connection()
+        self.assertEqual(database._AUTO_VACUUM_INCREMENTAL, conn.execute(
+                "PRAGMA auto_vacuum").fetchone()[0])
+        # Turn auto-vacuum off, as in a database created before it was
+        # used.
+        conn.execute("PRAGMA auto_vacuum=NONE")
+        conn.execute("VACUUM")
+        self.assertEqual(0, conn.execute(
+                "PRAGMA auto_vacuum").fetchone()[0])
+
+        for _ in xrange(2):
+            add_txn = self.db.begin_add(17, 1230959520)
+            for i in xrange(500):
+                au_file = audio_file_test.get_test_audio_file(i)
+                au_file.volume = None
+                au_file.import_timestamp = None
+                add_txn.add(au_file)
+            add_txn.commit()
+            self.db.reclaim_space()
+            size = os.path.getsize(self.name)
+            for table_name in ("audio_files", "id3_tags", "current_id3_tags"):
+                conn.execute("DELETE FROM %s" % table_name)
+            conn.commit()
+            self.db.reclaim_space()
+            self.assertTrue(os.path.getsize(self.name) < size / 4)
+            self.assertEqual(database._AUTO_VACUUM_INCREMENTAL, conn.execute(
+                    "PRAGMA auto_vacuum").fetchone()[0])
+        conn.close()
+
+    def test_query_plans(self):
+        self.assertTrue(self.db.create_tables())
+        all_au_files = [audio_file_test.get_test_audio_file(i)
+                        for i in xrange(300)]
+        for i, au_file in enumerate(all_au_files):
+            au_file.volume = None
+            au_file.import_timestamp = None
+            au_file.album_id = i // 12
+        for i in xrange(3):
+            add_txn = self.db.begin_add(17 + i, 1230959520 + i)
+            for au_file in all_au_files[i * 100:(i + 1) * 100]:
+                add_txn.add(au_file)
+            add_txn.commit()
+        self.db.analyze()
+
+        # Record every query that the hot paths run.
+        all_queries = []
+        class RecordingConnection(sqlite3.Connection):
+            def execute(self, sql, params=()):
+                all_queries.append((sql, params))
+                return sqlite3.Connection.execute(self, sql, params)
+            def executemany(self, sql, seq_of_params):
+                seq_of_params = list(seq_of_params)
+                if seq_of_params:
+                    all_queries.append((sql, seq_of_params[0]))
+                return sqlite3.Connection.executemany(self, sql,
+                                                      seq_of_params)
+        real_connect = sqlite3.connect
+        def connect(*args, **kwargs):
+            kwargs["factory"] = RecordingConnection
+            return real_connect(*args, **kwargs)
+        with mock.patch.object(database.sqlite3, "connect", connect):
+            db = database.Database(self.name)
+            self.assertEqual(300, len(list(db.get_all())))
+            self.assertEqual(3, len(list(db.get_all_imports())))
+            self.assertEqual(100, len(list(db.get_by_import(18, 1230959521))))
+            self.assertEqual(
+                all_au_files[7],
+                db.get_by_fingerprint(all_au_files[7].fingerprint))
+            db.get_existing_fingerprints(
+                au.fingerprint for au in all_au_files[::7])
+            db.update_many(all_au_files[:50], 1230959600)
+            new_au_file = audio_file_test.get_test_audio_file(1000)
+            new_au_file.volume = None
+            new_au_file.import_timestamp = None
+            add_txn = db.begin_add(20, 1230959700)
+            add_txn.add(new_au_file)
+            add_txn.commit()
+            db.changes_since(db.current_change_cursor() - 10)
+            db.close()
+
+        conn = self.db._get_connection()
+        checked = 0
+        for sql, params in all_queries:
+            if (not sql.lstrip().upper().startswith(
+                    ("SELECT", "UPDATE", "DELETE"))
+                or "sqlite_master" in sql):
+                continue
+            checked += 1
+            for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+                detail = row[-1]
+                self.assertFalse(
+                    "TEMP B-TREE" in detail
+                    or (detail.startswith("SCAN") and "INDEX" not in detail),
+                    "%s\n  has plan step: %s" % (sql, detail))
+        self.assertTrue(checked >= 8)
+
 
 if __name__ == "__main__":
     unittest.main()
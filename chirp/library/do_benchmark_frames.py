@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of our MPEG frame-splitting code paths.
+
+Usage:
+
+    do_benchmark_frames [--size-mb=20] [--repeat=3] [--corrupt]
+                        [--latency-ms=5] [path.mp3]
+
+If no path is given, a synthetic stream of dead air frames (with a
+leading ID3 tag and a sprinkling of junk) is generated in memory.
+With --corrupt, the frames are mixed with garbage full of false syncs,
+much like what the Barix produces after a reconnect.
+Throughput is reported in MB/s; for each path the best of --repeat
+runs is used.
+
+analyze_parallel and the block_reader backends are measured against a
+temporary copy of the data on local disk, and against a simulated slow
+filesystem that adds --latency-ms of delay to every read() call, much
+like our Samba mounts do.
+"""
+
+import argparse
+import cStringIO
+import os
+import random
+import sys
+import tempfile
+import time
+
+from chirp.common import block_reader
+from chirp.common import frame_table
+from chirp.common import id3_header
+from chirp.common import mp3_frame
+from chirp.library import analyzer
+from chirp.library import audio_file
+from chirp.stream import frame_splitter
+from chirp.stream import message
+
+
+# Approximate size of the blocks the Barix hands to the FrameSplitter.
+_STREAM_BLOCK_SIZE = 1 << 10
+
+# Size of the blocks used when splitting data that arrives in big reads.
+_LARGE_BLOCK_SIZE = 1 << 20
+
+
+def synthetic_mp3(size_bytes, corrupt=False):
+    """Returns a string of roughly size_bytes worth of MPEG data.
+
+    If corrupt is True, the frames are interleaved with blocks of
+    random garbage that is full of false syncs, and with runs of 0xff
+    fill bytes.
+    """
+    if corrupt:
+        rand = random.Random(0)
+        garbage = "".join(rand.choice("\xff\xfb\xfa\x90\x00abc")
+                          for _ in xrange(4000))
+        chunk = (mp3_frame.dead_air(100) + garbage
+                 + mp3_frame.dead_air(100) + "\xff" * 4000) * 8
+    else:
+        chunk = (mp3_frame.dead_air(1000) + "junk") * 16
+    parts = [id3_header.create_test_header(1000).ljust(1000, "\0")]
+    total = 1000
+    while total < size_bytes:
+        parts.append(chunk)
+        total += len(chunk)
+    return "".join(parts)
+
+
+def _bench_split_blocks(data):
+    for _ in mp3_frame.split(cStringIO.StringIO(data)):
+        pass
+
+
+def _bench_split_views(data):
+    for _ in mp3_frame.split_views(cStringIO.StringIO(data)):
+        pass
+
+
+def _large_blocks(data):
+    for i in xrange(0, len(data), _LARGE_BLOCK_SIZE):
+        yield data[i:i + _LARGE_BLOCK_SIZE]
+
+
+def _bench_split_large_blocks(data):
+    for _ in mp3_frame.split_blocks(_large_blocks(data)):
+        pass
+
+
+def _bench_analyzer(data):
+    analyzer.analyze(cStringIO.StringIO(data), audio_file.AudioFile())
+
+
+def _bench_frame_table_build(data):
+    frame_table.build(cStringIO.StringIO(data))
+
+
+def _bench_frame_table_deserialize(data):
+    # Measures the cost of deserializing a table, relative to the size
+    # of the MP3 it describes; building it is not timed.
+    frame_table.deserialize(_get_serialized_table(data))
+
+
+_serialized_table_cache = {}
+
+def _get_serialized_table(data):
+    key = id(data)
+    if key not in _serialized_table_cache:
+        table = frame_table.build(cStringIO.StringIO(data))
+        _serialized_table_cache[key] = table.serialize()
+    return _serialized_table_cache[key]
+
+
+def _bench_frame_splitter(data):
+    src = message.MessageSource()
+    for i in xrange(0, len(data), _STREAM_BLOCK_SIZE):
+        msg = message.Message()
+        msg.message_type = message.BLOCK
+        msg.payload = data[i:i + _STREAM_BLOCK_SIZE]
+        msg.connection_id = 1
+        msg.connection_offset = i
+        msg.start_timestamp_ms = msg.end_timestamp_ms = 0
+        src._add_message(msg)
+    src._add_stop_message()
+    fs = frame_splitter.FrameSplitter(src)
+    fs.loop()
+
+
+BENCHMARKS = (
+    ("mp3_frame.split", _bench_split_blocks),
+    ("mp3_frame.split_views", _bench_split_views),
+    ("split_blocks, 1MB blocks", _bench_split_large_blocks),
+    ("analyzer.analyze", _bench_analyzer),
+    ("FrameSplitter", _bench_frame_splitter),
+    ("FrameTable build", _bench_frame_table_build),
+    ("FrameTable deserialize", _bench_frame_table_deserialize),
+)
+
+
+class _SlowFile(object):
+    """A file wrapper that simulates a high-latency network filesystem."""
+
+    def __init__(self, file_obj, latency_s):
+        self._file_obj = file_obj
+        self._latency_s = latency_s
+
+    def read(self, size):
+        time.sleep(self._latency_s)
+        return self._file_obj.read(size)
+
+    def close(self):
+        self._file_obj.close()
+
+
+def _file_benchmarks(path, latency_ms, corrupt):
+    """Returns benchmarks that operate on the file at path."""
+    benchmarks = []
+    if not corrupt:
+        def bench_parallel(data):
+            analyzer.analyze_parallel(path, audio_file.AudioFile(),
+                                      chunk_size=1 << 20)
+        benchmarks.append(("analyze_parallel", bench_parallel))
+    for reader in block_reader.ALL_READERS:
+        def bench_local(data, reader=reader):
+            f_in = open(path, "rb")
+            try:
+                for _ in mp3_frame.split_views(f_in, reader=reader):
+                    pass
+            finally:
+                f_in.close()
+        benchmarks.append(("%s reader, local" % reader, bench_local))
+    # mmap needs a real file, so it can't be used with our fake slow
+    # filesystem.
+    for reader in (block_reader.BUFFERED, block_reader.LARGE):
+        def bench_slow(data, reader=reader):
+            f_in = _SlowFile(open(path, "rb"), latency_ms / 1000.0)
+            try:
+                for _ in mp3_frame.split_views(f_in, reader=reader):
+                    pass
+            finally:
+                f_in.close()
+        benchmarks.append(("%s reader, slow FS" % reader, bench_slow))
+    return benchmarks
+
+
+def run(name, func, data, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start_t = time.time()
+        func(data)
+        elapsed_t = time.time() - start_t
+        if best is None or elapsed_t < best:
+            best = elapsed_t
+    mb = len(data) / float(1 << 20)
+    sys.stdout.write("%-24s %8.1f MB/s  (%.1f MB in %.3fs)\n" % (
+        name, mb / best, mb, best))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the MPEG frame splitting code paths.")
+    parser.add_argument("path", nargs="?", default=None,
+                        help="An MP3 file to use instead of synthetic data")
+    parser.add_argument("--size-mb", type=int, default=20,
+                        help="Size of the synthetic test data, in MB")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each benchmark")
+    parser.add_argument("--corrupt", action="store_true",
+                        help="Mix junk full of false syncs into the "
+                        "synthetic test data")
+    parser.add_argument("--latency-ms", type=float, default=5,
+                        help="Per-read latency of the simulated slow "
+                        "filesystem, in milliseconds")
+    args = parser.parse_args()
+
+    if args.path:
+        data = open(args.path, "rb").read()
+    else:
+        data = synthetic_mp3(args.size_mb << 20, corrupt=args.corrupt)
+    for name, func in BENCHMARKS:
+        # The analyzer (rightly) rejects corrupted files.
+        if args.corrupt and func is _bench_analyzer:
+            continue
+        run(name, func, data, args.repeat)
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".mp3")
+    try:
+        os.write(fd, data)
+        os.close(fd)
+        for name, func in _file_benchmarks(tmp_path, args.latency_ms,
+                                           args.corrupt):
+            run(name, func, data, args.repeat)
+    finally:
+        os.unlink(tmp_path)
+
+
+if __name__ == "__main__":
+    main()
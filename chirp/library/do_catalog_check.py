@@ -1,7 +1,34 @@
 """Checks for any mp3 files in the library but missing from the catalog."""
 import optparse
 import os
-import sqlite3
+
+from chirp.common import dir_scan
+from chirp.library import database
+from chirp.library import fingerprint
+
+
+def check(libdir, db):
+    """Find the mp3 files under a directory that are not in the catalog.
+
+    Args:
+      libdir: The root of the directory tree to check.
+      db: A database.Database object for the catalog.
+
+    Yields:
+      A (fingerprint, found) tuple for each mp3 file, where fingerprint
+      is the file's name without the extension.
+    """
+    # dir_scan.walk does not need to stat every file in the library.
+    for root, dirs, files in dir_scan.walk(libdir):
+        bases = [os.path.splitext(entry.name)[0] for entry in files
+                 if os.path.splitext(entry.name)[1] == '.mp3']
+        # Look up each directory's files together.  Files that are not
+        # named for a fingerprint cannot be in the catalog.
+        existing = db.get_existing_fingerprints(
+            base for base in bases if fingerprint.is_valid(base))
+        for base in bases:
+            yield base, base in existing
+
 
 def main():
     p = optparse.OptionParser(
@@ -10,19 +37,13 @@ def main():
     if len(args) != 2:
         p.error('incorrect args')
     libdir, catfile = args
-    conn = sqlite3.connect(catfile)
-    cursor = conn.cursor()
     found = 0
-    for root, dirs, files in os.walk(libdir):
-        for fn in files:
-            base, ext = os.path.splitext(fn)
-            if ext == '.mp3':
-                cursor.execute(
-                    'select * from audio_files where fingerprint=?', [base])
-                if not cursor.fetchone():
-                    print ' * CATALOG MISSING %s' % base
-                else:
-                    found += 1
+    with database.Database(catfile) as db:
+        for base, in_catalog in check(libdir, db):
+            if not in_catalog:
+                print ' * CATALOG MISSING %s' % base
+            else:
+                found += 1
     print 'FOUND=%s' % found
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from chirp.library import audio_file_test
+from chirp.library import database
+from chirp.library import do_catalog_check
+from chirp.library import schema
+
+
+class CatalogCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.libdir = os.path.join(self.test_dir, "vol01")
+        self.name = os.path.join(self.test_dir, "catalog.sqlite")
+        self.db = database.Database(self.name)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.test_dir)
+
+    def _add_test_audio_files(self):
+        """Add some files to the catalog, and return their fingerprints."""
+        add_txn = self.db.begin_add(17, 1230959520)
+        fingerprints = []
+        for i in xrange(3):
+            au_file = audio_file_test.get_test_audio_file(i)
+            au_file.volume = None
+            au_file.import_timestamp = None
+            au_file.fingerprint = "%040x" % i
+            add_txn.add(au_file)
+            fingerprints.append(au_file.fingerprint)
+        add_txn.commit()
+        return fingerprints
+
+    def _touch(self, *names):
+        for name in names:
+            path = os.path.join(self.libdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+
+    def assert_check(self, fingerprints):
+        missing = "%040x" % 100
+        self._touch("a/%s.mp3" % fingerprints[0],
+                    "a/%s.mp3" % missing,
+                    "a/notes.txt",
+                    "b/c/%s.mp3" % fingerprints[1],
+                    "b/c/not a fingerprint.mp3")
+        self.assertEqual(
+            sorted([(fingerprints[0], True), (missing, False),
+                    (fingerprints[1], True),
+                    ("not a fingerprint", False)]),
+            sorted(do_catalog_check.check(self.libdir, self.db)))
+
+    def test_check(self):
+        self.assertTrue(self.db.create_tables())
+        self.assert_check(self._add_test_audio_files())
+
+    def test_check__version_1(self):
+        conn = sqlite3.connect(self.name)
+        conn.execute(schema.create_audio_files_table)
+        conn.execute(schema.create_id3_tags_table)
+        conn.commit()
+        conn.close()
+        self.assert_check(self._add_test_audio_files())
+
+
+if __name__ == "__main__":
+    unittest.main()
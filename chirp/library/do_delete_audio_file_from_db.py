@@ -18,7 +18,6 @@ Flags:
 
 import pprint
 import sys
-import sqlite3
 import argparse
 from chirp.common.conf import LIBRARY_DB
 from chirp.library import database
@@ -31,27 +30,17 @@ class AudioFileManager(object):
             library_db_file = LIBRARY_DB
         self.db_path = library_db_file
         self.db = database.Database(library_db_file)
-        self.conn = self.db._get_connection()
-        self.conn.row_factory = sqlite3.Row
 
-    def _select_rows(self, cursor):
-        while True:
-            item = cursor.fetchone()
-            if item is None:
-                break
-            yield item
+    def close(self):
+        """Close the connections to the database."""
+        self.db.close()
 
     def print_rows(self, rows):
         for row in rows:
             pprint.pprint(list(row))
 
     def get_rows(self, fingerprints, table):
-        sql = ("SELECT * "
-               "FROM %s "
-               "WHERE fingerprint IN (%s) "
-               ) % (table, ",".join("?" * len(fingerprints)))
-        cursor = self.conn.execute(sql, fingerprints)
-        return self._select_rows(cursor)
+        return self.db.get_rows_by_fingerprint(table, fingerprints)
 
     def get_tags(self, fingerprints):
         return self.get_rows(fingerprints, table="id3_tags")
@@ -59,27 +48,13 @@ class AudioFileManager(object):
     def get_audio_files(self, fingerprints):
         return self.get_rows(fingerprints, table="audio_files")
 
-    def del_rows(self, fingerprints, table):
-        sql = ("DELETE "
-               "FROM %s "
-               "WHERE fingerprint IN (%s) "
-               ) % (table, ",".join("?" * len(fingerprints)))
-
-        self.conn.execute(sql, fingerprints)
-
-    def del_tags(self, fingerprints):
-        self.del_rows(fingerprints, table="id3_tags")
-
     def del_audiofiles(self, fingerprints):
-        try:
-            self.del_tags(fingerprints)
-            self.del_rows(fingerprints, table="audio_files")
-        except Exception:
-            self.conn.rollback()
-            raise
-        else:
-            self.conn.commit()
+        """Delete audio files and their tags in a single transaction.
 
+        Returns:
+          The set of fingerprints that were actually deleted.
+        """
+        return self.db.delete_audio_files(fingerprints)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -102,31 +77,35 @@ def main():
     args = parser.parse_args()
 
     afm = AudioFileManager(library_db_file=args.db)
+    try:
+        sys.stdout.write("ARGS: {} \n\n".format(str(args)))
+        sys.stdout.write("Using database: {}\n".format(afm.db_path))
 
-    sys.stdout.write("ARGS: {} \n\n".format(str(args)))
-    sys.stdout.write("Using database: {}\n".format(afm.db_path))
-
-    fingerprints = args.fingerprint
+        fingerprints = args.fingerprint
 
-    tags = afm.get_tags(fingerprints)
+        tags = afm.get_tags(fingerprints)
 
-    audio_files = list(afm.get_audio_files(fingerprints))
-    sys.stdout.write("\nROWS TO DELETE from audio_files\n\n")
-    afm.print_rows(audio_files)
+        audio_files = list(afm.get_audio_files(fingerprints))
+        sys.stdout.write("\nROWS TO DELETE from audio_files\n\n")
+        afm.print_rows(audio_files)
 
-    sys.stdout.write("\nROWS TO DELETE from id3_tags\n\n")
-    afm.print_rows(tags)
+        sys.stdout.write("\nROWS TO DELETE from id3_tags\n\n")
+        afm.print_rows(tags)
 
-    if set(fingerprints) != set(f["fingerprint"] for f in audio_files):
-        sys.stdout.write(
-            "\n\nWARNING: A fingerprint was given that does not match "
-            "an audio file in the database\n\n")
+        if set(fingerprints) != set(f["fingerprint"] for f in audio_files):
+            sys.stdout.write(
+                "\n\nWARNING: A fingerprint was given that does not match "
+                "an audio file in the database\n\n")
 
-    if args.delete:
-        afm.del_audiofiles(fingerprints)
-        sys.stdout.write("\nDELETED\n")
-    else:
-        sys.stdout.write("\nNOTHING DELETED.  Pass in the --delete flag.\n")
+        if args.delete:
+            deleted = afm.del_audiofiles(fingerprints)
+            sys.stdout.write(
+                "\nDELETED {} audio files\n".format(len(deleted)))
+        else:
+            sys.stdout.write(
+                "\nNOTHING DELETED.  Pass in the --delete flag.\n")
+    finally:
+        afm.close()
 
 
 if __name__ == "__main__":
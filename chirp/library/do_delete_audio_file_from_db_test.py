@@ -1,4 +1,5 @@
 import os
+import sqlite3
 import time
 import unittest
 from mock import patch
@@ -6,6 +7,7 @@ from mock import patch
 from chirp.library import audio_file_test
 from chirp.library import do_delete_audio_file_from_db
 from chirp.library import database
+from chirp.library import schema
 
 
 TEST_DB_NAME_PATTERN = "/tmp/chirp-library-db_test.%d.sqlite"
@@ -18,7 +20,10 @@ class DeleteFingerprintTest(unittest.TestCase):
         self.db = database.Database(self.name)
 
     def tearDown(self):
-        os.unlink(self.name)
+        self.db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.name + suffix):
+                os.unlink(self.name + suffix)
 
     def _add_test_audiofiles(self):
         test_volume = 17
@@ -86,6 +91,7 @@ class DeleteFingerprintTest(unittest.TestCase):
 
         afm = do_delete_audio_file_from_db.AudioFileManager(
             library_db_file=self.name)
+        cursor = self.db.current_change_cursor()
 
         # TEST
         afm.del_audiofiles([test_fingerprint_1, test_fingerprint_2])
@@ -101,6 +107,12 @@ class DeleteFingerprintTest(unittest.TestCase):
         # make sure only 8 records exist now
         self.assertEqual(len(list(self.db.get_all())), 8)
 
+        # the deletes are in the change log
+        self.assertEqual(
+            [(test_fingerprint_1, database.CHANGE_DELETE),
+             (test_fingerprint_2, database.CHANGE_DELETE)],
+            self.db.changes_since(cursor)[1])
+
     def test_del_audiofiles__full_delete_non_existing_fingerprint(self):
         # SETUP
         test_fingerprint_1 = "0000000000000020"
@@ -115,13 +127,19 @@ class DeleteFingerprintTest(unittest.TestCase):
         afm = do_delete_audio_file_from_db.AudioFileManager(
             library_db_file=self.name)
 
+        cursor = self.db.current_change_cursor()
+
         # TEST
-        afm.del_audiofiles([test_fingerprint_1])
+        deleted = afm.del_audiofiles([test_fingerprint_1])
 
         # RESULTS
         # make sure nothing was deleted
+        self.assertEqual(deleted, set())
         self.assertEqual(len(list(self.db.get_all())), 10)
 
+        # and that no delete was logged
+        self.assertEqual(self.db.changes_since(cursor), (cursor, []))
+
     def test_del_audiofiles__raises_exception(self):
         # SETUP
         test_fingerprint_1 = "0000000000000007"
@@ -140,11 +158,36 @@ class DeleteFingerprintTest(unittest.TestCase):
         def _raise_exception(*args, **kwargs):
             raise Exception('Test')
 
-        with patch.object(afm, 'conn', autospec=True) as mock_conn:
-            mock_conn.execute.side_effect = _raise_exception
+        with patch.object(database, '_log_changes', _raise_exception):
             with self.assertRaises(Exception):
                 afm.del_audiofiles([test_fingerprint_1])
-            mock_conn.rollback.assert_called_with()
+
+    def test_del_audiofiles__rollback_is_atomic(self):
+        # SETUP
+        test_fingerprint_1 = "0000000000000007"
+
+        # Create db tables
+        self.assertTrue(self.db.create_tables())
+        self._add_test_audiofiles()
+
+        afm = do_delete_audio_file_from_db.AudioFileManager(
+            library_db_file=self.name)
+
+        # TEST
+        # fail after all of the rows have been deleted
+        def _raise_exception(*args, **kwargs):
+            raise Exception('Test')
+
+        with patch.object(database, '_log_changes', _raise_exception):
+            with self.assertRaises(Exception):
+                afm.del_audiofiles([test_fingerprint_1])
+
+        # RESULTS
+        # the deleted rows are back
+        self.assertEqual(
+            len(list(afm.get_tags(fingerprints=[test_fingerprint_1]))), 5)
+        af = self.db.get_by_fingerprint(test_fingerprint_1)
+        self.assertEquals(af.fingerprint, test_fingerprint_1)
 
     def test_get_audio_files__existing_record(self):
         # SETUP
@@ -221,6 +264,46 @@ class DeleteFingerprintTest(unittest.TestCase):
         # RESULTS
         self.assertEqual(len(list(af)), 0)
 
+    def test_get_rows__version_1(self):
+        # SETUP
+        test_fingerprint_1 = "0000000000000005"
+
+        # Create version 1 db tables
+        conn = sqlite3.connect(self.name)
+        conn.execute(schema.create_audio_files_table)
+        conn.execute(schema.create_id3_tags_table)
+        conn.commit()
+        conn.close()
+        self._add_test_audiofiles()
+
+        afm = do_delete_audio_file_from_db.AudioFileManager(
+            library_db_file=self.name)
+
+        # TEST
+        af = afm.get_audio_files(fingerprints=[test_fingerprint_1])
+        tags = afm.get_tags(fingerprints=[test_fingerprint_1])
+
+        # RESULTS
+        self.assertEqual([test_fingerprint_1],
+                         [a['fingerprint'] for a in af])
+        self.assertEqual(5 * [test_fingerprint_1],
+                         [t['fingerprint'] for t in tags])
+        afm.close()
+
+    def test_close(self):
+        # SETUP
+        self.assertTrue(self.db.create_tables())
+        afm = do_delete_audio_file_from_db.AudioFileManager(
+            library_db_file=self.name)
+        self.assertEqual([], afm.get_audio_files(["0000000000000005"]))
+
+        # TEST
+        afm.close()
+
+        # RESULTS
+        self.assertRaises(sqlite3.ProgrammingError,
+                          afm.get_audio_files, ["0000000000000005"])
+
     def test_print_rows_can_handle_non_ascii(self):
         afm = do_delete_audio_file_from_db.AudioFileManager(
             library_db_file=self.name
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Routine maintenance of the library database.
+
+Every retag adds a complete new set of tags to the tag history, so the
+id3_tags table grows without bound.  This trims the history down to
+the most recent sets of tags for each audio file, drops the tags of
+files that are no longer in the library, returns the freed space to the
+filesystem and refreshes the query planner's statistics.  It finishes
+by comparing the size of the database and the speed of some typical
+queries before and after.
+
+The history is trimmed in small batches, so it is safe to run this
+while the library is in use, and to interrupt it and run it again
+later.
+
+Usage:
+
+    do_maintain_catalog [--db=path] [--keep=N] [--archive=path]
+                        [--batch-size=N] [--no-vacuum]
+
+Flags:
+ --db = specify a filesystem path to an alternate location for the sqlite
+        database file
+ --keep = the number of sets of tags to keep for each audio file
+ --archive = copy all of the dropped tags into this sqlite database file
+ --batch-size = the number of audio files to process in each transaction
+ --no-vacuum = don't return the freed space to the filesystem
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from chirp.common import conf
+from chirp.library import database
+
+
+# The number of audio files to look up one at a time when measuring
+# query speed.
+_NUM_LOOKUPS = 100
+
+
+def _measure(library_db):
+    """Find out how big the database is, and how fast it is.
+
+    Returns:
+      A list of (description, value) tuples.
+    """
+    size = 0
+    for suffix in ("", "-wal"):
+        if os.path.exists(library_db + suffix):
+            size += os.path.getsize(library_db + suffix)
+    db = database.Database(library_db)
+    try:
+        num_tags = db._get_read_connection().execute(
+            "SELECT COUNT(*) FROM id3_tags").fetchone()[0]
+        start = time.time()
+        all_imports = list(db.get_all_imports())
+        imports_ms = 1000 * (time.time() - start)
+        newest_import = []
+        start = time.time()
+        if all_imports:
+            newest_import = list(db.get_by_import(*all_imports[-1]))
+        newest_import_ms = 1000 * (time.time() - start)
+        sample = [au_file.fingerprint
+                  for au_file in newest_import[:_NUM_LOOKUPS]]
+        start = time.time()
+        for fingerprint in sample:
+            db.get_by_fingerprint(fingerprint)
+        lookup_ms = 1000 * (time.time() - start) / max(1, len(sample))
+    finally:
+        db.close()
+    return [
+        ("File size (bytes)", "%d" % size),
+        ("Tag history rows", "%d" % num_tags),
+        ("List all imports (ms)", "%.1f" % imports_ms),
+        ("Read newest import (ms)", "%.1f" % newest_import_ms),
+        ("Look up one file (ms)", "%.2f" % lookup_ms),
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compact and tune the library database.")
+    parser.add_argument(
+        "--db", action="store", type=str, default=None,
+        help="Specify a full filesystem path to the library database file")
+    parser.add_argument(
+        "--keep", action="store", type=int, default=3,
+        help="Number of sets of tags to keep for each audio file")
+    parser.add_argument(
+        "--archive", action="store", type=str, default=None,
+        help="Copy the dropped tags into this sqlite database file")
+    parser.add_argument(
+        "--batch-size", action="store", type=int, default=500,
+        help="Number of audio files to process in each transaction")
+    parser.add_argument(
+        "--no-vacuum", action="store_true",
+        help="Don't return the freed space to the filesystem")
+    args = parser.parse_args()
+    if args.keep < 1:
+        parser.error("--keep must be at least 1")
+
+    library_db = args.db or conf.LIBRARY_DB
+    sys.stdout.write("Using database: {}\n".format(library_db))
+    before = _measure(library_db)
+
+    db = database.Database(library_db)
+    num_old = num_orphaned = 0
+    for num_files, num_old, num_orphaned in db.compact_tags(
+        args.keep, args.archive, args.batch_size):
+        sys.stdout.write("Checked {} files\r".format(num_files))
+        sys.stdout.flush()
+    sys.stdout.write("\nDropped {} old and {} orphaned tag rows\n".format(
+            num_old, num_orphaned))
+    if not args.no_vacuum:
+        sys.stdout.write("Reclaiming free space\n")
+        db.reclaim_space()
+    sys.stdout.write("Analyzing\n")
+    db.analyze()
+    db.close()
+
+    after = _measure(library_db)
+    sys.stdout.write("\n{:<26}{:>14}{:>14}\n".format("", "Before", "After"))
+    for (description, value_before), (_, value_after) in zip(before, after):
+        sys.stdout.write("{:<26}{:>14}{:>14}\n".format(
+                description, value_before, value_after))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
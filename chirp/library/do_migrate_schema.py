@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Convert the library database to the current schema version (see
+chirp.library.schema).
+
+The new tables are built alongside the old ones in small batches, so
+it is safe to run this while the library is in use, and to interrupt
+it and run it again later.  Writers are only blocked for the short
+final step that swaps in the new tables.
+
+Databases are also given a change log, if they don't already have
+one.  This is worth running even on a database that already uses the
+current schema version.
+
+Usage:
+
+    do_migrate_schema [--db=path] [--batch-size=N] [--no-vacuum]
+
+Flags:
+ --db = specify a filesystem path to an alternate location for the sqlite
+        database file
+ --batch-size = the number of rows to copy in each transaction
+ --no-vacuum = don't compact the database file afterwards
+"""
+
+import argparse
+import os
+import sys
+
+from chirp.common import conf
+from chirp.library import database
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the library database to the current schema.")
+    parser.add_argument(
+        "--db", action="store", type=str, default=None,
+        help="Specify a full filesystem path to the library database file")
+    parser.add_argument(
+        "--batch-size", action="store", type=int, default=5000,
+        help="Number of rows to copy in each transaction")
+    parser.add_argument(
+        "--no-vacuum", action="store_true",
+        help="Don't compact the database file after migrating")
+    args = parser.parse_args()
+
+    library_db = args.db or conf.LIBRARY_DB
+    sys.stdout.write("Using database: {}\n".format(library_db))
+    size_before = os.path.getsize(library_db)
+    db = database.Database(library_db)
+    migrated = False
+    for table_name, count in db.migrate_schema(args.batch_size,
+                                               vacuum=not args.no_vacuum):
+        sys.stdout.write("{}: {} rows\r".format(table_name, count))
+        sys.stdout.flush()
+        migrated = True
+    db.close()
+    if not migrated:
+        sys.stdout.write("Already using the current schema\n")
+        return
+    sys.stdout.write("\nFile size: {} -> {} bytes\n".format(
+        size_before, os.path.getsize(library_db)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Convert the ID3 tags stored in the library database from the old repr()
+format into the structured tag_json format (see chirp.library.tag_codec).
+
+The conversion happens in small batches, each in its own transaction,
+so it is safe to run while the library is in use and to interrupt it
+and run it again later.  Rows that have not yet been converted are
+still readable.
+
+Usage:
+
+    do_migrate_tag_encoding [--db=path] [--batch-size=N]
+
+Flags:
+ --db = specify a filesystem path to an alternate location for the sqlite
+        database file
+ --batch-size = the number of rows to convert in each transaction
+"""
+
+import argparse
+import sys
+
+from chirp.common import conf
+from chirp.library import database
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert stored ID3 tags to the tag_json format.")
+    parser.add_argument(
+        "--db", action="store", type=str, default=None,
+        help="Specify a full filesystem path to the library database file")
+    parser.add_argument(
+        "--batch-size", action="store", type=int, default=1000,
+        help="Number of rows to convert in each transaction")
+    args = parser.parse_args()
+
+    library_db = args.db or conf.LIBRARY_DB
+    sys.stdout.write("Using database: {}\n".format(library_db))
+    db = database.Database(library_db)
+    converted = skipped = 0
+    for converted, skipped in db.migrate_tag_encoding(args.batch_size):
+        sys.stdout.write("Converted {} rows\r".format(converted))
+        sys.stdout.flush()
+    sys.stdout.write("\nConverted {} rows\n".format(converted))
+    if skipped:
+        sys.stdout.write(
+            "{} rows could not be converted and still use"
+            " mutagen_repr\n".format(skipped))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
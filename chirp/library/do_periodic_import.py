@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+import argparse
+import collections
 import logging
 import os
 import sys
 from chirp.common import timestamp
+from chirp.common import conf
 from chirp.common.conf import (LIBRARY_PREFIX, LIBRARY_DB,
                                    LIBRARY_TMP_PREFIX)
 from chirp.common.printing import cprint
@@ -13,76 +16,142 @@ from chirp.library import artists
 from chirp.library import audio_file
 from chirp.library import database
 from chirp.library import dropbox
-from chirp.library import import_file
+from chirp.library import import_spool
 from chirp.library import import_transaction
+from chirp.library import scan_cache
 
 
 VOLUME_NUMBER = 1
 IMPORT_SIZE_LIMIT = 0.95 * (3 << 30)  # 95% of 3GB.
 
 
-def import_albums(dry_run):
-    inbox = dropbox.Dropbox()
+def _open_scan_cache():
+    """Returns a ScanCache as specified in the settings, or None."""
+    cache_db = getattr(conf, "SCAN_CACHE_DB", None)
+    if not cache_db:
+        return None
+    return scan_cache.ScanCache(cache_db)
+
+
+def _close_scan_cache(cache):
+    if cache is None:
+        return
+    cprint("Scan cache: %d hits, %d misses" % (cache.hits, cache.misses))
+    cache.close()
+
+
+def import_albums(dry_run, workers=1):
+    cache = _open_scan_cache()
+    # Albums that pass validation are kept here until we know that the
+    # whole dropbox is clean, and then imported from here.  This way
+    # each album is only scanned once, and we never need to hold all
+    # of the albums in memory.
+    spool = import_spool.ImportSpool()
+    try:
+        for _ in _import_albums(dry_run, cache, spool, workers):
+            yield
+    finally:
+        spool.close()
+        _close_scan_cache(cache)
+
+
+def _describe_album(alb):
+    """Returns a list of lines describing an unstandardized album.
+
+    A line of None stands for a blank line.
+    """
+    lines = []
+    if alb.tags():
+        lines.append(u"(%s)" % ", ".join(alb.tags()))
+    else:
+        lines.append(None)
+    duration_ms = sum(au.duration_ms for au in alb.all_au_files)
+    if alb.is_compilation():
+        lines.append("Compilation")
+        for i, au in enumerate(alb.all_au_files):
+            artist = au.mutagen_id3["TPE1"]
+            lines.append(u"  {:02d}: {}".format(i+1, artist))
+    else:
+        lines.append(alb.artist_name())
+    lines.append(u"{} tracks / {} minutes".format(
+        len(alb.all_au_files), int(duration_ms / 60000)))
+    lines.append(u"ID=%015x" % alb.album_id)
+    return lines
+
+
+def _import_albums(dry_run, cache, spool, workers):
+    inbox = dropbox.Dropbox(cache=cache)
     prescan_timestamp = timestamp.now()
     error_count = 0
     album_count = 0
     seen_fp = {}
 
     db = database.Database(LIBRARY_DB)
+    # Most tracks in the dropbox are new, so this lets us skip almost
+    # all of the database lookups in our duplicate check.
+    db.rebuild_fingerprint_filter()
+
+    # Descriptions of the albums that have been handed off to be
+    # standardized, oldest first.  Albums come back from
+    # standardize_albums in the same order.
+    descriptions = collections.deque()
+
+    def prepare_albums():
+        for alb in inbox.albums(remember=False):
+            # Describe the album as it was found, before it is changed.
+            descriptions.append((alb.title(), _describe_album(alb)))
+            # Attach a dummy volume # and timestamp
+            alb.set_volume_and_import_timestamp(0xff, prescan_timestamp)
+            yield alb
 
     try:
-        for alb in inbox.albums():
-            alb.drop_payloads()
+        for alb, std_error in album.standardize_albums(prepare_albums(),
+                                                       workers=workers):
             album_count += 1
-            cprint(u'#{num} "{title}"'.format(num=album_count, title=alb.title()))
-            if alb.tags():
-                cprint(u"(%s)" % ", ".join(alb.tags()))
-            else:
-                print
-            duration_ms = sum(au.duration_ms for au in alb.all_au_files)
-            if alb.is_compilation():
-                cprint("Compilation")
-                for i, au in enumerate(alb.all_au_files):
-                    artist = au.mutagen_id3["TPE1"]
-                    cprint(u"  {:02d}: {}".format(i+1, artist))
-            else:
-                cprint(alb.artist_name())
-            cprint(u"{} tracks / {} minutes".format(
-                len(alb.all_au_files), int(duration_ms / 60000)))
-            cprint(u"ID=%015x" % alb.album_id)
+            title, description = descriptions.popleft()
+            cprint(u'#{num} "{title}"'.format(num=album_count, title=title))
+            for line in description:
+                if line is None:
+                    print
+                else:
+                    cprint(line)
             sys.stdout.flush()
 
             # Check that the album isn't already in library.
             collision = False
+            in_library = db.get_existing_fingerprints(
+                au.fingerprint for au in alb.all_au_files)
             for au in alb.all_au_files:
                 if au.fingerprint in seen_fp:
                     cprint(u"***** ERROR: DUPLICATE TRACK WITHIN IMPORT", type='error')
                     cprint(u"This one is at %s" % au.path)
-                    cprint(u"Other one is at %s" % seen_fp[au.fingerprint].path)
+                    cprint(u"Other one is at %s" % seen_fp[au.fingerprint])
                     collision = True
                     break
-                fp_au_file = db.get_by_fingerprint(au.fingerprint)
-                if fp_au_file is not None:
+                if au.fingerprint in in_library:
+                    fp_au_file = db.get_by_fingerprint(au.fingerprint)
                     cprint(u"***** ERROR: TRACK ALREADY IN LIBRARY", type='error')
                     cprint(fp_au_file.mutagen_id3)
                     collision = True
                     break
-                seen_fp[au.fingerprint] = au
+                seen_fp[au.fingerprint] = au.path
 
             if collision:
                 sys.stdout.flush()
                 error_count += 1
 
-            # Attach a dummy volume # and timestamp
-            alb.set_volume_and_import_timestamp(0xff, prescan_timestamp)
-            try:
-                alb.standardize()
+            if std_error is None:
                 cprint("OK!\n")
-            except (import_file.ImportFileError, album.AlbumError), ex:
+            else:
                 cprint("***** IMPORT ERROR")
-                cprint("*****   %s\n" % str(ex))
+                cprint("*****   %s\n" % str(std_error))
                 error_count += 1
 
+            # Once we have seen an error nothing will be imported, so
+            # there is no point in spooling any more albums.
+            if error_count == 0:
+                spool.add(alb)
+
             sys.stdout.flush()
             yield # scanned an album
     except analyzer.InvalidFileError as ex:
@@ -102,7 +171,7 @@ def import_albums(dry_run):
         return
 
     txn = None
-    for alb in inbox.albums():
+    for alb in spool.albums():
         if txn is None:
             txn = import_transaction.ImportTransaction(db, VOLUME_NUMBER,
                                                        timestamp.now(),
@@ -117,11 +186,26 @@ def import_albums(dry_run):
     # Flush out any remaining tracks.
     if txn:
         txn.commit(LIBRARY_PREFIX)
+    # The library has grown, so bring the query planner up to date.
+    db.analyze()
     return
 
 
 def main():
-    dry_run = "--actually-do-import" not in sys.argv
+    parser = argparse.ArgumentParser(
+        description="Import new albums from the dropbox into the library.")
+    parser.add_argument(
+        "--actually-do-import", action="store_true",
+        help="Update the music library.  Without this flag, the dropbox"
+        " is only checked for errors.")
+    parser.add_argument(
+        "--workers", action="store", type=int, default=1,
+        help="Number of processes used to standardize albums")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    dry_run = not args.actually_do_import
     cprint()
     if dry_run:
         cprint("+++ This is only a dry run.  No actual import will occur.")
@@ -134,7 +218,7 @@ def main():
         cprint("***")
         cprint("*" * 70)
     cprint()
-    for _ in import_albums(dry_run):
+    for _ in import_albums(dry_run, workers=args.workers):
         pass
 
 
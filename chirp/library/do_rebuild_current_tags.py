@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Regenerate the library database's table of current ID3 tags from the
+full tag history.
+
+The current_id3_tags table is normally kept up to date automatically.
+Run this once after upgrading an older database, or if the id3_tags
+table has been modified by anything other than chirp.library.database.
+
+Usage:
+
+    do_rebuild_current_tags [--db=path]
+
+Flags:
+ --db = specify a filesystem path to an alternate location for the sqlite
+        database file
+"""
+
+import argparse
+import sys
+
+from chirp.common import conf
+from chirp.library import database
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Regenerate the table of current ID3 tags.")
+    parser.add_argument(
+        "--db", action="store", type=str, default=None,
+        help="Specify a full filesystem path to the library database file")
+    args = parser.parse_args()
+
+    library_db = args.db or conf.LIBRARY_DB
+    sys.stdout.write("Using database: {}\n".format(library_db))
+    db = database.Database(library_db)
+    count = db.rebuild_current_tags()
+    sys.stdout.write("Wrote {} current tags\n".format(count))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Inspect and maintain the scan cache (see chirp.library.scan_cache).
+
+Usage:
+
+    Show statistics:
+    do_scan_cache stats
+
+    Remove stale entries and shrink the cache file:
+    do_scan_cache compact
+
+    Drop every entry, or only those under a directory:
+    do_scan_cache invalidate [path_prefix]
+
+Flags:
+ --db = specify a filesystem path to an alternate location for the
+        cache's sqlite database file
+"""
+
+import argparse
+import os
+import sys
+
+from chirp.common import conf
+from chirp.library import scan_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect and maintain the scan cache.")
+    parser.add_argument(
+        "command", choices=("stats", "compact", "invalidate"),
+        help="What to do to the cache")
+    parser.add_argument(
+        "path_prefix", nargs="?", default=None,
+        help="For invalidate, only drop entries for files under this path")
+    parser.add_argument(
+        "--db", action="store", type=str, default=None,
+        help="Specify a full filesystem path to the cache database file")
+    args = parser.parse_args()
+
+    cache_db = args.db or getattr(conf, "SCAN_CACHE_DB", None)
+    if not cache_db:
+        sys.stderr.write("The scan cache is disabled (SCAN_CACHE_DB)\n")
+        return 1
+    sys.stdout.write("Using cache: {}\n".format(cache_db))
+    cache = scan_cache.ScanCache(cache_db)
+    try:
+        if args.command == "compact":
+            size_before = os.path.getsize(cache_db)
+            removed = cache.compact()
+            sys.stdout.write("Removed {} stale entries\n".format(removed))
+            sys.stdout.write("File size: {} -> {} bytes\n".format(
+                size_before, os.path.getsize(cache_db)))
+        elif args.command == "invalidate":
+            prefix = args.path_prefix
+            if prefix is not None:
+                prefix = os.path.abspath(prefix)
+            removed = cache.invalidate(prefix)
+            sys.stdout.write("Removed {} entries\n".format(removed))
+        stats = cache.stats()
+        total = stats["lifetime_hits"] + stats["lifetime_misses"]
+        sys.stdout.write("Entries: {}\n".format(stats["entries"]))
+        sys.stdout.write("Frame tables: {}\n".format(stats["frame_tables"]))
+        sys.stdout.write(
+            "Lifetime hits: {}, misses: {} ({:.1f}% hits)\n".format(
+                stats["lifetime_hits"], stats["lifetime_misses"],
+                100.0 * stats["lifetime_hits"] / (total or 1)))
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
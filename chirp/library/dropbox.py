@@ -1,37 +1,50 @@
 
 import logging
-import os
 from chirp.common import conf
+from chirp.common import dir_scan
 from chirp.library import album
-from chirp.library import audio_file
+from chirp.library import payload_spool
+from chirp.library import scan_cache
 
 
 class Dropbox(object):
 
-    def __init__(self, dropbox_path=None):
+    def __init__(self, dropbox_path=None, cache=None,
+                 payload_budget_bytes=payload_spool.DEFAULT_BUDGET_BYTES):
+        """Constructor.
+
+        Args:
+          dropbox_path: The path to the dropbox; if None, the
+            MUSIC_DROPBOX setting is used.
+          cache: An optional scan_cache.ScanCache, used whenever we
+            scan files in the dropbox.
+          payload_budget_bytes: When albums() is asked for payloads,
+            at most this many bytes of them are kept in memory; the
+            rest are spilled to a temporary file.
+        """
         dropbox_path = dropbox_path or conf.MUSIC_DROPBOX
         self._path = dropbox_path
+        self._cache = cache
+        self._spool = payload_spool.PayloadSpool(payload_budget_bytes)
         self._dirs = {}
         self._all_files = []
         # Scan the path and remember all of the subdirectories and
         # the MP3 files that they cotain.
-        for basename in os.listdir(dropbox_path):
-            child_path = os.path.join(dropbox_path, basename)
-            if os.path.isdir(child_path):
+        for child in dir_scan.scan_dir(dropbox_path):
+            if child.is_dir():
                 mp3_names = []
-                for name in os.listdir(child_path):
+                for entry in dir_scan.scan_dir(child.path):
                     # Skip dot-files.
-                    if name.startswith("."):
+                    if entry.name.startswith("."):
                         continue
                     # Must have the right file extension.
-                    if not name.lower().endswith(".mp3"):
+                    if not entry.name.lower().endswith(".mp3"):
                         continue
-                    mp3_path = os.path.join(child_path, name)
                     # Only accept things that look like ordinary files.
-                    if os.path.isfile(mp3_path):
-                        mp3_names.append(name)
-                        self._all_files.append(mp3_path)
-                self._dirs[child_path] = mp3_names
+                    if entry.is_file():
+                        mp3_names.append(entry.name)
+                        self._all_files.append(entry.path)
+                self._dirs[child.path] = mp3_names
                     
         self._all_albums = None
         self._all_tracks = None
@@ -48,16 +61,33 @@ class Dropbox(object):
         """
         # Note the use of ad-hoc relativization in the path.
         return dict(
-            (mp3_path[len(self._path):], audio_file.scan_fast(mp3_path))
+            (mp3_path[len(self._path):],
+             scan_cache.scan(mp3_path, self._cache, fast=True))
             for mp3_path in self._all_files)
 
-    def albums(self):
-        """Return unstandardized versions of all albums in the dropbox."""
+    def albums(self, get_payload=False, remember=True):
+        """Return unstandardized versions of all albums in the dropbox.
+
+        Args:
+          get_payload: If True, the tracks' MPEG frames are kept in their
+            'payload' fields, under the dropbox's memory budget.  This
+            only matters the first time albums() is called, since the
+            albums are remembered; use Album.ensure_payloads() to be sure
+            the payloads are present.
+          remember: If False, the albums are not kept in memory after
+            they are returned, and the next call to albums() will scan
+            the dropbox again.
+        """
         if self._all_albums is None:
-            self._all_albums = []
+            all_albums = []
+            if remember:
+                self._all_albums = all_albums
             for path in sorted(self._dirs):
-                for au in album.from_directory(path):
-                    self._all_albums.append(au)
+                for au in album.from_directory(path, cache=self._cache,
+                                               get_payload=get_payload,
+                                               spool=self._spool):
+                    if remember:
+                        all_albums.append(au)
                     yield au
         else:
             for au in self._all_albums:
@@ -68,6 +98,7 @@ class Dropbox(object):
         if self._all_tracks is None:
             self._all_tracks = []
             for path in self._dirs:
-                for alb in album.from_directory(path, fast=True):
+                for alb in album.from_directory(path, fast=True,
+                                                cache=self._cache):
                     self._all_tracks.extend(alb.all_au_files)
         return self._all_tracks
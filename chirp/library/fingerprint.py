@@ -10,8 +10,7 @@ The fingerprint is used as a globally unique identifier inside the
 music library, and is stored in a file's UFID tag.
 """
 
-import hashlib
-from chirp.common import mp3_frame
+from chirp.common import frame_table
 
 
 def compute(file_obj):
@@ -25,16 +24,7 @@ def compute(file_obj):
       a 40-character sequence of hex digits.  If no valid MPEG frames
       are found, None is returned.
     """
-    sha1_calc = hashlib.sha1()
-    saw_a_valid_frame = False
-    for hdr, data_buffer in mp3_frame.split(file_obj):
-        if hdr is not None:
-            sha1_calc.update(data_buffer)
-            saw_a_valid_frame = True
-    if saw_a_valid_frame:
-        return sha1_calc.hexdigest()
-    else:
-        return None
+    return frame_table.build(file_obj).fingerprint
 
 
 def is_valid(fingerprint_str):
@@ -7,11 +7,16 @@ import hashlib
 
 import mutagen.id3
 
+from chirp.common import block_reader
+from chirp.common import frame_table
+from chirp.common import id3_header
+from chirp.common import range_copy
 from chirp.library import artists
 from chirp.library import audio_file
 from chirp.library import checker
 from chirp.library import constants
 from chirp.library import order
+from chirp.library import payload_spool
 from chirp.library import titles
 
 
@@ -136,12 +141,120 @@ def standardize_file(au_file):
             ["Found pre-write errors"] + pre_write_tagging_errors)
 
 
-def write_file(au_file, prefix):
+def _copy_payload(au_file, path):
+    """Copy the MPEG frames of au_file's source file onto the end of path.
+
+    The frames are copied straight from the source file, using the byte
+    ranges recorded when it was scanned, and their SHA1 is checked
+    against au_file's fingerprint as they are copied.
+
+    Raises:
+      ImportFileError: if the copy fails or the fingerprint does not
+        match.  In that case the file at path is removed.
+    """
+    ranges = au_file.payload_ranges
+    try:
+        if ranges is None:
+            # We don't know where the frames are (for example, after a
+            # fast scan), so we have to look.
+            src_fh = open(au_file.path, "rb")
+            try:
+                ranges = frame_table.build(
+                    src_fh, compute_fingerprint=False).payload_ranges()
+            finally:
+                src_fh.close()
+        _, sha1 = range_copy.copy_ranges(au_file.path, ranges, path)
+    except (IOError, OSError), ex:
+        os.unlink(path)
+        raise ImportFileError(["Could not copy frames from %s: %s"
+                               % (au_file.path, ex)])
+    if sha1 != au_file.fingerprint:
+        os.unlink(path)
+        raise ImportFileError(["Fingerprint mismatch while copying %s"
+                               % au_file.path])
+
+
+# Ways of checking a file after it has been written into the library.
+#
+#   VERIFY_FULL: Rescan the file with audio_file.scan, exactly as if it
+#     were being imported for the first time.  This re-reads the tags
+#     with mutagen and splits and hashes every MPEG frame.
+#   VERIFY_STREAM: Read the file once, in large blocks.  The tag block
+#     at the front is parsed from memory and compared with the tags we
+#     meant to write, and everything after it is hashed and compared
+#     with the file's fingerprint.
+#   VERIFY_SAMPLED: Like VERIFY_STREAM, but only a fraction of the files
+#     have their audio hashed.  The rest just have their tag block and
+#     size checked.
+VERIFY_FULL = "full"
+VERIFY_STREAM = "stream"
+VERIFY_SAMPLED = "sampled"
+
+# The fraction of files whose audio is hashed in VERIFY_SAMPLED mode.
+DEFAULT_SAMPLE_FRACTION = 0.1
+
+
+def _id3_frame_set(mutagen_id3):
+    return set(repr(x) for x in mutagen_id3.itervalues())
+
+
+def _is_sampled(au_file, sample_fraction):
+    # Decide based on the fingerprint, so that the same files are
+    # always picked.
+    return int(au_file.fingerprint[:8], 16) < sample_fraction * (1 << 32)
+
+
+def _verify_full(au_file, path):
+    new_au_file = audio_file.scan(path, get_payload=False)
+    if new_au_file is None:
+        return ["New file damaged!"]
+    new_au_file.volume = au_file.volume
+    new_au_file.import_timestamp = au_file.import_timestamp
+    return checker.find_tags_errors(new_au_file)
+
+
+def _verify_stream(au_file, path, check_payload):
+    errors = []
+    f_in = open(path, "rb")
+    try:
+        file_size = os.fstat(f_in.fileno()).st_size
+        tag_size = id3_header.parse_size(f_in.read(10))
+        if tag_size is None:
+            return ["New file has no ID3 tag"]
+        f_in.seek(0)
+        tag_data = f_in.read(tag_size + 10)
+        new_id3 = audio_file.parse_id3_tag(tag_data)
+        if new_id3 is None:
+            return ["Could not parse new file's ID3 tag"]
+        if _id3_frame_set(new_id3) != _id3_frame_set(au_file.mutagen_id3):
+            errors.append("ID3 tag changed when written")
+        if file_size - len(tag_data) != au_file.frame_size:
+            errors.append("New file has %d bytes of audio, expected %d"
+                          % (file_size - len(tag_data), au_file.frame_size))
+        elif check_payload:
+            sha1_calc = hashlib.sha1()
+            for block in block_reader.read_blocks(f_in):
+                sha1_calc.update(block)
+            if sha1_calc.hexdigest() != au_file.fingerprint:
+                errors.append("New file's fingerprint does not match")
+    finally:
+        f_in.close()
+    # The tags that were written are the ones we have in memory, so
+    # there is no need to parse them again to check them.
+    return errors + checker.find_tags_errors(au_file)
+
+
+def write_file(au_file, prefix, verify=VERIFY_STREAM,
+               sample_fraction=DEFAULT_SAMPLE_FRACTION):
     """Write a newly-imported file into the archive.
 
     Args:
       au_file: An AudioFile object.
       prefix: The library prefix that the file is being imported into.
+      verify: How to check the file after it is written; one of
+        VERIFY_FULL, VERIFY_STREAM or VERIFY_SAMPLED.
+      sample_fraction: In VERIFY_SAMPLED mode, the fraction of files
+        whose audio is checked.
 
     Returns:
       The full path to the newly-imported file.
@@ -149,6 +262,9 @@ def write_file(au_file, prefix):
     Raises:
       ImportFileError: if the import fails.
     """
+    if verify not in (VERIFY_FULL, VERIFY_STREAM, VERIFY_SAMPLED):
+        raise ValueError("Unknown verification mode: %r" % verify)
+
     # Make sure the canonical directory exists.
     try:
         os.makedirs(au_file.canonical_directory(prefix))
@@ -160,24 +276,23 @@ def write_file(au_file, prefix):
     if os.path.exists(path):
         raise ImportFileError(["File exists: " + path])
     au_file.mutagen_id3.save(path)
-    assert au_file.payload is not None
-    out_fh = open(path, "a")
-    out_fh.write(au_file.payload)
-    out_fh.close()
+    if au_file.payload is not None:
+        out_fh = open(path, "a")
+        payload_spool.write(au_file.payload, out_fh)
+        out_fh.close()
+    else:
+        _copy_payload(au_file, path)
 
     # Now make sure that the file we just wrote passes our checks.
-    new_au_file = audio_file.scan(path)
-    if new_au_file is None:
-        raise ImportFileError(["New file damaged!"])
-    new_au_file.volume = au_file.volume
-    new_au_file.import_timestamp = au_file.import_timestamp
-    post_write_tagging_errors = checker.find_tags_errors(new_au_file)
-    if post_write_tagging_errors:
+    if verify == VERIFY_FULL:
+        post_write_errors = _verify_full(au_file, path)
+    else:
+        check_payload = (verify == VERIFY_STREAM
+                         or _is_sampled(au_file, sample_fraction))
+        post_write_errors = _verify_stream(au_file, path, check_payload)
+    if post_write_errors:
         os.unlink(path)
         raise ImportFileError(
-            ["Found post-write errors!"] + post_write_tagging_errors)
+            ["Found post-write errors!"] + post_write_errors)
 
     return path
-
-
-
@@ -88,6 +88,88 @@ class ImportFileTest(unittest.TestCase):
         self.assertEqual(au_file.fingerprint, new_au_file.fingerprint)
         self.assertEqual(au_file.payload, new_au_file.payload)
 
+    def prepare_for_write(self, path, get_payload):
+        au_file = audio_file.scan(path, get_payload=get_payload)
+        au_file.volume = TEST_VOL
+        au_file.import_timestamp = TEST_TS
+        au_file.album_id = 77777
+        au_file.mutagen_id3[constants.UFID_OWNER_IDENTIFIER] = ufid.ufid_tag(
+            TEST_VOL, TEST_TS, au_file.fingerprint)
+        import_file.standardize_file(au_file)
+        return au_file
+
+    prepare_for_write.__test__ = False  # not a test itself
+
+    def test_write_file_from_source_ranges(self):
+        path = self.create_test_file(TEST_TAG_LIST)
+        # Put some junk on the end of the source file, which should
+        # not be copied.
+        out_fh = open(path, "a")
+        out_fh.write("junk" * 100)
+        out_fh.close()
+        expected = audio_file.scan(path)
+
+        au_file = self.prepare_for_write(path, get_payload=False)
+        self.assertEqual(None, au_file.payload)
+        new_path = import_file.write_file(au_file, self.prefix)
+        new_au_file = audio_file.scan(new_path)
+        self.assertEqual(expected.fingerprint, new_au_file.fingerprint)
+        self.assertEqual(expected.payload, new_au_file.payload)
+        self.assertEqual([], new_au_file.payload_ranges[1:])
+
+        # Without known frame locations, the source is scanned for them.
+        au_file = self.prepare_for_write(path, get_payload=False)
+        au_file.payload_ranges = None
+        new_path = import_file.write_file(au_file, os.path.join(self.prefix,
+                                                                "other"))
+        self.assertEqual(expected.payload, audio_file.scan(new_path).payload)
+
+    def test_write_file_fingerprint_mismatch(self):
+        path = self.create_test_file(TEST_TAG_LIST)
+        au_file = self.prepare_for_write(path, get_payload=False)
+        au_file.payload_ranges = [(offset + 1, size)
+                                  for offset, size in au_file.payload_ranges]
+        self.assertRaises(import_file.ImportFileError,
+                          import_file.write_file, au_file, self.prefix)
+        self.assertFalse(os.path.exists(au_file.canonical_path(self.prefix)))
+
+    def test_write_file_verification(self):
+        path = self.create_test_file(TEST_TAG_LIST)
+        for i, verify in enumerate((import_file.VERIFY_FULL,
+                                    import_file.VERIFY_STREAM,
+                                    import_file.VERIFY_SAMPLED)):
+            au_file = self.prepare_for_write(path, get_payload=False)
+            import_file.write_file(au_file, os.path.join(self.prefix, str(i)),
+                                   verify=verify)
+        self.assertRaises(ValueError, import_file.write_file, au_file,
+                          self.prefix, verify="bogus")
+
+        # Damage the audio on its way into the library.
+        au_file = self.prepare_for_write(path, get_payload=True)
+        au_file.payload = au_file.payload[:-1] + "?"
+        self.assertRaises(import_file.ImportFileError,
+                          import_file.write_file, au_file, self.prefix,
+                          verify=import_file.VERIFY_STREAM)
+        self.assertFalse(os.path.exists(au_file.canonical_path(self.prefix)))
+        # When sampling, the damage is only noticed if this file is
+        # picked.
+        self.assertRaises(import_file.ImportFileError,
+                          import_file.write_file, au_file, self.prefix,
+                          verify=import_file.VERIFY_SAMPLED,
+                          sample_fraction=1)
+        import_file.write_file(au_file, self.prefix,
+                               verify=import_file.VERIFY_SAMPLED,
+                               sample_fraction=0)
+
+        # A short file is always caught.
+        au_file = self.prepare_for_write(path, get_payload=True)
+        au_file.payload = au_file.payload[:-1]
+        self.assertRaises(import_file.ImportFileError,
+                          import_file.write_file, au_file,
+                          os.path.join(self.prefix, "short"),
+                          verify=import_file.VERIFY_SAMPLED,
+                          sample_fraction=0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,78 @@
+"""
+A temporary on-disk store of albums that are ready to be imported.
+
+do_periodic_import scans and validates every album in the dropbox
+before importing any of them.  Rather than keeping all of those albums
+in memory (or scanning the dropbox a second time), each album that
+passes validation is written to an ImportSpool: its standardized tags,
+fingerprints, frame statistics and the locations of its MPEG frames.
+Once the whole dropbox has been validated, the import is driven from
+the spool.  Payloads are never spooled; the MPEG frames are copied
+directly from the source files when the albums are written into the
+library.
+"""
+
+import copy
+import cPickle
+import tempfile
+
+from chirp.library import album
+
+
+class ImportSpool(object):
+    """An append-only sequence of albums, kept in a temporary file."""
+
+    def __init__(self, tmp_dir=None):
+        """Constructor.
+
+        Args:
+          tmp_dir: The directory in which to create the spool file.  If
+            None, the system default is used.
+        """
+        self._tmp_dir = tmp_dir
+        self._spool_file = None
+        self._num_albums = 0
+
+    def __len__(self):
+        return self._num_albums
+
+    def add(self, alb):
+        """Append an album to the spool.
+
+        Args:
+          alb: An Album object.  The album itself is not modified.
+        """
+        if self._spool_file is None:
+            self._spool_file = tempfile.TemporaryFile(
+                prefix="chirp-import-", dir=self._tmp_dir)
+        all_au_files = []
+        for au in alb.all_au_files:
+            # Never write payloads into the spool.
+            au = copy.copy(au)
+            au.payload = None
+            all_au_files.append(au)
+        self._spool_file.seek(0, 2)
+        cPickle.dump(all_au_files, self._spool_file, cPickle.HIGHEST_PROTOCOL)
+        self._num_albums += 1
+
+    def albums(self):
+        """Yields the spooled albums, in the order they were added.
+
+        Each album is read back from disk as it is needed, so only one
+        album is held in memory at a time.
+        """
+        if self._spool_file is None:
+            return
+        self._spool_file.seek(0)
+        for _ in xrange(self._num_albums):
+            all_au_files = cPickle.load(self._spool_file)
+            offset = self._spool_file.tell()
+            yield album.Album(all_au_files)
+            self._spool_file.seek(offset)
+
+    def close(self):
+        """Delete the spool file."""
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+        self._num_albums = 0
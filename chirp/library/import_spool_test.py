@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import unittest
+
+import mutagen.id3
+
+from chirp.library import album
+from chirp.library import audio_file
+from chirp.library import import_spool
+
+
+def create_test_album(talb, num_tracks):
+    all_au_files = []
+    for i in range(1, num_tracks + 1):
+        au_file = audio_file.AudioFile()
+        au_file.path = "/dropbox/%s/%d.mp3" % (talb, i)
+        au_file.fingerprint = "%039x%d" % (i, num_tracks)
+        au_file.frame_size = 1000 * i
+        au_file.payload_ranges = [(100, 1000 * i)]
+        au_file.payload = "payload"
+        au_file.mutagen_id3 = mutagen.id3.ID3()
+        au_file.mutagen_id3.add(mutagen.id3.TALB(text=[talb], encoding=3))
+        au_file.mutagen_id3.add(
+            mutagen.id3.TRCK(text=["%d/%d" % (i, num_tracks)], encoding=3))
+        all_au_files.append(au_file)
+    return album.Album(all_au_files)
+
+create_test_album.__test__ = False  # not a test itself
+
+
+class ImportSpoolTest(unittest.TestCase):
+
+    def test_spool(self):
+        spool = import_spool.ImportSpool()
+        self.assertEqual([], list(spool.albums()))
+        originals = [create_test_album("Album %d" % n, n) for n in (3, 1, 5)]
+        for alb in originals:
+            spool.add(alb)
+        self.assertEqual(3, len(spool))
+        # The albums themselves are untouched.
+        self.assertEqual("payload", originals[0].all_au_files[0].payload)
+
+        # The albums can be read back more than once.
+        for _ in range(2):
+            spooled = list(spool.albums())
+            self.assertEqual(len(originals), len(spooled))
+            for orig, alb in zip(originals, spooled):
+                self.assertEqual(orig.album_id, alb.album_id)
+                self.assertEqual(orig.title(), alb.title())
+                for orig_au, au in zip(orig.all_au_files, alb.all_au_files):
+                    self.assertEqual(None, au.payload)
+                    orig_au.payload = None
+                    self.assertEqual(orig_au, au)
+                    self.assertEqual(orig_au.payload_ranges,
+                                     au.payload_ranges)
+        spool.close()
+        self.assertEqual(0, len(spool))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,12 +11,13 @@ from chirp.library import ufid
 class ImportTransaction(object):
 
     def __init__(self, db, volume, import_timestamp, tmp_prefix,
-                 dry_run=True):
+                 dry_run=True, verify=import_file.VERIFY_STREAM):
         self._db = db
         self._volume = volume
         self._import_timestamp = import_timestamp
         self._tmp_prefix = tmp_prefix
         self._dry_run = dry_run
+        self._verify = verify
 
         self.total_size_in_bytes = 0
         self.num_albums = 0
@@ -30,17 +31,19 @@ class ImportTransaction(object):
         # Plug in the volume and import timestamp for this transaction.
         alb.set_volume_and_import_timestamp(
             self._volume, self._import_timestamp)
-        alb.ensure_payloads()
 
         cprint(u'Adding Album "%s"' % alb.title())
         sys.stdout.flush()
 
-        # Write the files to our temporary prefix.
+        # Write the files to our temporary prefix.  The MPEG frames
+        # are copied directly from the source files, unless the album
+        # already has its payloads in hand.
         for au_file in alb.all_au_files:
             # Might raise an ImportFileError.
             if not self._dry_run:
-                import_file.write_file(au_file, self._tmp_prefix)
-        # We forget the payloads immediately to save RAM.
+                import_file.write_file(au_file, self._tmp_prefix,
+                                       verify=self._verify)
+        # Forget any payloads immediately to save RAM.
         alb.drop_payloads()
 
         # Everything checks out!
@@ -57,6 +60,9 @@ class ImportTransaction(object):
         # Write each new file into the database.
         for au_file in self._all_au_files:
             txn.add(au_file)
+        # Find out about any problems with the new rows before we move
+        # the files into the library.
+        txn.flush()
         ufid_prefix = ufid.ufid_prefix(self._volume, self._import_timestamp)
         # Strip off trailing "/"
         if ufid_prefix.endswith("/"):
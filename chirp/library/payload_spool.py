@@ -0,0 +1,155 @@
+"""
+Keep the payloads of scanned audio files under a fixed memory budget.
+
+A full scan of an MP3 file can store a copy of all of its MPEG frames
+in the AudioFile's 'payload' field.  Holding on to the payloads of
+every track of many albums at once uses a lot of RAM, so a PayloadSpool
+keeps track of the total size of the payloads it has been handed and,
+once its budget is exceeded, moves the oldest ones out into a temporary
+file.  The 'payload' field of a spilled AudioFile is replaced by a
+SpilledPayload object, which can be read back or copied into another
+file.
+"""
+
+import collections
+import tempfile
+
+
+# The default memory budget for a PayloadSpool.
+DEFAULT_BUDGET_BYTES = 64 << 20
+
+# The size of the reads used when copying a spilled payload.
+_COPY_SIZE = 1 << 20
+
+
+class SpilledPayload(object):
+    """A payload that has been moved out of memory into a spool file."""
+
+    def __init__(self, spool_file, offset, size):
+        self._spool_file = spool_file
+        self._offset = offset
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def read(self):
+        """Returns the payload as a string."""
+        self._spool_file.seek(self._offset)
+        return self._spool_file.read(self._size)
+
+    def write_to(self, out_fh):
+        """Copies the payload into a file-like object, a block at a time."""
+        self._spool_file.seek(self._offset)
+        remaining = self._size
+        while remaining > 0:
+            block = self._spool_file.read(min(remaining, _COPY_SIZE))
+            if not block:
+                raise IOError("Spool file is truncated")
+            out_fh.write(block)
+            remaining -= len(block)
+
+
+def write(payload, out_fh):
+    """Writes a payload into a file-like object.
+
+    Args:
+      payload: Either a string or a SpilledPayload.
+      out_fh: A file-like object to write the payload to.
+    """
+    if isinstance(payload, SpilledPayload):
+        payload.write_to(out_fh)
+    else:
+        out_fh.write(payload)
+
+
+class PayloadSpool(object):
+    """Limits the amount of memory used by a set of AudioFile payloads.
+
+    Attributes:
+      budget_bytes: The maximum total size of the payloads kept in memory.
+      in_memory_bytes: The total size of the payloads currently in memory.
+      spilled_bytes: The total size of the payloads currently spilled
+        to disk.
+    """
+
+    def __init__(self, budget_bytes=DEFAULT_BUDGET_BYTES, tmp_dir=None):
+        """Constructor.
+
+        Args:
+          budget_bytes: The maximum total size of the payloads to keep
+            in memory.
+          tmp_dir: The directory in which to create the spool file.  If
+            None, the system default is used.
+        """
+        self.budget_bytes = budget_bytes
+        self.in_memory_bytes = 0
+        self.spilled_bytes = 0
+        self._tmp_dir = tmp_dir
+        self._spool_file = None
+        # Maps id(au_file) to au_file, oldest first, for each file whose
+        # payload is still in memory.
+        self._resident = collections.OrderedDict()
+
+    def add(self, au_file):
+        """Put an AudioFile's payload under the spool's control.
+
+        If this takes the total size of the payloads in memory over
+        the budget, the oldest payloads are spilled to disk.
+
+        Args:
+          au_file: An AudioFile object.  Nothing is done if its payload
+            is None or has already been spilled.
+        """
+        payload = au_file.payload
+        if payload is None or isinstance(payload, SpilledPayload):
+            return
+        if id(au_file) in self._resident:
+            return
+        self._resident[id(au_file)] = au_file
+        self.in_memory_bytes += len(payload)
+        while self.in_memory_bytes > self.budget_bytes:
+            _, oldest = self._resident.popitem(last=False)
+            self._spill(oldest)
+
+    def _spill(self, au_file):
+        if self._spool_file is None:
+            self._spool_file = tempfile.TemporaryFile(
+                prefix="chirp-payload-", dir=self._tmp_dir)
+        payload = au_file.payload
+        self._spool_file.seek(0, 2)
+        offset = self._spool_file.tell()
+        self._spool_file.write(payload)
+        au_file.payload = SpilledPayload(self._spool_file, offset,
+                                         len(payload))
+        self.in_memory_bytes -= len(payload)
+        self.spilled_bytes += len(payload)
+
+    def release(self, au_file):
+        """Forget an AudioFile's payload, wherever it is kept.
+
+        Args:
+          au_file: An AudioFile object.  Its payload is set to None.
+        """
+        payload = au_file.payload
+        if payload is None:
+            return
+        if self._resident.pop(id(au_file), None) is not None:
+            self.in_memory_bytes -= len(payload)
+        elif isinstance(payload, SpilledPayload):
+            self.spilled_bytes -= len(payload)
+            # Once nothing in the spool file is still in use, reclaim
+            # the disk space.
+            if self.spilled_bytes == 0 and self._spool_file is not None:
+                self._spool_file.seek(0)
+                self._spool_file.truncate()
+        au_file.payload = None
+
+    def close(self):
+        """Delete the spool file.  Spilled payloads become unreadable."""
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+        self._resident.clear()
+        self.in_memory_bytes = 0
+        self.spilled_bytes = 0
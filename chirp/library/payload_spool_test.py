@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import cStringIO
+import unittest
+
+from chirp.library import audio_file
+from chirp.library import payload_spool
+
+
+def _au_file(payload):
+    au_file = audio_file.AudioFile()
+    au_file.payload = payload
+    return au_file
+
+
+def _as_string(payload):
+    out = cStringIO.StringIO()
+    payload_spool.write(payload, out)
+    return out.getvalue()
+
+
+class PayloadSpoolTest(unittest.TestCase):
+
+    def test_spill_and_release(self):
+        spool = payload_spool.PayloadSpool(budget_bytes=250)
+        payloads = [chr(ord("a") + i) * 100 for i in range(4)]
+        all_au_files = [_au_file(p) for p in payloads]
+        for au_file in all_au_files:
+            spool.add(au_file)
+            self.assertTrue(spool.in_memory_bytes <= spool.budget_bytes)
+        # The oldest payloads were spilled first.
+        self.assertTrue(isinstance(all_au_files[0].payload,
+                                   payload_spool.SpilledPayload))
+        self.assertTrue(isinstance(all_au_files[1].payload,
+                                   payload_spool.SpilledPayload))
+        self.assertEqual(payloads[2], all_au_files[2].payload)
+        self.assertEqual(200, spool.in_memory_bytes)
+        self.assertEqual(200, spool.spilled_bytes)
+        # Every payload still has the right contents.
+        for payload, au_file in zip(payloads, all_au_files):
+            self.assertEqual(100, len(au_file.payload))
+            self.assertEqual(payload, _as_string(au_file.payload))
+        self.assertEqual(payloads[0], all_au_files[0].payload.read())
+
+        # Adding the same file twice does nothing.
+        spool.add(all_au_files[3])
+        self.assertEqual(200, spool.in_memory_bytes)
+
+        for au_file in all_au_files:
+            spool.release(au_file)
+            self.assertEqual(None, au_file.payload)
+        self.assertEqual(0, spool.in_memory_bytes)
+        self.assertEqual(0, spool.spilled_bytes)
+        spool.close()
+
+    def test_oversized_payload(self):
+        spool = payload_spool.PayloadSpool(budget_bytes=10)
+        au_file = _au_file("x" * 1000)
+        spool.add(au_file)
+        self.assertEqual(0, spool.in_memory_bytes)
+        self.assertEqual("x" * 1000, _as_string(au_file.payload))
+        spool.close()
+
+    def test_no_payload(self):
+        spool = payload_spool.PayloadSpool(budget_bytes=10)
+        au_file = _au_file(None)
+        spool.add(au_file)
+        spool.release(au_file)
+        self.assertEqual(0, spool.in_memory_bytes)
+        self.assertEqual(0, spool.spilled_bytes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,493 @@
+"""
+A persistent cache of the results of audio_file.scan and scan_fast.
+
+Scanning a file means parsing its tags with mutagen and, for a full
+scan, reading and hashing every MPEG frame.  Most of the files we scan
+(for example, in the dropbox during a dry run of do_periodic_import)
+have not changed since the last time we looked at them, so we keep the
+results in a small sqlite database.
+
+Entries are keyed by the file's path together with its device, inode,
+size and modification time, so any change to the file makes its entry
+stale.  Each entry holds the fingerprint, the frame statistics, the
+representative MP3 header, the locations of the MPEG frames and a
+snapshot of the file's (cleaned-up) tags.  The snapshot is plain JSON
+(see tag_codec); files whose tags cannot be encoded faithfully are
+simply not cached.  The mutagen objects returned from the cache have
+no stream information (their 'info' is None).  Payloads are never
+cached: AudioFile objects returned from the cache always have payload
+set to None.
+
+The cache also keeps the frame_table.FrameTable of every file that gets
+a full scan, keyed by the same file identity.  A full scan of a file
+whose scan entry is missing (for example, because its tags cannot be
+cached, or because the entry format changed) then only has to parse
+the tags.
+
+The cache database should live on a local disk, not on a network share.
+"""
+
+import base64
+import json
+import os
+import sqlite3
+import struct
+
+import mutagen
+import mutagen.id3
+import mutagen.mp3
+
+from chirp.common import frame_table
+from chirp.common import mp3_header
+from chirp.library import audio_file
+from chirp.library import tag_codec
+
+
+# Bump this whenever the format of the cached data changes.  Caches
+# written by an older version are silently discarded.
+_FORMAT_VERSION = 3
+
+# Tag snapshots follow the field layout of mutagen's frame classes, so
+# they are only valid for the version of mutagen that produced them.
+_FORMAT_STRING = "%d/mutagen-%s" % (_FORMAT_VERSION, mutagen.version_string)
+
+# Commit after this many new entries have been written.
+_COMMIT_INTERVAL = 100
+
+_CREATE_TABLES = (
+    """
+CREATE TABLE IF NOT EXISTS scan_cache (
+  path TEXT,
+  fast INTEGER,  /* 1 if this came from scan_fast */
+  device INTEGER,
+  inode INTEGER,
+  size INTEGER,
+  mtime_ns INTEGER,
+  fingerprint TEXT,
+  volume INTEGER,
+  import_timestamp INTEGER,
+  album_id INTEGER,
+  frame_count INTEGER,
+  frame_size INTEGER,
+  duration_ms INTEGER,
+  hdr_sampling_rate_hz INTEGER,
+  hdr_bit_rate_kbps REAL,
+  hdr_channels INTEGER,
+  hdr_protected INTEGER,
+  hdr_padding INTEGER,
+  tags TEXT,  /* JSON; see _encode_tags */
+  payload_ranges BLOB,  /* packed (offset, size) pairs */
+  PRIMARY KEY (path, fast)
+)
+""",
+    """
+CREATE TABLE IF NOT EXISTS scan_cache_frame_tables (
+  path TEXT PRIMARY KEY,
+  device INTEGER,
+  inode INTEGER,
+  size INTEGER,
+  mtime_ns INTEGER,
+  frame_table BLOB  /* see FrameTable.serialize */
+)
+""",
+    """
+CREATE TABLE IF NOT EXISTS scan_cache_info (
+  name TEXT PRIMARY KEY,
+  value
+)
+""",
+)
+
+_COLUMNS = ("path", "fast", "device", "inode", "size", "mtime_ns",
+            "fingerprint", "volume", "import_timestamp", "album_id",
+            "frame_count", "frame_size", "duration_ms",
+            "hdr_sampling_rate_hz", "hdr_bit_rate_kbps", "hdr_channels",
+            "hdr_protected", "hdr_padding", "tags", "payload_ranges")
+
+
+def _mtime_ns(stat_obj):
+    return int(getattr(stat_obj, "st_mtime_ns", stat_obj.st_mtime * 1e9))
+
+
+def file_key(path, stat_obj=None):
+    """Returns the identity of the file at path, as used by the cache.
+
+    Args:
+      path: The path to a file.
+      stat_obj: If given, the result of os.stat(path).
+
+    Returns:
+      A (path, device, inode, size, mtime_ns) tuple.
+
+    Raises:
+      OSError: if the file cannot be stat-ed.
+    """
+    if stat_obj is None:
+        stat_obj = os.stat(path)
+    return (path, stat_obj.st_dev, stat_obj.st_ino, stat_obj.st_size,
+            _mtime_ns(stat_obj))
+
+
+def _to_db_bool(value):
+    if value is None:
+        return None
+    return int(value)
+
+
+def _from_db_bool(value):
+    if value is None:
+        return None
+    return bool(value)
+
+
+def _to_db_ranges(ranges):
+    if ranges is None:
+        return None
+    flat = [x for offset_and_size in ranges for x in offset_and_size]
+    return sqlite3.Binary(struct.pack("<%dQ" % len(flat), *flat))
+
+
+def _from_db_ranges(value):
+    if value is None:
+        return None
+    value = str(value)
+    flat = struct.unpack("<%dQ" % (len(value) / 8), value)
+    return zip(flat[0::2], flat[1::2])
+
+
+def _encode_tags(mutagen_id3):
+    """Take a JSON snapshot of the tags in a mutagen.mp3.MP3 object.
+
+    Returns:
+      A string, or None if the tags cannot be faithfully encoded.
+    """
+    tags = mutagen_id3.tags
+    if tags is None:
+        return json.dumps(None)
+    frames = []
+    for frame in tags.itervalues():
+        encoded = tag_codec.encode(frame)
+        if encoded is None:
+            return None
+        frames.append(encoded)
+    return json.dumps({
+        "version": tags.version,
+        "size": tags.size,
+        "frames": frames,
+        "unknown_frames": [base64.b64encode(data)
+                           for data in tags.unknown_frames],
+        })
+
+
+def _decode_tags(value, path):
+    """Turn a snapshot taken by _encode_tags back into a mutagen object.
+
+    Returns:
+      A mutagen.mp3.MP3 object whose 'info' is None.
+
+    Raises:
+      ValueError: if the snapshot is malformed.
+    """
+    try:
+        snapshot = json.loads(value)
+        mp3 = mutagen.mp3.MP3.__new__(mutagen.mp3.MP3)
+        mp3.filename = path
+        mp3.info = None
+        mp3.tags = None
+        if snapshot is not None:
+            mp3.tags = mutagen.id3.ID3()
+            mp3.tags.filename = path
+            mp3.tags.version = tuple(snapshot["version"])
+            mp3.tags.size = snapshot["size"]
+            for encoded in snapshot["frames"]:
+                mp3.tags.add(tag_codec.decode(encoded))
+            mp3.tags.unknown_frames = [
+                base64.b64decode(data)
+                for data in snapshot["unknown_frames"]]
+    except (KeyError, TypeError):
+        raise ValueError("Malformed tag snapshot")
+    return mp3
+
+
+class ScanCache(object):
+    """A persistent cache of AudioFile objects.
+
+    Attributes:
+      hits: The number of lookups that found a fresh entry.
+      misses: The number of lookups that did not.
+    """
+
+    def __init__(self, name):
+        """Constructor.
+
+        Args:
+          name: The path to the sqlite database holding the cache.
+        """
+        self._name = name
+        self._conn = sqlite3.connect(name)
+        self._conn.text_factory = str
+        self._pending_writes = 0
+        self.hits = 0
+        self.misses = 0
+        # The values of hits and misses as of the last flush.
+        self._flushed_hits = 0
+        self._flushed_misses = 0
+        for sql in _CREATE_TABLES:
+            self._conn.execute(sql)
+        if self._get_info("format") != _FORMAT_STRING:
+            # The table's layout may have changed too, so start over.
+            self._conn.execute("DROP TABLE scan_cache")
+            self._conn.execute(_CREATE_TABLES[0])
+            self._set_info("format", _FORMAT_STRING)
+        self._conn.commit()
+
+    def _get_info(self, name, default=None):
+        row = self._conn.execute(
+            "SELECT value FROM scan_cache_info WHERE name = ?",
+            (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_info(self, name, value):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO scan_cache_info VALUES (?, ?)",
+            (name, value))
+
+    def get(self, key, fast):
+        """Look up a file in the cache.
+
+        Args:
+          key: The file's identity, as returned by file_key().
+          fast: True to look up the result of scan_fast, False for scan.
+
+        Returns:
+          A new AudioFile object, or None if there is no fresh entry
+          for the file.
+        """
+        path, device, inode, size, mtime_ns = key
+        row = self._conn.execute(
+            "SELECT %s FROM scan_cache WHERE path = ? AND fast = ?"
+            % ",".join(_COLUMNS), (path, int(fast))).fetchone()
+        if row is None or row[2:6] != (device, inode, size, mtime_ns):
+            self.misses += 1
+            return None
+        values = dict(zip(_COLUMNS, row))
+        try:
+            mutagen_id3 = _decode_tags(values["tags"], path)
+        except ValueError:
+            # A corrupted snapshot is just a cache miss.
+            self.misses += 1
+            return None
+        au_file = audio_file.AudioFile()
+        au_file.path = path
+        au_file.mutagen_id3 = mutagen_id3
+        for attr in ("fingerprint", "volume", "import_timestamp",
+                     "album_id", "frame_count", "frame_size",
+                     "duration_ms"):
+            setattr(au_file, attr, values[attr])
+        au_file.mp3_header = mp3_header.MP3Header(
+            sampling_rate_hz=values["hdr_sampling_rate_hz"],
+            bit_rate_kbps=values["hdr_bit_rate_kbps"],
+            channels=values["hdr_channels"],
+            protected=_from_db_bool(values["hdr_protected"]),
+            padding=_from_db_bool(values["hdr_padding"]))
+        au_file.payload_ranges = _from_db_ranges(values["payload_ranges"])
+        self.hits += 1
+        return au_file
+
+    def get_frame_table(self, key):
+        """Look up the FrameTable of a file.
+
+        Args:
+          key: The file's identity, as returned by file_key().
+
+        Returns:
+          A FrameTable, or None if there is no fresh table for the file.
+        """
+        path, device, inode, size, mtime_ns = key
+        row = self._conn.execute(
+            "SELECT device, inode, size, mtime_ns, frame_table"
+            " FROM scan_cache_frame_tables WHERE path = ?",
+            (path,)).fetchone()
+        if row is None or row[:4] != (device, inode, size, mtime_ns):
+            return None
+        # Tables written in an older format are just missing.
+        return frame_table.deserialize(str(row[4]))
+
+    def put_frame_table(self, key, table):
+        """Store the FrameTable of a file.
+
+        Args:
+          key: The file's identity, as returned by file_key() *before*
+            the table was built.
+          table: A FrameTable describing the file.
+        """
+        self._conn.execute(
+            "INSERT OR REPLACE INTO scan_cache_frame_tables"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            key + (sqlite3.Binary(table.serialize()),))
+        self._pending_writes += 1
+        if self._pending_writes >= _COMMIT_INTERVAL:
+            self.flush()
+
+    def put(self, key, au_file, fast):
+        """Store the result of a scan in the cache.
+
+        Args:
+          key: The file's identity, as returned by file_key() *before*
+            the file was scanned.
+          au_file: The AudioFile returned by the scan.
+          fast: True if au_file came from scan_fast, False for scan.
+
+        Nothing is stored if au_file's tags cannot be faithfully encoded.
+        """
+        tags = _encode_tags(au_file.mutagen_id3)
+        if tags is None:
+            return
+        hdr = au_file.mp3_header or mp3_header.MP3Header()
+        path, device, inode, size, mtime_ns = key
+        row = (path, int(fast), device, inode, size, mtime_ns,
+               au_file.fingerprint, au_file.volume, au_file.import_timestamp,
+               au_file.album_id, au_file.frame_count, au_file.frame_size,
+               au_file.duration_ms,
+               hdr.sampling_rate_hz, hdr.bit_rate_kbps, hdr.channels,
+               _to_db_bool(hdr.protected), _to_db_bool(hdr.padding),
+               tags,
+               _to_db_ranges(au_file.payload_ranges))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO scan_cache VALUES (%s)"
+            % ",".join("?" * len(row)), row)
+        self._pending_writes += 1
+        if self._pending_writes >= _COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Commit any new entries, and update the lifetime counters."""
+        if self.hits != self._flushed_hits:
+            self._set_info("hits", self._get_info("hits", 0)
+                           + self.hits - self._flushed_hits)
+            self._flushed_hits = self.hits
+        if self.misses != self._flushed_misses:
+            self._set_info("misses", self._get_info("misses", 0)
+                           + self.misses - self._flushed_misses)
+            self._flushed_misses = self.misses
+        self._conn.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        """Flush and close the cache."""
+        self.flush()
+        self._conn.close()
+
+    def stats(self):
+        """Returns a dict of statistics about the cache."""
+        return {
+            "entries": self._conn.execute(
+                "SELECT COUNT(*) FROM scan_cache").fetchone()[0],
+            "frame_tables": self._conn.execute(
+                "SELECT COUNT(*) FROM scan_cache_frame_tables").fetchone()[0],
+            "lifetime_hits": self._get_info("hits", 0),
+            "lifetime_misses": self._get_info("misses", 0),
+            "hits": self.hits,
+            "misses": self.misses,
+            }
+
+    def invalidate(self, path_prefix=None):
+        """Remove entries, and frame tables, from the cache.
+
+        Args:
+          path_prefix: If given, only remove the entries for files whose
+            paths start with this prefix.  Otherwise remove everything.
+
+        Returns:
+          The number of entries removed.
+        """
+        removed = 0
+        for table_name in ("scan_cache", "scan_cache_frame_tables"):
+            if path_prefix is None:
+                cursor = self._conn.execute("DELETE FROM %s" % table_name)
+            else:
+                # Avoid LIKE, since paths can contain wildcard characters.
+                cursor = self._conn.execute(
+                    "DELETE FROM %s WHERE substr(path, 1, ?) = ?"
+                    % table_name, (len(path_prefix), path_prefix))
+            if table_name == "scan_cache":
+                removed = cursor.rowcount
+        self._conn.commit()
+        return removed
+
+    def compact(self):
+        """Remove stale entries and frame tables, then shrink the
+        database file.
+
+        An entry is stale if its file has disappeared or changed.
+
+        Returns:
+          The number of entries removed.
+        """
+        removed = 0
+        for table_name in ("scan_cache", "scan_cache_frame_tables"):
+            stale = []
+            for row in self._conn.execute(
+                "SELECT path, device, inode, size, mtime_ns FROM %s"
+                % table_name):
+                try:
+                    if file_key(row[0]) != tuple(row):
+                        stale.append((row[0],))
+                except OSError:
+                    stale.append((row[0],))
+            self._conn.executemany(
+                "DELETE FROM %s WHERE path = ?" % table_name, stale)
+            if table_name == "scan_cache":
+                removed = len(stale)
+        self._conn.commit()
+        self._conn.execute("VACUUM")
+        return removed
+
+
+def scan(path, cache, fast=False, get_payload=True):
+    """Scan a file, using and updating a cache.
+
+    Args:
+      path: The path to an MP3 file.
+      cache: A ScanCache object, or None to bypass the cache entirely.
+      fast: If True, use audio_file.scan_fast instead of audio_file.scan.
+      get_payload: If False, never set the payload of the returned
+        AudioFile.  This has no effect on fast scans.
+
+    Returns:
+      The same thing as audio_file.scan or audio_file.scan_fast.  If the
+      result comes from the cache, its payload is not set.
+    """
+    if fast:
+        scan_func = audio_file.scan_fast
+    else:
+        scan_func = lambda p: audio_file.scan(p, get_payload=get_payload)
+    if cache is None:
+        return scan_func(path)
+    key = file_key(path)
+    au_file = cache.get(key, fast)
+    if au_file is None:
+        if not (fast or get_payload):
+            scan_func = lambda p: audio_file.scan(
+                p, table=_get_frame_table(p, key, cache))
+        au_file = scan_func(path)
+        if au_file is not None:
+            cache.put(key, au_file, fast)
+    return au_file
+
+
+def _get_frame_table(path, key, cache):
+    """Returns the FrameTable for a file, building and caching it if
+    necessary.
+    """
+    table = cache.get_frame_table(key)
+    if table is None:
+        f_in = open(path, "rb")
+        try:
+            table = frame_table.build(f_in)
+        finally:
+            f_in.close()
+        cache.put_frame_table(key, table)
+    return table
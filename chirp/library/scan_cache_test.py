@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+import mutagen.id3
+
+from chirp.common import ROOT_DIR
+from chirp.library import audio_file
+from chirp.library import scan_cache
+
+
+TEST_MP3 = os.path.join(ROOT_DIR, "library/testdata/analyzer_test/test001.mp3")
+
+
+class ScanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cache_db = os.path.join(self.test_dir, "cache.sqlite3_db")
+        self.mp3_path = os.path.join(self.test_dir, "test.mp3")
+        shutil.copy(TEST_MP3, self.mp3_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def assert_same(self, expected, au_file):
+        self.assertEqual(None, au_file.payload)
+        expected.payload = None
+        self.assertEqual(expected, au_file)
+        self.assertEqual(expected.mp3_header.bit_rate_kbps,
+                         au_file.mp3_header.bit_rate_kbps)
+        self.assertEqual(expected.payload_ranges, au_file.payload_ranges)
+
+    def test_scan(self):
+        cache = scan_cache.ScanCache(self.cache_db)
+        for fast, scan_func in ((False, audio_file.scan),
+                                (True, audio_file.scan_fast)):
+            expected = scan_func(self.mp3_path)
+            first = scan_cache.scan(self.mp3_path, cache, fast=fast)
+            self.assertEqual(expected, first)
+            second = scan_cache.scan(self.mp3_path, cache, fast=fast)
+            self.assert_same(expected, second)
+            # Every lookup returns a fresh object.
+            self.assertFalse(first.mutagen_id3 is second.mutagen_id3)
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(2, cache.misses)
+        cache.close()
+
+        # The cache persists, and so do the counters.
+        cache = scan_cache.ScanCache(self.cache_db)
+        self.assert_same(audio_file.scan(self.mp3_path),
+                         scan_cache.scan(self.mp3_path, cache))
+        stats = cache.stats()
+        self.assertEqual(2, stats["entries"])
+        self.assertEqual(1, stats["hits"])
+        cache.flush()
+        self.assertEqual(3, cache.stats()["lifetime_hits"])
+        self.assertEqual(2, cache.stats()["lifetime_misses"])
+
+        # Modifying the file causes a miss.
+        future = time.time() + 10
+        os.utime(self.mp3_path, (future, future))
+        scan_cache.scan(self.mp3_path, cache)
+        self.assertEqual(1, cache.misses)
+        cache.close()
+
+    def test_invalidate_and_compact(self):
+        cache = scan_cache.ScanCache(self.cache_db)
+        other_path = os.path.join(self.test_dir, "other.mp3")
+        shutil.copy(TEST_MP3, other_path)
+        for path in (self.mp3_path, other_path):
+            scan_cache.scan(path, cache, fast=True)
+        self.assertEqual(1, cache.invalidate(other_path))
+        self.assertEqual(1, cache.stats()["entries"])
+        scan_cache.scan(other_path, cache, fast=True)
+
+        # Entries for changed and deleted files are removed.
+        os.unlink(other_path)
+        self.assertEqual(1, cache.compact())
+        self.assertEqual(0, cache.compact())
+        self.assertEqual(1, cache.invalidate())
+        self.assertEqual(0, cache.stats()["entries"])
+        cache.close()
+
+    def test_tag_snapshots(self):
+        cache = scan_cache.ScanCache(self.cache_db)
+        # Snapshots are stored as JSON, and keep frames that mutagen
+        # does not understand.
+        expected = scan_cache.scan(self.mp3_path, cache, fast=True)
+        expected.mutagen_id3.tags.unknown_frames.append("XXXX\0\0\0\1\0\0x")
+        cache.put(scan_cache.file_key(self.mp3_path), expected, True)
+        snapshot = json.loads(cache._conn.execute(
+            "SELECT tags FROM scan_cache").fetchone()[0])
+        self.assertEqual(len(expected.mutagen_id3), len(snapshot["frames"]))
+        au_file = scan_cache.scan(self.mp3_path, cache, fast=True)
+        self.assert_same(expected, au_file)
+        self.assertEqual(expected.mutagen_id3.tags.unknown_frames,
+                         au_file.mutagen_id3.tags.unknown_frames)
+        self.assertEqual(None, au_file.mutagen_id3.info)
+
+        # A file with no tags at all.
+        mutagen.id3.delete(self.mp3_path)
+        expected = scan_cache.scan(self.mp3_path, cache)
+        self.assertEqual(None, expected.mutagen_id3.tags)
+        au_file = scan_cache.scan(self.mp3_path, cache)
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(None, au_file.mutagen_id3.tags)
+
+        # Tags that cannot be encoded faithfully are not cached.
+        cache.invalidate()
+        shutil.copy(TEST_MP3, self.mp3_path)
+        with mock.patch.object(scan_cache.tag_codec, "encode",
+                               return_value=None):
+            scan_cache.scan(self.mp3_path, cache)
+        self.assertEqual(0, cache.stats()["entries"])
+        cache.close()
+
+    def test_frame_tables(self):
+        cache = scan_cache.ScanCache(self.cache_db)
+        expected = audio_file.scan(self.mp3_path, get_payload=False)
+        # Files whose tags can't be cached still have their frame
+        # tables cached, so that they are only split once.
+        with mock.patch.object(scan_cache.tag_codec, "encode",
+                               return_value=None):
+            self.assertEqual(expected, scan_cache.scan(
+                    self.mp3_path, cache, get_payload=False))
+            self.assertEqual(0, cache.stats()["entries"])
+            self.assertEqual(1, cache.stats()["frame_tables"])
+            with mock.patch.object(scan_cache.frame_table, "build",
+                                   side_effect=AssertionError):
+                au_file = scan_cache.scan(self.mp3_path, cache,
+                                          get_payload=False)
+        self.assertEqual(expected, au_file)
+        self.assertEqual(expected.payload_ranges, au_file.payload_ranges)
+
+        # Scans that need the payload still read the whole file.
+        self.assertTrue(scan_cache.scan(
+                self.mp3_path, cache).payload is not None)
+
+        # Modifying the file makes its frame table stale.
+        key = scan_cache.file_key(self.mp3_path)
+        self.assertTrue(cache.get_frame_table(key) is not None)
+        future = time.time() + 10
+        os.utime(self.mp3_path, (future, future))
+        self.assertEqual(
+            None, cache.get_frame_table(scan_cache.file_key(self.mp3_path)))
+        cache.compact()
+        self.assertEqual(0, cache.stats()["frame_tables"])
+
+        scan_cache.scan(self.mp3_path, cache, get_payload=False)
+        self.assertEqual(1, cache.stats()["frame_tables"])
+        cache.invalidate(self.test_dir)
+        self.assertEqual(0, cache.stats()["frame_tables"])
+        cache.close()
+
+    def test_bypass(self):
+        au_file = scan_cache.scan(self.mp3_path, None)
+        self.assertTrue(au_file.payload is not None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,12 +5,31 @@ Our data model is extremely simple:
   * Each audio file is uniquely identified by a fingerprint.
   * Each audio file has many ID3 tags.
   * ID3 tags are partitioned into sets by a timestamp.
+  * The set of tags with the greatest timestamp is a file's current
+    tags, and is also kept in its own table.
+  * Every change to an audio file is recorded, in commit order, in a
+    change log.
+
+There are two versions of the schema; a database's version is stored
+in its user_version pragma.  Version 1 (user_version 0) stores
+fingerprints as hex strings and keeps each table in rowid order.
+Version 2 stores fingerprints as raw bytes and integer-coded frame ids,
+and clusters each table on its fingerprint so that no separate indexes
+are needed.  The two versions have the same table and column names,
+plus a seq column in the version 2 tag tables.
 """
 
+import binascii
+import sqlite3
+import struct
+
 from chirp.common import mp3_header
 from chirp.library import audio_file
+from chirp.library import tag_codec
 
 
+# Version 1 of the schema.
+
 create_audio_files_table = """
 CREATE TABLE audio_files (
   volume INTEGER,            /* volume number */
@@ -39,7 +58,8 @@ CREATE TABLE id3_tags (
     timestamp INTEGER, /* Timestamp of this ID3 tag */
     frame_id TEXT,     /* The value of this_mutagen_id3_tag.FrameID */
     value TEXT,        /* For text tags,  unicode(this_mutagen_id3_tag) */
-    mutagen_repr TEXT  /* Very Python- and Mutagen-specific */
+    mutagen_repr TEXT, /* Very Python- and Mutagen-specific */
+    tag_json TEXT      /* tag_codec.encode(this_mutagen_id3_tag), or NULL */
 )
 """
 
@@ -50,11 +70,133 @@ ON id3_tags ( fingerprint, timestamp DESC )
 """
 
 
-def audio_file_to_tuple(au_file):
+# id3_tags holds the full history of every file's tags.  This table
+# holds a copy of just the rows with each file's greatest timestamp,
+# which are the only ones we normally want to read.
+create_current_id3_tags_table = """
+CREATE TABLE current_id3_tags (
+    fingerprint TEXT,  /* Fingerprint of the file this tag is part of */
+    timestamp INTEGER, /* Timestamp of this ID3 tag */
+    frame_id TEXT,     /* The value of this_mutagen_id3_tag.FrameID */
+    value TEXT,        /* For text tags,  unicode(this_mutagen_id3_tag) */
+    mutagen_repr TEXT, /* Very Python- and Mutagen-specific */
+    tag_json TEXT      /* tag_codec.encode(this_mutagen_id3_tag), or NULL */
+)
+"""
+
+
+create_current_id3_tags_index = """
+CREATE INDEX current_id3_tags_index_fingerprint
+ON current_id3_tags ( fingerprint )
+"""
+
+
+# The current schema version.
+SCHEMA_VERSION = 2
+
+# The version 2 statements take the name of the table to create, so
+# that a database can be migrated by building new tables alongside
+# the old ones.
+
+create_audio_files_table_v2 = """
+CREATE TABLE %s (
+  volume INTEGER,            /* volume number */
+  import_timestamp INTEGER,  /* seconds since the epoch */
+  fingerprint BLOB PRIMARY KEY,  /* SHA1 hash of the MPEG frames, as bytes */
+  album_id INTEGER,          /* Unique identifier for source album. */
+  sampling_rate_hz INTEGER,  /* Audio sampling rate, measured in Hz */
+  bit_rate_kbps INTEGER,     /* File bit rate, measued in kbps */
+  channels INTEGER,          /* MPEG channel identifier */
+  frame_count INTEGER,       /* total number of MPEG frames */
+  frame_size INTEGER,        /* total size of all MPEG frames, in bytes */
+  duration_ms INTEGER        /* song duration, measured in milliseconds */
+) WITHOUT ROWID
+"""
+
+# Used for both id3_tags and current_id3_tags.
+create_id3_tags_table_v2 = """
+CREATE TABLE %s (
+    fingerprint BLOB,  /* Fingerprint of the file this tag is part of */
+    timestamp INTEGER, /* Timestamp of this ID3 tag */
+    seq INTEGER,       /* Distinguishes tags with the same timestamp */
+    frame_id INTEGER,  /* frame_id_to_code(this_mutagen_id3_tag.FrameID) */
+    value TEXT,        /* For text tags,  unicode(this_mutagen_id3_tag) */
+    mutagen_repr TEXT, /* Only set if tag_json is NULL */
+    tag_json TEXT,     /* tag_codec.encode(this_mutagen_id3_tag), or NULL */
+    PRIMARY KEY ( fingerprint, timestamp, seq )
+) WITHOUT ROWID
+"""
+
+
+# Indexes on audio_files for each of the ways that we walk through the
+# library.  These work with either version of the schema.
+create_audio_files_access_indexes = (
+    # Database.get_all: ORDER BY import_timestamp DESC, album_id
+    """
+    CREATE INDEX IF NOT EXISTS audio_files_index_timestamp_album
+    ON audio_files ( import_timestamp DESC, album_id )
+    """,
+    # Database.get_by_import: WHERE volume=? AND import_timestamp=?
+    # ORDER BY album_id
+    """
+    CREATE INDEX IF NOT EXISTS audio_files_index_import
+    ON audio_files ( volume, import_timestamp, album_id )
+    """,
+    # Database.get_all_imports: SELECT DISTINCT volume, import_timestamp
+    # ORDER BY import_timestamp.  This covers the query, so the table
+    # itself is never touched.
+    """
+    CREATE INDEX IF NOT EXISTS audio_files_index_timestamp_volume
+    ON audio_files ( import_timestamp, volume )
+    """,
+)
+
+
+# A log of every change made to the library.  seq only ever increases
+# (AUTOINCREMENT never reuses a value, even after rows are deleted), so
+# it orders the changes by when they were committed.  This works with
+# either version of the schema; fingerprints are stored in the same
+# form as in the audio_files table.
+create_changes_table = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp INTEGER, /* When the change was made */
+    fingerprint BLOB,  /* Fingerprint of the file that was changed */
+    change TEXT        /* "add", "update" or "delete" */
+)
+"""
+
+
+def fingerprint_to_db(fingerprint):
+    """Convert a fingerprint into the form stored by a version 2 schema."""
+    return sqlite3.Binary(binascii.unhexlify(fingerprint))
+
+
+def fingerprint_from_db(value):
+    """Convert a fingerprint read from a database of any version."""
+    if isinstance(value, buffer):
+        return binascii.hexlify(value)
+    return str(value)
+
+
+def frame_id_to_code(frame_id):
+    """Turn an ID3 frame id like "TIT2" into an integer."""
+    return struct.unpack(">I", str(frame_id).ljust(4)[:4])[0]
+
+
+def code_to_frame_id(code):
+    """This is the inverse of frame_id_to_code."""
+    return struct.pack(">I", code).rstrip()
+
+
+def audio_file_to_tuple(au_file, schema_version=1):
     """Turn an AudioFile object into an insertable tuple."""
+    fingerprint = au_file.fingerprint
+    if schema_version >= 2:
+        fingerprint = fingerprint_to_db(fingerprint)
     return (au_file.volume,
             au_file.import_timestamp,
-            au_file.fingerprint,
+            fingerprint,
             au_file.album_id,
             au_file.mp3_header.sampling_rate_hz,
             au_file.mp3_header.bit_rate_kbps,
@@ -67,12 +209,12 @@ def audio_file_to_tuple(au_file):
 def tuple_to_audio_file(au_file_tuple):
     """Convert a tuple into a new AudioFile object.
 
-    This is the inverse of audio_file_to_tuple.
+    This is the inverse of audio_file_to_tuple, for any schema version.
     """
     au_file = audio_file.AudioFile()
     (au_file.volume,
      au_file.import_timestamp,
-     au_file.fingerprint,
+     raw_fingerprint,
      raw_album_id,
      sampling_rate_hz,
      bit_rate_kbps,
@@ -80,6 +222,7 @@ def tuple_to_audio_file(au_file_tuple):
      au_file.frame_count,
      au_file.frame_size,
      au_file.duration_ms) = au_file_tuple
+    au_file.fingerprint = fingerprint_from_db(raw_fingerprint)
     au_file.album_id = int(raw_album_id)
     au_file.mp3_header = mp3_header.MP3Header(
         sampling_rate_hz=sampling_rate_hz,
@@ -88,9 +231,40 @@ def tuple_to_audio_file(au_file_tuple):
     return au_file
 
 
+# The id3_tags tables of databases created before the tag_json column
+# was introduced only have this many columns.
+ID3_TAGS_LEGACY_COLUMNS = 5
+
+
 def id3_tag_to_tuple(fingerprint, timestamp, tag):
-    """Turn a Mutagen ID3 tag object into an insertable tuple."""
+    """Turn a Mutagen ID3 tag object into an insertable tuple.
+
+    The mutagen_repr column is always filled in, so that older code can
+    still read the tags.  To insert into a table without the tag_json
+    column, use the first ID3_TAGS_LEGACY_COLUMNS items.
+    """
     value = u""
     if hasattr(tag, "text"):
         value = unicode(tag)
-    return (fingerprint, timestamp, tag.FrameID, value, repr(tag))
+    tag_repr = repr(tag)
+    return (fingerprint, timestamp, tag.FrameID, value, tag_repr,
+            tag_codec.encode(tag, tag_repr))
+
+
+def tag_tuple_to_v2(tag_tuple, seq):
+    """Convert a tuple from id3_tag_to_tuple for a version 2 schema.
+
+    Args:
+      tag_tuple: A tuple returned by id3_tag_to_tuple.
+      seq: An integer that is unique among the tags of this file with
+        the same timestamp.
+
+    Returns:
+      A tuple that can be inserted into a version 2 id3_tags or
+      current_id3_tags table.
+    """
+    fingerprint, timestamp, frame_id, value, tag_repr, tag_json = tag_tuple
+    if tag_json is not None:
+        tag_repr = None
+    return (fingerprint_to_db(fingerprint), timestamp, seq,
+            frame_id_to_code(frame_id), value, tag_repr, tag_json)
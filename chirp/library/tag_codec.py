@@ -0,0 +1,149 @@
+"""
+A structured encoding for ID3 tags stored in the library database.
+
+Historically each row of the id3_tags table held repr() of a mutagen
+frame, which was turned back into a frame with eval().  That is slow
+and unsafe.  This module instead encodes a frame as a compact JSON
+list: the name of the frame's class followed by the values of its
+fields, in the order that mutagen declares them.  For example:
+
+    ["TIT2", 3, ["Song Title"]]
+    ["UFID", "http://chirpradio.org/_ufid/1", {"b": "dm9sMDEv..."}]
+
+Unicode strings, numbers and None are stored as themselves.  Byte strings
+(which mutagen uses for binary data) are base64-encoded and wrapped
+in a {"b": ...} object so that they cannot be confused with text.
+
+Only frames whose encoding round-trips exactly are encoded; for
+anything else encode() returns None and callers should keep using
+the old repr() column.
+
+Many tag values (TOWN, TFLT, the album's TALB and TPE1, ...) repeat
+over and over, so decoded values are kept in a cache keyed by the
+encoded string.  Every call to decode() still returns a new frame
+object, so callers are free to modify what they get back.
+"""
+
+import base64
+import json
+
+import mutagen.id3
+
+
+# When the decode (or repr) cache grows past this many entries, it is
+# emptied.
+_DECODE_CACHE_SIZE = 50000
+
+_decode_cache = {}
+
+# Maps encoded frames to the repr() of the frame they decode to, so
+# that encode() does not need to check the same value twice.
+_repr_cache = {}
+
+
+def _to_json_value(value):
+    # Frames that were constructed without an explicit text encoding
+    # have an encoding of None.
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, mutagen.id3.ID3TimeStamp):
+        return unicode(value.text)
+    if isinstance(value, str):
+        return {"b": base64.b64encode(value)}
+    if isinstance(value, bool):
+        raise ValueError("Unexpected bool in ID3 frame")
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, list):
+        return [_to_json_value(x) for x in value]
+    raise ValueError("Cannot encode %r" % (value,))
+
+
+def _from_json_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value["b"])
+    if isinstance(value, list):
+        return [_from_json_value(x) for x in value]
+    return value
+
+
+def _get_frame_class(name):
+    cls = getattr(mutagen.id3, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, mutagen.id3.Frame)):
+        raise ValueError("Not an ID3 frame type: %r" % name)
+    return cls
+
+
+def encode(tag, tag_repr=None):
+    """Encode a mutagen ID3 frame.
+
+    Args:
+      tag: A mutagen.id3.Frame object.
+      tag_repr: repr(tag), if the caller has already computed it.
+
+    Returns:
+      A unicode string containing the encoded frame, or None if this
+      frame cannot be faithfully encoded.
+    """
+    name = type(tag).__name__
+    try:
+        _get_frame_class(name)
+        encoded = json.dumps(
+            [name] + [_to_json_value(getattr(tag, spec.name))
+                      for spec in tag._framespec],
+            ensure_ascii=False, separators=(",", ":"))
+    except (ValueError, TypeError, AttributeError):
+        return None
+    # json.dumps returns a str if everything happened to be ASCII.
+    encoded = unicode(encoded)
+    # Be paranoid: only use encodings that give us back exactly what
+    # we started with.
+    decoded_repr = _repr_cache.get(encoded)
+    if decoded_repr is None:
+        try:
+            decoded_repr = repr(decode(encoded))
+        except (ValueError, TypeError):
+            return None
+        if len(_repr_cache) >= _DECODE_CACHE_SIZE:
+            _repr_cache.clear()
+        _repr_cache[encoded] = decoded_repr
+    if tag_repr is None:
+        tag_repr = repr(tag)
+    if decoded_repr != tag_repr:
+        return None
+    return encoded
+
+
+def decode(encoded):
+    """Turn an encoded frame back into a mutagen ID3 frame.
+
+    Args:
+      encoded: A string returned by encode().
+
+    Returns:
+      A new mutagen.id3.Frame object.
+
+    Raises:
+      ValueError: if encoded is not a valid encoded frame.
+    """
+    cached = _decode_cache.get(encoded)
+    if cached is None:
+        try:
+            items = json.loads(encoded)
+        except ValueError:
+            raise ValueError("Malformed encoded frame: %r" % encoded)
+        if not (isinstance(items, list) and items
+                and isinstance(items[0], basestring)):
+            raise ValueError("Malformed encoded frame: %r" % encoded)
+        cls = _get_frame_class(str(items[0]))
+        try:
+            cached = (cls, [_from_json_value(x) for x in items[1:]])
+        except (KeyError, TypeError):
+            raise ValueError("Malformed encoded frame: %r" % encoded)
+        if len(_decode_cache) >= _DECODE_CACHE_SIZE:
+            _decode_cache.clear()
+        _decode_cache[encoded] = cached
+    cls, values = cached
+    # The frame's field validators copy the (possibly shared) lists of
+    # values, so each frame gets its own.
+    return cls(*values)
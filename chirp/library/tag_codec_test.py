@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import mutagen.id3
+
+from chirp.library import tag_codec
+
+
+TEST_TAGS = [
+    mutagen.id3.TIT2(encoding=3, text=[u"Song über alles"]),
+    mutagen.id3.TPE1(encoding=1, text=[u"Artist 1", u"Artist 2"]),
+    mutagen.id3.TRCK(encoding=3, text=[u"3/7"]),
+    mutagen.id3.TALB(text=[u"No explicit encoding"]),
+    mutagen.id3.TDRC(encoding=3, text=[u"1999-03-01"]),
+    mutagen.id3.TXXX(encoding=3, desc=u"Description", text=[u"Text"]),
+    mutagen.id3.UFID(owner=u"http://chirpradio.org/_ufid/1",
+                     data="vol01/20090101-010101/0123456789abcdef"),
+    mutagen.id3.COMM(encoding=3, lang="eng", desc=u"", text=[u"Comment"]),
+    mutagen.id3.APIC(encoding=0, mime=u"image/jpeg", type=3, desc=u"",
+                     data="\x00\xff\xd8 binary data"),
+]
+
+
+class TagCodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for tag in TEST_TAGS:
+            encoded = tag_codec.encode(tag)
+            self.assertTrue(isinstance(encoded, unicode), repr(tag))
+            self.assertEqual(repr(tag), repr(tag_codec.decode(encoded)))
+            # Decoding again (from the cache) gives the same thing.
+            self.assertEqual(repr(tag), repr(tag_codec.decode(encoded)))
+
+    def test_format(self):
+        self.assertEqual(
+            u'["TIT2",3,["Title"]]',
+            tag_codec.encode(mutagen.id3.TIT2(encoding=3, text=[u"Title"])))
+        # Byte strings are marked so they are never mistaken for text.
+        encoded = tag_codec.encode(
+            mutagen.id3.UFID(owner=u"owner", data="data"))
+        self.assertEqual(u'["UFID","owner",{"b":"ZGF0YQ=="}]', encoded)
+
+    def test_decode_returns_new_frames(self):
+        tag = mutagen.id3.TPE1(encoding=3, text=[u"Artist"])
+        encoded = tag_codec.encode(tag)
+        first = tag_codec.decode(encoded)
+        first.text[0] = u"Changed"
+        first.text.append(u"Added")
+        second = tag_codec.decode(encoded)
+        self.assertFalse(first is second)
+        self.assertEqual([u"Artist"], second.text)
+
+    def test_decode_errors(self):
+        for bad in (u"", u"not json", u"{}", u"[]", u"[3]",
+                    u'["ID3"]', u'["os"]', u'["NoSuchFrame", 3, []]',
+                    u'["UFID", "owner", {"x": "y"}]'):
+            self.assertRaises(ValueError, tag_codec.decode, bad)
+
+
+if __name__ == "__main__":
+    unittest.main()
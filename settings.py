@@ -10,6 +10,17 @@ MUSIC_DROPBOX = op.join(SAMBA,
                  "public/public/Departments/Music Dept/New Music Dropbox/")
 # When an album needs fixing, it gets moved here:
 MUSIC_DROPBOX_FIX = op.join(SAMBA, "public/Departments/Music Dept/Needs-Fixing")
+# How MP3 files are read when they are scanned; one of "buffered" (4k
+# reads), "large" (big reads with readahead hints, best for network
+# filesystems) or "mmap" (best for local disks).
+MP3_READER = "large"
+# The size of each read done by the "large" reader; 1MB to 8MB.
+MP3_READER_READ_SIZE = 4 << 20
+# Cache of file scan results, so that unchanged files in the dropbox are
+# not re-read on every run.  This should be on a local disk.  The cache
+# is disabled by default; to enable it, set this to a path in
+# settings_local.py.
+SCAN_CACHE_DB = None
 
 
 # Path to checkout of App Engine code, from
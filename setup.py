@@ -1,10 +1,16 @@
 from setuptools import setup, find_packages
 
 
-with open('requirements/prod.txt') as fp:
-    requires = [
-        line.strip() for line in fp.readlines() if not line.startswith('#')
-    ]
+def read_requirements(path):
+    with open(path) as fp:
+        return [
+            line.strip() for line in fp.readlines()
+            if line.strip() and not line.startswith('#')
+        ]
+
+
+requires = read_requirements('requirements/prod.txt')
+optional_requires = read_requirements('requirements/optional.txt')
 
 
 setup(
@@ -17,6 +23,7 @@ setup(
     license="Apache License",
     packages=find_packages(exclude=['ez_setup']),
     install_requires=requires,
+    extras_require={'fast': optional_requires},
     url='',
     include_package_data=True,
     entry_points="""
@@ -31,6 +38,11 @@ setup(
        empty_dropbox = chirp.library.empty_dropbox:main
 
        do_delete_audio_file_from_db = chirp.library.do_delete_audio_file_from_db:main
+       do_scan_cache = chirp.library.do_scan_cache:main
+       do_migrate_tag_encoding = chirp.library.do_migrate_tag_encoding:main
+       do_rebuild_current_tags = chirp.library.do_rebuild_current_tags:main
+       do_migrate_schema = chirp.library.do_migrate_schema:main
+       do_maintain_catalog = chirp.library.do_maintain_catalog:main
        do_archive_stream = chirp.stream.do_archive_stream:main
        do_proxy_barix_status = chirp.stream.do_proxy_barix_status:main
        """,